@@ -0,0 +1,399 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Results are written here, one JSON file per run
+RESULTS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results')
+
+# How often uploaded documents are polled until they finish, and how long to wait at most
+STATUS_POLL_INTERVAL = 0.05
+PROCESSING_TIMEOUT = 600
+
+WORDS = (
+    "analysis data model system research method result theory student course lecture exam "
+    "paper chapter section figure table equation value process network learning memory "
+    "structure function variable sample error measure design study review summary"
+).split()
+
+def random_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def make_jpeg(rng, width, height):
+    """A small JPEG with a random colour pattern"""
+    from PIL import Image, ImageDraw
+    img = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randrange(width), rng.randrange(height)
+        draw.rectangle([x, y, x + rng.randrange(10, 80), y + rng.randrange(10, 80)],
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=80)
+    return img.size, buffer.getvalue()
+
+def make_pdf(rng, pages, images_per_page=1, lines_per_page=40):
+    """Build a PDF with text on every page and embedded JPEG images"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None]
+    font_ref = 3
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    page_refs = []
+
+    for _ in range(pages):
+        image_refs = []
+        for _ in range(images_per_page):
+            (width, height), data = make_jpeg(rng, 320, 240)
+            objects.append(
+                f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} /ColorSpace /DeviceRGB "
+                f"/BitsPerComponent 8 /Filter /DCTDecode /Length {len(data)} >>\nstream\n".encode()
+                + data + b"\nendstream"
+            )
+            image_refs.append(len(objects))
+
+        lines = ["BT /F1 10 Tf 50 760 Td 12 TL"]
+        lines += [f"({random_text(rng, 12)}) '" for _ in range(lines_per_page)]
+        lines.append("ET")
+        for i, ref in enumerate(image_refs):
+            lines.append(f"q 160 0 0 120 {50 + i * 170} 60 cm /Im{i} Do Q")
+        content = "\n".join(lines).encode()
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_ref = len(objects)
+
+        xobjects = " ".join(f"/Im{i} {ref} 0 R" for i, ref in enumerate(image_refs))
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {content_ref} 0 R "
+            f"/Resources << /Font << /F1 {font_ref} 0 R >> /XObject << {xobjects} >> >> >>".encode()
+        )
+        page_refs.append(len(objects))
+
+    kids = " ".join(f"{ref} 0 R" for ref in page_refs)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+def make_corpus(folder, seed, pdfs, pdf_pages, pdf_images, texts, text_kb, images):
+    """Write a synthetic corpus; the same seed always gives the same files"""
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    corpus = []
+
+    for i in range(pdfs):
+        path = os.path.join(folder, f"doc_{i:03d}.pdf")
+        with open(path, 'wb') as f:
+            f.write(make_pdf(rng, pdf_pages, pdf_images))
+        corpus.append({"path": path, "kind": "pdf", "pages": pdf_pages})
+
+    for i in range(texts):
+        path = os.path.join(folder, f"notes_{i:03d}.txt")
+        with open(path, 'w') as f:
+            while f.tell() < text_kb * 1024:
+                f.write(random_text(rng, 16) + "\n")
+        corpus.append({"path": path, "kind": "txt", "pages": 1})
+
+    for i in range(images):
+        path = os.path.join(folder, f"photo_{i:03d}.jpg")
+        with open(path, 'wb') as f:
+            f.write(make_jpeg(rng, 1600, 1200)[1])
+        corpus.append({"path": path, "kind": "image", "pages": 1})
+
+    return corpus
+
+def summarize(samples):
+    """Count, mean and p50/p90/p99 of latency samples, in ms"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2),
+        "p50_ms": percentile(0.50),
+        "p90_ms": percentile(0.90),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+def read_metric(base_url, name, **labels):
+    """Sum a metric's samples from /metrics, over all label sets or only those carrying the given labels"""
+    wanted = [f'{key}="{value}"' for key, value in labels.items()]
+    total = 0.0
+    for line in requests.get(f"{base_url}/metrics", timeout=10).text.splitlines():
+        if line.startswith(name + '{') or line.startswith(name + ' '):
+            series = line.rsplit(' ', 1)[0]
+            if all(label in series for label in wanted):
+                total += float(line.rsplit(' ', 1)[1])
+    return total
+
+def run_in_threads(clients, jobs, fn):
+    """Run fn(session, job) for every job across client threads, each with its own keep-alive session"""
+    local = threading.local()
+
+    def call(job):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return fn(local.session, job)
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        return list(pool.map(call, jobs))
+
+def bench_ingestion(base_url, corpus, clients):
+    """Upload the corpus from concurrent clients and poll each document until it is processed"""
+    def upload_and_wait(session, item):
+        started = time.perf_counter()
+        with open(item["path"], 'rb') as f:
+            response = session.post(
+                f"{base_url}/process_document",
+                files={"file": (os.path.basename(item["path"]), f)},
+                data={"user_id": "bench"},
+                timeout=120
+            )
+        upload_time = time.perf_counter() - started
+        response.raise_for_status()
+        doc_id = response.json()["document_id"]
+
+        status_times = []
+        status = None
+        deadline = time.time() + PROCESSING_TIMEOUT
+        while time.time() < deadline:
+            polled = time.perf_counter()
+            status = session.get(f"{base_url}/document_status/{doc_id}", timeout=30).json()["status"]
+            status_times.append(time.perf_counter() - polled)
+            if status in ("completed", "error"):
+                break
+            time.sleep(STATUS_POLL_INTERVAL)
+        return {
+            "kind": item["kind"],
+            "status": status,
+            "upload": upload_time,
+            "status_polls": status_times,
+            "total": time.perf_counter() - started,
+        }
+
+    started = time.perf_counter()
+    results = run_in_threads(clients, corpus, upload_and_wait)
+    elapsed = time.perf_counter() - started
+
+    pages = sum(item["pages"] for item in corpus)
+    by_kind = {}
+    for result in results:
+        by_kind.setdefault(result["kind"], []).append(result["total"])
+
+    # Only the extract stage, not the whole job (queueing, OCR, text writing and indexing)
+    extract_seconds = read_metric(base_url, 'span_duration_seconds_sum', span='extract')
+    return {
+        "documents": len(results),
+        "failed": sum(1 for result in results if result["status"] != "completed"),
+        "pages": pages,
+        "seconds": round(elapsed, 3),
+        "documents_per_second": round(len(results) / elapsed, 3),
+        "pages_per_second": round(pages / elapsed, 3),
+        "extraction_ms_per_page": round(extract_seconds / pages * 1000, 3) if extract_seconds and pages else None,
+        "upload_latency": summarize([result["upload"] for result in results]),
+        "status_latency_while_processing": summarize([t for result in results for t in result["status_polls"]]),
+        "end_to_end_by_type": {kind: summarize(times) for kind, times in by_kind.items()},
+    }
+
+def bench_status(base_url, clients, requests_total):
+    """Hammer /document_status of finished documents from concurrent clients"""
+    doc_ids = [doc["doc_id"] for doc in requests.get(f"{base_url}/documents?limit=500", timeout=30).json()["documents"]]
+    if not doc_ids:
+        return {"count": 0}
+
+    def get_status(session, i):
+        started = time.perf_counter()
+        session.get(f"{base_url}/document_status/{doc_ids[i % len(doc_ids)]}", timeout=30).raise_for_status()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    times = run_in_threads(clients, range(requests_total), get_status)
+    elapsed = time.perf_counter() - started
+    return dict(summarize(times), requests_per_second=round(len(times) / elapsed, 1))
+
+def bench_chat(base_url, fastchat_url, clients, requests_total):
+    """Compare /chat with calling the fake FastChat directly; the difference is the proxy's overhead"""
+    payload = {"model": "vicuna-7b-v1.5", "messages": [{"role": "user", "content": "hello"}], "max_tokens": 800}
+
+    def direct(session, i):
+        started = time.perf_counter()
+        session.post(f"{fastchat_url}/v1/chat/completions", json=payload, timeout=60).raise_for_status()
+        return time.perf_counter() - started
+
+    def proxied(session, i):
+        started = time.perf_counter()
+        # A different question each time, and no response cache, so every call reaches FastChat
+        body = {"message": f"question {i}", "conversation_history": [], "cache": False}
+        session.post(f"{base_url}/chat", json=body, timeout=60).raise_for_status()
+        return time.perf_counter() - started
+
+    direct_times = run_in_threads(clients, range(requests_total), direct)
+    started = time.perf_counter()
+    proxied_times = run_in_threads(clients, range(requests_total), proxied)
+    elapsed = time.perf_counter() - started
+
+    direct_summary = summarize(direct_times)
+    proxied_summary = summarize(proxied_times)
+    return {
+        "direct": direct_summary,
+        "proxied": proxied_summary,
+        "requests_per_second": round(len(proxied_times) / elapsed, 1),
+        "overhead_p50_ms": round(proxied_summary["p50_ms"] - direct_summary["p50_ms"], 2),
+        "overhead_p99_ms": round(proxied_summary["p99_ms"] - direct_summary["p99_ms"], 2),
+    }
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def start_servers(workers, token_delay):
+    """Start the fake FastChat and the API server on free local ports; returns their URLs"""
+    from werkzeug.serving import make_server
+    from http.server import ThreadingHTTPServer
+    import fake_fastchat
+
+    fake_fastchat.TOKEN_DELAY = token_delay
+    fake_server = ThreadingHTTPServer(('127.0.0.1', 0), fake_fastchat.FakeFastChatHandler)
+    fake_server.daemon_threads = True
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+    fastchat_url = f"http://127.0.0.1:{fake_server.server_port}"
+
+    # The API server reads its backends when imported
+    os.environ['FASTCHAT_BACKENDS'] = fastchat_url
+    # Every benchmark client shares one address, so per-client rate limits are off unless set
+    for name in ('CHAT_RATE_LIMIT', 'UPLOAD_RATE_LIMIT', 'API_RATE_LIMIT'):
+        os.environ.setdefault(name, '0')
+    import flask_api
+    import document_processor
+
+    document_processor.start_document_processing(workers)
+    api_server = make_server('127.0.0.1', 0, flask_api.app, threaded=True)
+    threading.Thread(target=api_server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{api_server.server_port}", fastchat_url
+
+def run_benchmarks(args):
+    """Run every benchmark against a fresh data folder and return the results"""
+    # Extraction goes to a throwaway folder: document_processor keeps its data relative to the cwd
+    data_dir = tempfile.mkdtemp(prefix='chatbot_bench_')
+    os.chdir(data_dir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        corpus = make_corpus(
+            os.path.join(data_dir, 'corpus'), args.seed, args.pdfs, args.pdf_pages, args.pdf_images,
+            args.texts, args.text_kb, args.images
+        )
+        base_url, fastchat_url = start_servers(args.workers, args.token_delay)
+
+        results = {"ingestion": bench_ingestion(base_url, corpus, args.clients)}
+        results["status"] = bench_status(base_url, args.clients, args.status_requests)
+        if args.chat_requests:
+            results["chat"] = bench_chat(base_url, fastchat_url, args.clients, args.chat_requests)
+
+        import document_processor
+        document_processor.stop_document_processing()
+        return results
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+def flatten(results, prefix=''):
+    """Flatten nested results to {"a.b.c": number} for comparisons"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare_runs(before_path, after_path):
+    """Print every metric of two result files side by side, with the relative change"""
+    with open(before_path) as f:
+        before = flatten(json.load(f)["results"])
+    with open(after_path) as f:
+        after = flatten(json.load(f)["results"])
+
+    width = max(len(name) for name in before.keys() | after.keys())
+    for name in sorted(before.keys() | after.keys()):
+        old, new = before.get(name), after.get(name)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        print(f"{name:<{width}}  {old if old is not None else '-':>12}  {new if new is not None else '-':>12}  {change}")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark document ingestion and the /chat proxy")
+    parser.add_argument('--seed', type=int, default=1, help="corpus seed (same seed, same files)")
+    parser.add_argument('--pdfs', type=int, default=8)
+    parser.add_argument('--pdf-pages', type=int, default=20)
+    parser.add_argument('--pdf-images', type=int, default=1, help="images per PDF page")
+    parser.add_argument('--texts', type=int, default=8)
+    parser.add_argument('--text-kb', type=int, default=64)
+    parser.add_argument('--images', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None, help="processing workers (DOC_PROCESSING_WORKERS)")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent clients")
+    parser.add_argument('--status-requests', type=int, default=2000)
+    parser.add_argument('--chat-requests', type=int, default=200, help="0 skips the chat benchmark")
+    parser.add_argument('--token-delay', type=float, default=0.0, help="fake FastChat seconds per token")
+    parser.add_argument('--name', default='run', help="label stored with the results")
+    parser.add_argument('--output', help="result file (default: benchmark_results/<name>-<time>.json)")
+    parser.add_argument('--keep-data', action='store_true', help="keep the temporary data folder")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files and exit")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    # Usage: python benchmark.py [--pdfs 8 --pdf-pages 20 ...] | --compare before.json after.json
+    args = parse_args(sys.argv[1:])
+    if args.compare:
+        compare_runs(*args.compare)
+        sys.exit(0)
+
+    output = os.path.abspath(args.output or os.path.join(
+        RESULTS_FOLDER, f"{args.name}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    ))
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    results = run_benchmarks(args)
+
+    report = {
+        "name": args.name,
+        "started_at": started_at,
+        "git_commit": get_git_commit(),
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {key: value for key, value in vars(args).items() if key not in ('compare', 'output')},
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
@@ -0,0 +1,173 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Tokens the chat template adds around every message (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+class TokenCounter:
+    """Count tokens with the model's own tokenizer, or estimate when it isn't installed"""
+
+    def __init__(self, tokenizer_name=None):
+        self.tokenizer_name = tokenizer_name
+        self.tokenizer = None
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not self.tokenizer_name:
+                return
+            try:
+                from transformers import AutoTokenizer
+                self.tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_name)
+            except Exception as e:
+                print(f"Tokenizer {self.tokenizer_name} unavailable, estimating token counts: {str(e)}")
+
+    def count(self, text):
+        """Count the tokens in a piece of text"""
+        if not self.loaded:
+            self._load()
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        # LLaMA's SentencePiece vocabulary averages a little over 3 characters per token
+        return (len(text) + 2) // 3
+
+    def count_messages(self, messages):
+        """Count the prompt tokens of a list of chat messages"""
+        return sum(self.count(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+class HistoryManager:
+    """Fit a conversation into the model's context window, summarizing or dropping old turns"""
+
+    def __init__(self, context_window=4096, max_new_tokens=800, summary_tokens=256,
+                 token_counter=None, summarizer=None, max_cached_summaries=1024):
+        self.context_window = context_window
+        self.max_new_tokens = max_new_tokens
+        self.summary_tokens = summary_tokens
+        self.token_counter = token_counter or TokenCounter()
+        self.summarizer = summarizer
+
+        # Prefix hash -> summary of every message in that prefix
+        self.summaries = OrderedDict()
+        self.max_cached_summaries = max_cached_summaries
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "compacted_requests": 0,
+            "summaries_generated": 0,
+            "summaries_reused": 0,
+            "summaries_extended": 0,
+            "tokens_saved_total": 0,
+        }
+
+    @property
+    def prompt_budget(self):
+        """Tokens available for the prompt once the completion is reserved"""
+        return self.context_window - self.max_new_tokens
+
+    def _prefix_hashes(self, messages):
+        """Rolling hashes, so the hash of every prefix is available in one pass"""
+        hashes = []
+        digest = hashlib.sha256()
+        for message in messages:
+            digest.update(json.dumps([message.get("role"), message.get("content")]).encode())
+            hashes.append(digest.copy().hexdigest())
+        return hashes
+
+    def _cached_summary(self, key):
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is not None:
+                self.summaries.move_to_end(key)
+            return summary
+
+    def _cache_summary(self, key, summary):
+        with self.lock:
+            self.summaries[key] = summary
+            self.summaries.move_to_end(key)
+            while len(self.summaries) > self.max_cached_summaries:
+                self.summaries.popitem(last=False)
+
+    def _summarize(self, older):
+        """Summarize older turns, extending the longest prefix already summarized"""
+        hashes = self._prefix_hashes(older)
+        summary = self._cached_summary(hashes[-1])
+        if summary is not None:
+            with self.lock:
+                self.counters["summaries_reused"] += 1
+            return summary
+
+        # Start from an earlier turn's summary so only the new turns are summarized
+        previous_summary = None
+        start = 0
+        for i in range(len(older) - 2, -1, -1):
+            previous_summary = self._cached_summary(hashes[i])
+            if previous_summary is not None:
+                start = i + 1
+                break
+
+        summary = self.summarizer(previous_summary, older[start:])
+        self._cache_summary(hashes[-1], summary)
+        with self.lock:
+            self.counters["summaries_generated"] += 1
+            if previous_summary is not None:
+                self.counters["summaries_extended"] += 1
+        return summary
+
+    def compact(self, messages):
+        """Return (messages that fit the budget, info about what was saved)"""
+        count = self.token_counter.count_messages
+        original_tokens = count(messages)
+        with self.lock:
+            self.counters["requests"] += 1
+
+        info = {"prompt_tokens": original_tokens, "tokens_saved": 0, "dropped_messages": 0, "summarized": False}
+        if original_tokens <= self.prompt_budget:
+            return messages, info
+
+        # The system prompt and the current message always stay
+        system = [m for m in messages[:1] if m.get("role") == "system"]
+        turns = messages[len(system):]
+        budget = self.prompt_budget - count(system) - count(turns[-1:])
+        if self.summarizer:
+            budget -= self.summary_tokens + MESSAGE_OVERHEAD_TOKENS
+
+        # Keep as many recent turns as fit
+        keep_from = len(turns) - 1
+        while keep_from > 0:
+            cost = count(turns[keep_from - 1:keep_from])
+            if cost > budget:
+                break
+            budget -= cost
+            keep_from -= 1
+        older, recent = turns[:keep_from], turns[keep_from:]
+
+        compacted = system + recent
+        if older and self.summarizer:
+            try:
+                summary = self._summarize(older)
+                compacted = system + [{
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation: {summary}"
+                }] + recent
+                info["summarized"] = True
+            except Exception as e:
+                print(f"Error summarizing conversation history, dropping old turns: {str(e)}")
+
+        info["prompt_tokens"] = count(compacted)
+        info["tokens_saved"] = max(0, original_tokens - info["prompt_tokens"])
+        info["dropped_messages"] = len(older)
+        with self.lock:
+            self.counters["compacted_requests"] += 1
+            self.counters["tokens_saved_total"] += info["tokens_saved"]
+        return compacted, info
+
+    def stats(self):
+        """Get compaction counters"""
+        with self.lock:
+            return dict(self.counters, cached_summaries=len(self.summaries))
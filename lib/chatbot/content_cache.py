@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+class ContentCache:
+    """Content-addressed index of extraction results, reference counted per document"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _conn(self):
+        """Get this thread's connection, creating the table on first use (connections can't be shared across threads)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS contents ("
+                "content_hash TEXT NOT NULL, file_ext TEXT NOT NULL, doc_id TEXT NOT NULL, "
+                "data TEXT NOT NULL, ref_count INTEGER NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (content_hash, file_ext))"
+            )
+            self.local.conn = conn
+        return conn
+
+    def acquire(self, content_hash, file_ext):
+        """Take a reference on finished content; returns its entry, or None on a miss"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = conn.execute(
+                "UPDATE contents SET ref_count = ref_count + 1 "
+                "WHERE content_hash = ? AND file_ext = ? AND ref_count > 0",
+                (content_hash, file_ext)
+            ).rowcount
+            row = None
+            if updated:
+                row = conn.execute(
+                    "SELECT doc_id, data FROM contents WHERE content_hash = ? AND file_ext = ?",
+                    (content_hash, file_ext)
+                ).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        if row is None:
+            return None
+        entry = json.loads(row[1])
+        entry['doc_id'] = row[0]
+        return entry
+
+    def register(self, content_hash, file_ext, doc_id, entry):
+        """Publish a document's extraction results; False if the content is already cached"""
+        conn = self._conn()
+        inserted = conn.execute(
+            "INSERT OR IGNORE INTO contents (content_hash, file_ext, doc_id, data, ref_count, created_at) "
+            "VALUES (?, ?, ?, ?, 1, ?)",
+            (content_hash, file_ext, doc_id, json.dumps(entry), time.time())
+        ).rowcount
+        return inserted == 1
+
+    def release(self, content_hash, file_ext):
+        """Drop a reference; returns the remaining count (the entry is removed at zero)"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE contents SET ref_count = ref_count - 1 "
+                "WHERE content_hash = ? AND file_ext = ? AND ref_count > 0",
+                (content_hash, file_ext)
+            )
+            row = conn.execute(
+                "SELECT ref_count FROM contents WHERE content_hash = ? AND file_ext = ?",
+                (content_hash, file_ext)
+            ).fetchone()
+            remaining = row[0] if row else 0
+            if remaining == 0:
+                conn.execute(
+                    "DELETE FROM contents WHERE content_hash = ? AND file_ext = ?",
+                    (content_hash, file_ext)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return remaining
+
+    def replace_text_files(self, new_paths):
+        """Point cached entries at the new paths of converted text files ({old path: new path})"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute("SELECT content_hash, file_ext, data FROM contents").fetchall()
+            for content_hash, file_ext, data in rows:
+                entry = json.loads(data)
+                if entry.get("text_file") in new_paths:
+                    entry["text_file"] = new_paths[entry["text_file"]]
+                    conn.execute(
+                        "UPDATE contents SET data = ? WHERE content_hash = ? AND file_ext = ?",
+                        (json.dumps(entry), content_hash, file_ext)
+                    )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def stats(self):
+        """Get the number of cached contents and the references held on them"""
+        row = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(ref_count), 0) FROM contents").fetchone()
+        return {"contents": row[0], "references": row[1]}
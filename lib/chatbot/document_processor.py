@@ -1,21 +1,88 @@
 import os
 import uuid
-import json
 import time
-from queue import Queue
-from threading import Thread
+import multiprocessing
+import shutil
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import Thread, Lock, Event
 import PyPDF2
-from PIL import Image
+import numpy as np
+from werkzeug.http import parse_options_header
 from werkzeug.utils import secure_filename
 
+import metadata_store
+import retrieval
+import image_pipeline
+import upload_ingest
+import job_scheduler
+import job_journal
+import ocr
+import office_extractors
+import metrics
+import status_board
+import text_store
+from upload_ingest import UploadRejected
+from content_cache import ContentCache
+from search_index import SearchIndex
+
 # Document processing settings
 UPLOAD_FOLDER = 'document_data'
-ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'txt', 'png', 'jpg', 'jpeg'}
+ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'ppt', 'pptx', 'txt', 'png', 'jpg', 'jpeg'}
+
+# Number of extraction processes (and dispatcher threads feeding them)
+PROCESSING_WORKERS = int(os.environ.get('DOC_PROCESSING_WORKERS', os.cpu_count() or 1))
+
+# PDFs are split into page ranges of this size and extracted in parallel
+PDF_PAGES_PER_CHUNK = int(os.environ.get('DOC_PDF_PAGES_PER_CHUNK', 20))
+
+# Where document metadata is kept: 'sqlite' (default) or the legacy 'json' file
+METADATA_BACKEND = os.environ.get('DOC_METADATA_BACKEND', 'sqlite')
+
+# Chunks embedded per process-pool job when indexing a document for retrieval
+EMBED_BATCH_SIZE = 256
+
+# Largest slice of text returned by one offset/limit request
+TEXT_RANGE_MAX_BYTES = 256 * 1024
+
+# Uploads are read from the request, hashed and written in chunks of this size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Pages with fewer extracted characters than this are treated as scans and OCRed
+OCR_MIN_PAGE_CHARS = 16
+
+# Scheduling: images and small files go first, big scans are bulk work
+SMALL_FILE_BYTES = 2 * 1024 * 1024
+SMALL_FILE_PAGES = 20
+BULK_FILE_BYTES = 25 * 1024 * 1024
+BULK_FILE_PAGES = 100
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+
+# Request bodies taken as a ZIP archive by the bulk upload endpoint
+ARCHIVE_MIMETYPES = {'application/zip', 'application/x-zip-compressed'}
+
+# Document processing queue (fair between users) and status tracking
+document_queue = job_scheduler.FairScheduler()
+document_status = status_board.StatusBoard()
+document_progress = {}
 
-# Document processing queue and status tracking
-document_queue = Queue()
-document_status = {}
-documents_data_file = os.path.join(UPLOAD_FOLDER, 'documents_data.json')
+# Most documents one batch status request may ask about, and the longest a status wait may block
+STATUS_BATCH_MAX = 500
+STATUS_WAIT_MAX_SECONDS = 60
+
+# Text files being written, so the pages finished so far can be read before a document completes
+text_writers = {}
+
+# Rewrite plain .txt files from before the compressed text format in the background after startup
+CONVERT_LEGACY_TEXT = os.environ.get('DOC_TEXT_CONVERT', '1') == '1'
+
+# Process pool running the CPU-bound extraction, plus per-worker bookkeeping
+processing_pool = None
+processing_pool_lock = Lock()
+worker_threads = []
+worker_stats = {}
+worker_stats_lock = Lock()
 
 # Initialize folders
 def init_document_folders():
@@ -26,162 +93,566 @@ def init_document_folders():
 
 # Load existing document data if available
 def load_documents_data():
-    """Load existing document data from file"""
-    if os.path.exists(documents_data_file):
-        try:
-            with open(documents_data_file, 'r') as f:
-                return json.load(f)
-        except:
-            return {}
-    else:
-        return {}
+    """Open the document metadata store, migrating the old JSON file if needed"""
+    return metadata_store.open_metadata_store(METADATA_BACKEND, UPLOAD_FOLDER)
+
+# Opened on first use, so importing this module (as every pool process does) stays cheap
+documents_data = metadata_store.LazyMetadataStore(load_documents_data)
+
+# Extraction results shared between uploads of identical files
+content_cache = ContentCache(os.path.join(UPLOAD_FOLDER, 'content_cache.db'))
+
+# Chunk vectors used to answer chat questions about documents (loaded on first use)
+vector_index = retrieval.VectorIndex(os.path.join(UPLOAD_FOLDER, 'vector_index'))
+
+# Full-text index behind /search (opened on first use)
+search_index = SearchIndex(os.path.join(UPLOAD_FOLDER, 'search_index.db'))
+
+# Durable record of queued and running jobs, replayed on startup
+job_journal_db = job_journal.JobJournal(os.path.join(UPLOAD_FOLDER, 'jobs.db'))
+maintenance_stop = Event()
 
-documents_data = load_documents_data()
+# Set once metadata is open and unfinished jobs are queued again (reported by /ready)
+processing_ready = Event()
+
+# How often leases are renewed and due retries are queued again
+JOB_MAINTENANCE_INTERVAL = 2
+
+# OCR of images and scanned pages, on its own bounded pool
+ocr_service = ocr.OcrService(os.path.join(UPLOAD_FOLDER, 'ocr_cache'))
+
+# Resized copies of document images served for ?w= requests
+image_variants = image_pipeline.VariantCache(os.path.join(UPLOAD_FOLDER, 'images', 'variants'))
+
+def get_charged_size(doc_data):
+    """Bytes a document counts against its user's quota; a copy linked to an identical file stores none"""
+    return 0 if doc_data.get("deduplicated_from") else doc_data.get("size", 0)
+
+def get_storage_usage():
+    """Yield (user_id, size) for every stored document, to seed the storage quota"""
+    for doc in documents_data.query():
+        yield doc.get("metadata", {}).get("user_id", ""), get_charged_size(doc)
+
+# Stored bytes per user, checked while uploads stream in
+storage_quota = upload_ingest.StorageQuota(get_storage_usage)
+
+# Chunked uploads that can resume after a dropped connection
+resumable_uploads = upload_ingest.ResumableUploads(os.path.join(UPLOAD_FOLDER, 'uploads'), storage_quota)
+
+# Bulk uploads, with the archives they bring while those are being extracted
+upload_batches = upload_ingest.UploadBatches(os.path.join(UPLOAD_FOLDER, 'batches'))
+
+# Archives are deleted once their files are extracted, so they are not charged to anyone's quota
+archive_quota = upload_ingest.StorageQuota(lambda: (), user_quota=0, global_quota=0)
+
+def collect_job_states():
+    """Journaled jobs per state, for /metrics"""
+    return [((state,), count) for state, count in job_journal_db.stats().items()]
+
+def collect_busy_workers():
+    with worker_stats_lock:
+        return [((), sum(1 for stats in worker_stats.values() if stats["busy_since"] is not None))]
+
+# Queue and worker gauges, read when /metrics is scraped
+metrics.GaugeCallback(
+    'document_queue_depth', 'Documents waiting to be processed', ('priority',),
+    lambda: [((name,), depth) for name, depth in document_queue.stats()["by_priority"].items()]
+)
+metrics.GaugeCallback('document_jobs', 'Journaled processing jobs', ('state',), collect_job_states)
+metrics.GaugeCallback('document_workers_busy', 'Dispatcher threads running a job', (), collect_busy_workers)
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_document_worker():
-    """Worker thread to process documents from the queue"""
-    print("Document processing worker started")
+def get_file_size(path):
+    """Get a file's size, 0 if it is gone"""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def get_file_ext(filename):
+    """Get the lowercase extension of a file name"""
+    return filename.rsplit('.', 1)[-1].lower()
+
+def prepare_upload_path(filename):
+    """Check an upload's name and create its document folder; returns (doc_id, filename, filepath)"""
+    if not filename:
+        raise UploadRejected("No file selected")
+    if not allowed_file(filename):
+        raise UploadRejected(f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}")
+    
+    doc_id = str(uuid.uuid4())
+    doc_dir = os.path.join(UPLOAD_FOLDER, doc_id)
+    os.makedirs(doc_dir, exist_ok=True)
+    
+    # secure_filename() drops non-ASCII names entirely; keep at least the extension
+    ext = get_file_ext(filename)
+    safe_name = secure_filename(filename)
+    if not safe_name.lower().endswith('.' + ext):
+        safe_name = f"document.{ext}"
+    return doc_id, safe_name, os.path.join(doc_dir, safe_name)
+
+def get_upload_fields(form_data):
+    """Pick the document metadata fields out of an upload form"""
+    return {key: form_data.get(key, '') for key in ('title', 'description', 'category', 'tags', 'user_id')}
+
+def get_content_entry(doc_data):
+    """Get the extraction results of a document that other uploads can link to"""
+    return {
+        "filepath": doc_data["filepath"],
+        "text_file": doc_data["text_file"],
+        "images": doc_data.get("images", []),
+        "image_count": doc_data.get("image_count", 0),
+        "page_count": doc_data.get("page_count"),
+    }
+
+def index_document_text(doc_id, text_content):
+    """Chunk a document's text, embed the chunks on the process pool and add them to the index"""
+    try:
+        chunks = retrieval.chunk_text(text_content)
+        if not chunks:
+            return
+        
+        texts = [chunk["text"] for chunk in chunks]
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        if processing_pool is not None:
+            vectors = [future.result() for future in [processing_pool.submit(retrieval.embed_texts, b) for b in batches]]
+        else:
+            vectors = [retrieval.embed_texts(b) for b in batches]
+        
+        vector_index.add_document(doc_id, chunks, np.concatenate(vectors))
+    except Exception as e:
+        print(f"Error indexing document {doc_id}: {str(e)}")
+
+def index_document_search(doc_id, doc_data, text_content):
+    """Add a document's text and metadata to the full-text search index"""
+    try:
+        search_index.index_document(doc_id, doc_data, text_content)
+    except Exception as e:
+        print(f"Error adding document {doc_id} to search index: {str(e)}")
+
+def index_duplicate_document(doc_id, doc_data, source_doc_id):
+    """Index a deduplicated upload, sharing the original's retrieval chunks when they still exist"""
+    try:
+        text_content = text_store.open_text(doc_data["text_file"]).read_text()
+        index_document_search(doc_id, doc_data, text_content)
+        if not vector_index.alias_document(doc_id, source_doc_id):
+            index_document_text(doc_id, text_content)
+    except Exception as e:
+        print(f"Error indexing duplicate document {doc_id}: {str(e)}")
+
+def backfill_search_index():
+    """Index documents completed before the search index existed"""
+    if not search_index.is_empty():
+        return
+    
+    offset = 0
+    indexed = 0
+    while True:
+        batch = documents_data.query(status='completed', limit=500, offset=offset)
+        if not batch:
+            break
+        for doc_data in batch:
+            text_file = doc_data.get("text_file")
+            if text_file and os.path.exists(text_file):
+                index_document_search(doc_data["doc_id"], doc_data, text_store.open_text(text_file).read_text())
+                indexed += 1
+        offset += len(batch)
+    
+    if indexed:
+        print(f"Search index backfilled with {indexed} documents")
+
+def convert_legacy_text_files():
+    """Rewrite plain .txt files as compressed text files, updating every document that points at them"""
+    converted = {}
+    offset = 0
+    while True:
+        batch = documents_data.query(status='completed', limit=500, offset=offset)
+        if not batch:
+            break
+        for doc_data in batch:
+            text_file = doc_data.get("text_file")
+            if not text_file or text_store.is_text_store(text_file):
+                continue
+            try:
+                # Deduplicated uploads share a text file; it is converted once
+                if text_file not in converted:
+                    if not os.path.exists(text_file):
+                        continue
+                    converted[text_file] = text_store.convert_text_file(text_file)
+                
+                # Re-read the document, in case it changed (or was deleted) meanwhile
+                current = documents_data.get(doc_data["doc_id"])
+                if current and current.get("text_file") == text_file:
+                    current["text_file"] = converted[text_file]
+                    documents_data[doc_data["doc_id"]] = current
+            except Exception as e:
+                print(f"Error converting text of document {doc_data['doc_id']}: {str(e)}")
+        offset += len(batch)
+    
+    # The old files go once nothing points at them any more
+    if converted:
+        content_cache.replace_text_files(converted)
+        for text_file in converted:
+            text_store.remove_text_file(text_file)
+        print(f"Converted {len(converted)} text files to the compressed format")
+    return len(converted)
+
+def retrieve_document_chunks(query, doc_ids, k):
+    """Get the chunks of the given documents most relevant to a question, with their filenames"""
+    chunks = vector_index.search(query, doc_ids, k)
+    filenames = {}
+    for chunk in chunks:
+        if chunk["doc_id"] not in filenames:
+            filenames[chunk["doc_id"]] = (documents_data.get(chunk["doc_id"]) or {}).get("filename", "")
+        chunk["filename"] = filenames[chunk["doc_id"]]
+    return chunks
+
+def extract_document(filepath, doc_dir):
+    """Extract the pages of text and the images of a document (runs inside the process pool)"""
+    file_ext = filepath.split('.')[-1].lower()
+    text_content = ""
+    images = []
+    
+    if file_ext == 'pdf':
+        text_content, images = process_pdf(filepath, doc_dir)
+    elif file_ext in ['png', 'jpg', 'jpeg']:
+        text_content, images = process_image(filepath, doc_dir)
+    elif file_ext in ['txt']:
+        with open(filepath, 'r', errors='ignore') as f:
+            text_content = f.read()
+    elif file_ext in ['doc', 'docx', 'ppt', 'pptx']:
+        # Pages (Word page breaks, or slides) get the same markers as PDF pages
+        pages, images = office_extractors.extract_office_document(filepath, os.path.join(UPLOAD_FOLDER, 'images'))
+        return [format_page_text(i, page) for i, page in enumerate(pages, 1)], images
+    
+    return [text_content], images
+
+def process_document_worker(worker_id=0):
+    """Worker thread to dispatch documents from the queue to the process pool"""
+    print(f"Document processing worker {worker_id} started")
     while True:
         # Get document from queue
         doc_id = document_queue.get()
         
         if doc_id is None:  # Poison pill to stop thread
+            document_queue.task_done()
             break
             
+        started = time.time()
+        with worker_stats_lock:
+            worker_stats[worker_id]["current_document"] = doc_id
+            worker_stats[worker_id]["busy_since"] = started
+        if metrics.TRACING_ENABLED:
+            metrics.start_trace('document_job', doc_id=doc_id)
+            
+        doc_data = {}
+        outcome = None
         try:
+            # Take the job's lease; it may have been deleted while queued
+            attempt = job_journal_db.start(doc_id)
+            if attempt is None:
+                continue
+            
             # Update status to processing
-            document_status[doc_id] = "processing"
+            document_status.set(doc_id, "processing")
             
             # Get document data
             doc_data = documents_data.get(doc_id, {})
             
             if not doc_data:
                 print(f"Error: No data found for document {doc_id}")
-                document_status[doc_id] = "error"
-                document_queue.task_done()
+                document_status.set(doc_id, "error", error="Document data not found")
+                job_journal_db.fail(doc_id, "Document data not found", transient=False)
                 continue
                 
-            # Process document based on file type
-            filepath = doc_data.get('filepath')
-            file_ext = filepath.split('.')[-1].lower()
-            
             # Create doc directory if needed
+            filepath = doc_data.get('filepath')
             doc_dir = os.path.join(UPLOAD_FOLDER, doc_id)
             os.makedirs(doc_dir, exist_ok=True)
             
-            # Extract text and images
-            text_content = ""
-            images = []
+            # Extract text and images in the process pool
+            if filepath.split('.')[-1].lower() == 'pdf':
+                page_texts, images = process_pdf_parallel(doc_id, filepath)
+            else:
+                with metrics.span('extract'):
+                    future = processing_pool.submit(extract_document, filepath, doc_dir)
+                    page_texts, images = future.result()
+                
+                # Photos of notes have no text layer; read them with OCR
+                if get_file_ext(filepath) in IMAGE_EXTENSIONS and ocr_service.available():
+                    with metrics.span('ocr'):
+                        ocr_text = ocr_service.submit([filepath]).result()
+                    if ocr_text:
+                        page_texts = [ocr_text]
             
-            if file_ext == 'pdf':
-                text_content, images = process_pdf(filepath, doc_dir)
-            elif file_ext in ['png', 'jpg', 'jpeg']:
-                text_content, images = process_image(filepath, doc_dir)
-            elif file_ext in ['txt']:
-                with open(filepath, 'r', errors='ignore') as f:
-                    text_content = f.read()
-            elif file_ext in ['doc', 'docx']:
-                # Note: For simplicity, we're not implementing docx processing here
-                # In a production app, you would use a library like python-docx
-                text_content = f"Document processing for {file_ext} files not implemented yet"
+            # Images were written by the pool processes; count them here
+            metrics.bytes_written.inc(sum(get_file_size(img["path"]) for img in images), folder='images')
             
             # Save text content
-            text_file = os.path.join(UPLOAD_FOLDER, 'texts', f"{doc_id}.txt")
-            with open(text_file, 'w', encoding='utf-8') as f:
-                f.write(text_content)
+            with metrics.span('write_text'):
+                text_file = write_text_file(doc_id, page_texts)
+            text_content = "".join(page_texts)
                 
             # Update document data
             doc_data['text_file'] = text_file
+            if doc_id in document_progress:
+                doc_data['page_count'] = document_progress[doc_id]['pages_total']
             doc_data['image_count'] = len(images)
             doc_data['images'] = images
             doc_data['processing_complete'] = True
             doc_data['status'] = 'completed'
             
-            # Save updated document data
+            # Index the text for retrieval and search before the document shows as completed
+            with metrics.span('index_vectors'):
+                index_document_text(doc_id, text_content)
+            with metrics.span('index_search'):
+                index_document_search(doc_id, doc_data, text_content)
+            
+            # Share the results with later uploads of the same file
+            if doc_data.get('content_hash'):
+                if content_cache.register(
+                    doc_data['content_hash'], get_file_ext(filepath), doc_id, get_content_entry(doc_data)
+                ):
+                    doc_data['content_ref'] = True
+                else:
+                    # An identical upload finished first; this copy stays unshared
+                    doc_data.pop('content_hash')
+            
+            # Save updated document data; partial text was served until now
             documents_data[doc_id] = doc_data
-            save_documents_data()
+            release_text_file(doc_id)
                 
             # Update status to completed
-            document_status[doc_id] = "completed"
+            job_journal_db.complete(doc_id)
+            document_status.set(
+                doc_id, "completed", page_count=doc_data.get('page_count'), image_count=len(images)
+            )
+            outcome = "completed"
+            if doc_data.get('page_count'):
+                metrics.document_page_seconds.observe(
+                    (time.time() - started) / doc_data['page_count'], file_type=get_file_ext(filepath)
+                )
             print(f"Document {doc_id} processed successfully")
             
         except Exception as e:
             print(f"Error processing document {doc_id}: {str(e)}")
-            document_status[doc_id] = "error"
+            document_progress.pop(doc_id, None)
+            discard_text_file(doc_id)
+            if isinstance(e, BrokenProcessPool):
+                restart_processing_pool()
+            
+            # Transient failures are retried with backoff; the rest are dead-lettered
+            state, delay = job_journal_db.fail(doc_id, e, is_transient_error(e))
+            outcome = "retrying" if state == 'retrying' else "error"
+            if state == 'retrying':
+                print(f"Retrying document {doc_id} in {delay:.1f}s")
+                document_status.set(doc_id, "retrying", error=str(e), retry_in_seconds=round(delay, 1))
+            else:
+                document_status.set(doc_id, "error", error=str(e))
+                if doc_data:
+                    doc_data['status'] = 'error'
+                    doc_data['error'] = str(e)
+                    documents_data[doc_id] = doc_data
             
         finally:
-            document_queue.task_done()
+            with worker_stats_lock:
+                stats = worker_stats[worker_id]
+                stats["jobs_processed"] += 1
+                stats["busy_seconds"] += time.time() - started
+                stats["current_document"] = None
+                stats["busy_since"] = None
+            if outcome:
+                metrics.document_job_seconds.observe(
+                    time.time() - started, file_type=get_file_ext(doc_data.get('filename', '')), outcome=outcome
+                )
+            metrics.end_trace(outcome=outcome)
+            document_queue.task_done(doc_id)
 
-def save_documents_data():
-    """Save documents data to file"""
-    with open(documents_data_file, 'w') as f:
-        json.dump(documents_data, f, indent=2)
+def count_pdf_pages(filepath):
+    """Get the number of pages in a PDF"""
+    with open(filepath, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
 
-def process_pdf(filepath, doc_dir):
-    """Process a PDF file to extract text and images"""
-    text_content = ""
-    images = []
+def format_page_text(page_number, page_text):
+    """Format a page's text with the page marker used in the text files"""
+    if not page_text:
+        return ""
+    return f"\n--- Page {page_number} ---\n{page_text}\n"
+
+def extract_pdf_pages(filepath, start_page, end_page):
+    """Extract text and images from a range of PDF pages (runs inside the process pool)"""
+    pages = []
     
-    try:
-        # Open the PDF
-        with open(filepath, 'rb') as file:
-            reader = PyPDF2.PdfReader(file)
+    # Open the PDF
+    with open(filepath, 'rb') as file:
+        reader = PyPDF2.PdfReader(file)
+        end_page = min(end_page, len(reader.pages))
+        
+        # Process each page in the range
+        for i in range(start_page, end_page):
+            page = reader.pages[i]
+            page_images = []
             
-            # Process each page
-            for i, page in enumerate(reader.pages):
-                # Extract text
-                page_text = page.extract_text()
-                if page_text:
-                    text_content += f"\n--- Page {i+1} ---\n{page_text}\n"
-                    
-                # Extract images (if available)
-                # Note: This is a simplified approach and may not extract all images
-                if '/XObject' in page['/Resources']:
-                    xobject = page['/Resources']['/XObject']
-                    for obj in xobject:
-                        if xobject[obj]['/Subtype'] == '/Image':
-                            try:
-                                # Save image
-                                img_dir = os.path.join(UPLOAD_FOLDER, 'images')
-                                img_name = f"{uuid.uuid4()}.png"
-                                img_path = os.path.join(img_dir, img_name)
+            # Extract text
+            page_text = page.extract_text()
+                
+            # Extract images (if available)
+            # Note: This is a simplified approach and may not extract all images
+            resources = page.get('/Resources') or {}
+            if '/XObject' in resources:
+                xobject = resources['/XObject'].get_object()
+                for obj in xobject:
+                    if xobject[obj]['/Subtype'] == '/Image':
+                        try:
+                            # Save image under its real format
+                            ext, data = image_pipeline.pdf_image_to_file(xobject[obj])
+                            img_dir = os.path.join(UPLOAD_FOLDER, 'images')
+                            img_name = f"{uuid.uuid4()}.{ext}"
+                            img_path = os.path.join(img_dir, img_name)
+                            
+                            with open(img_path, 'wb') as img_file:
+                                img_file.write(data)
                                 
-                                # This is a simplified approach
-                                # In production, you'd need more robust PDF image extraction
-                                with open(img_path, 'wb') as img_file:
-                                    img_file.write(xobject[obj].getData())
-                                    
-                                images.append({
-                                    'path': img_path,
-                                    'page': i+1,
-                                    'filename': img_name
-                                })
-                            except Exception as e:
-                                print(f"Error extracting image: {str(e)}")
-        
+                            page_images.append({
+                                'path': img_path,
+                                'page': i+1,
+                                'filename': img_name
+                            })
+                        except Exception as e:
+                            print(f"Error extracting image: {str(e)}")
+            
+            pages.append((i+1, format_page_text(i+1, page_text), page_images))
+    
+    return pages
+
+def has_text_layer(page_number, page_text):
+    """Whether a page's extracted text is more than a few stray characters"""
+    return len(page_text.replace(f"--- Page {page_number} ---", "").strip()) >= OCR_MIN_PAGE_CHARS
+
+def process_pdf(filepath, doc_dir):
+    """Process a PDF file to extract text and images"""
+    try:
+        pages = extract_pdf_pages(filepath, 0, count_pdf_pages(filepath))
+        text_content = "".join(page_text for _, page_text, _ in pages)
+        images = [img for _, _, page_images in pages for img in page_images]
         return text_content, images
     except Exception as e:
         print(f"Error processing PDF: {str(e)}")
         return f"Error processing PDF: {str(e)}", []
 
+def process_pdf_parallel(doc_id, filepath):
+    """Extract a PDF in page ranges across the process pool, writing pages as they finish"""
+    pages_total = count_pdf_pages(filepath)
+    document_progress[doc_id] = {"pages_done": 0, "pages_total": pages_total}
+    writer = open_text_file(doc_id)
+    
+    # Fan page ranges out to the pool
+    futures = [
+        processing_pool.submit(extract_pdf_pages, filepath, start, start + PDF_PAGES_PER_CHUNK)
+        for start in range(0, pages_total, PDF_PAGES_PER_CHUNK)
+    ]
+    
+    page_texts = [""] * pages_total
+    page_images = [[] for _ in range(pages_total)]
+    ocr_futures = {}
+    use_ocr = ocr_service.available()
+    with metrics.span('extract'):
+        for future in as_completed(futures):
+            for page_number, page_text, images in future.result():
+                page_texts[page_number - 1] = page_text
+                page_images[page_number - 1] = images
+                
+                # Scanned pages carry only an image: OCR them on the separate pool
+                if use_ocr and images and not has_text_layer(page_number, page_text):
+                    ocr_futures[ocr_service.submit(img["path"] for img in images)] = page_number
+                    continue
+                append_page(doc_id, writer, page_number, page_text)
+    
+    with metrics.span('ocr'):
+        for future in as_completed(ocr_futures):
+            page_number = ocr_futures[future]
+            ocr_text = future.result()
+            if ocr_text:
+                page_texts[page_number - 1] = format_page_text(page_number, ocr_text)
+            append_page(doc_id, writer, page_number, page_texts[page_number - 1])
+    
+    images = [img for images in page_images for img in images]
+    return page_texts, images
+
+def get_text_path(doc_id):
+    """Get the path of a document's compressed text file"""
+    return os.path.join(UPLOAD_FOLDER, 'texts', f"{doc_id}{text_store.TEXT_STORE_EXT}")
+
+def open_text_file(doc_id):
+    """Start a document's text file; pages are appended as extraction finishes them"""
+    writer = text_writers.get(doc_id)
+    if writer is None:
+        writer = text_writers[doc_id] = text_store.TextStoreWriter(get_text_path(doc_id))
+    return writer
+
+def append_page(doc_id, writer, page_number, page_text):
+    """Append a finished page so partial text can be served right away"""
+    writer.add_page(page_number, page_text)
+    document_progress[doc_id]["pages_done"] += 1
+
+def write_text_file(doc_id, page_texts):
+    """Finish a document's text file with the pages not appended yet, and write its page index.
+
+    The writer keeps serving partial text until release_text_file(), once the completed record is saved.
+    """
+    writer = open_text_file(doc_id)
+    appended = set(writer.page_numbers())
+    for page_number, page_text in enumerate(page_texts, 1):
+        if page_number not in appended:
+            writer.add_page(page_number, page_text)
+    metrics.bytes_written.inc(writer.close(), folder='texts')
+    return writer.path
+
+def release_text_file(doc_id):
+    """Stop serving a document's partial text; its record now points at the finished file"""
+    text_writers.pop(doc_id, None)
+    document_progress.pop(doc_id, None)
+
+def discard_text_file(doc_id):
+    """Drop the half-written text file of a document whose processing failed"""
+    writer = text_writers.pop(doc_id, None)
+    if writer is not None:
+        writer.discard()
+
+def read_text_page(text_file, page_number):
+    """Read one page of a text file; returns (text, pages_total), text is None if out of range"""
+    text = text_store.open_text(text_file)
+    return text.read_page(page_number), text.page_count
+
+def read_text_range(text_file, offset, limit):
+    """Read up to limit bytes of a text file from offset without splitting a UTF-8 character"""
+    data = text_store.open_text(text_file).read_range(offset, limit)
+    
+    # Back off to the last complete character; the client continues from next_offset
+    text_content, used = text_store.decode_text(data)
+    return text_content, offset + used
+
+def get_partial_text(doc_id):
+    """Get the text of the pages finished so far, in page order"""
+    writer = text_writers.get(doc_id)
+    if writer is None:
+        return None, []
+    
+    page_numbers = writer.page_numbers()
+    return "".join(writer.read_page(page_number) or "" for page_number in page_numbers), page_numbers
+
 def process_image(filepath, doc_dir):
     """Process an image file to save it and potentially extract text"""
     try:
-        # Create a copy in the images directory
+        # Create a copy in the images directory, re-encoding only if it isn't already compressed
         img_dir = os.path.join(UPLOAD_FOLDER, 'images')
-        img_name = f"{uuid.uuid4()}.png"
+        img_name = image_pipeline.store_image_file(filepath, img_dir, str(uuid.uuid4()))
         img_path = os.path.join(img_dir, img_name)
-        
-        # Open and save the image
-        with Image.open(filepath) as img:
-            img.save(img_path)
             
-        # In a production app, you would use OCR to extract text from the image
-        # For now, we'll just return a placeholder
+        # Placeholder text; the worker replaces it with OCR output when an engine is installed
         text_content = f"[Image file: {os.path.basename(filepath)}]"
         
         images = [{
@@ -195,85 +666,469 @@ def process_image(filepath, doc_dir):
         print(f"Error processing image: {str(e)}")
         return f"Error processing image: {str(e)}", []
 
-def handle_document_upload(file, form_data, ngrok_url):
-    """Handle document upload and add to processing queue"""
+def handle_document_upload(stream, content_type, ngrok_url):
+    """Stream a multipart upload to disk and add it to the processing queue"""
+    upload = {}
+    charged = None
+    
+    def open_sink(filename, fields):
+        # Fields sent before the file already tell whose quota to charge
+        upload["doc_id"], upload["filename"], upload["filepath"] = prepare_upload_path(filename)
+        return upload_ingest.UploadSink(upload["filepath"], storage_quota, fields.get('user_id', ''))
+    
+    def discard_upload():
+        # A stored record holds the quota charge (and any shared content), and deleting it gives them back
+        if upload and documents_data.get(upload["doc_id"]):
+            document_status.remove(upload["doc_id"])
+            delete_document_data(upload["doc_id"])
+            return
+        if charged:
+            storage_quota.release(*charged)
+        if upload:
+            shutil.rmtree(os.path.dirname(upload["filepath"]), ignore_errors=True)
+    
     try:
-        # Check if file is valid
-        if file.filename == '':
-            return {"error": "No file selected"}, 400
-            
-        if not allowed_file(file.filename):
-            return {
-                "error": f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
-            }, 400
-            
-        # Generate a unique document ID
-        doc_id = str(uuid.uuid4())
-        
-        # Create document directory
-        doc_dir = os.path.join(UPLOAD_FOLDER, doc_id)
-        os.makedirs(doc_dir, exist_ok=True)
-        
-        # Save file
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(doc_dir, filename)
-        file.save(filepath)
-        
-        # Get metadata from request
-        metadata = {
-            "title": form_data.get('title', filename),
-            "description": form_data.get('description', ''),
-            "category": form_data.get('category', ''),
-            "tags": form_data.get('tags', ''),
-            "user_id": form_data.get('user_id', ''),
-            "upload_date": time.strftime("%Y-%m-%d %H:%M:%S"),
-        }
+        with metrics.span('upload'):
+            fields, sink = upload_ingest.stream_multipart_upload(stream, content_type, open_sink, UPLOAD_CHUNK_SIZE)
+        if sink is None:
+            return {"error": "No file provided"}, 400
         
-        # Store document data
-        documents_data[doc_id] = {
-            "doc_id": doc_id,
-            "filepath": filepath,
-            "filename": filename,
-            "metadata": metadata,
-            "processing_complete": False,
-            "status": "queued"
-        }
+        try:
+            content_hash, size = sink.close()
+            # A user_id sent after the file moves the bytes to that user's quota
+            user_id = fields.get('user_id', '')
+            if user_id != sink.user_id:
+                storage_quota.reserve(user_id, size)
+                storage_quota.release(sink.user_id, size)
+        except Exception:
+            sink.discard()
+            raise
+        charged = (user_id, size)
         
-        # Save document data to file
-        save_documents_data()
-            
-        # Set initial status
-        document_status[doc_id] = "queued"
+        return register_upload(
+            upload["doc_id"], upload["filename"], upload["filepath"],
+            content_hash, size, get_upload_fields(fields), ngrok_url
+        )
+        
+    except UploadRejected as e:
+        discard_upload()
+        return e.to_response()
+    except Exception as e:
+        discard_upload()
+        print(f"Error processing document upload: {str(e)}")
+        return {"error": str(e)}, 500
+
+def handle_bulk_upload(stream, content_type, args, ngrok_url):
+    """Stream many documents to disk (a multi-file form, ZIP archives in it, or a raw ZIP body) and queue them as one batch"""
+    uploads = {}
+    archives = {}
+    finished = set()
+    documents = []
+    rejected = []
+    user_id = ''
+    registered = False
+    
+    def open_document_sink(filename, user_id):
+        doc_id, safe_name, filepath = prepare_upload_path(filename)
+        sink = upload_ingest.UploadSink(filepath, storage_quota, user_id)
+        uploads[sink] = (doc_id, safe_name, filepath)
+        return sink
+    
+    def open_sink(filename, fields):
+        # An archive's index is at its end, so archives are received whole and extracted afterwards
+        if get_file_ext(filename) == 'zip':
+            sink = upload_ingest.UploadSink(
+                upload_batches.archive_path(), archive_quota, '', max_bytes=upload_ingest.BULK_UPLOAD_MAX_BYTES
+            )
+            archives[sink] = filename
+            return sink
+        return open_document_sink(filename, fields.get('user_id', ''))
+    
+    def finish_document(sink, user_id):
+        doc_id, filename, filepath = uploads[sink]
+        finished.add(sink)
+        try:
+            content_hash, size = sink.close()
+            # A user_id sent after the file moves the bytes to that user's quota
+            if user_id != sink.user_id:
+                storage_quota.reserve(user_id, size)
+                storage_quota.release(sink.user_id, size)
+        except UploadRejected as e:
+            sink.discard()
+            shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
+            rejected.append((filename, e))
+            return
+        documents.append((doc_id, filename, filepath, content_hash, size))
+    
+    try:
+        fields = dict(args)
+        with metrics.span('upload'):
+            if parse_options_header(content_type or '')[0] in ARCHIVE_MIMETYPES:
+                received = [open_sink('upload.zip', fields)]
+                upload_ingest.copy_stream(stream, received[0], UPLOAD_CHUNK_SIZE)
+            else:
+                form_fields, received, refused = upload_ingest.stream_multipart_files(
+                    stream, content_type, open_sink, UPLOAD_CHUNK_SIZE
+                )
+                fields.update(form_fields)
+                rejected.extend(refused)
+        
+        # Expand archives in place; their members count towards the same file limit
+        user_id = fields.get('user_id', '')
+        budget = upload_ingest.BULK_MAX_FILES - len(rejected) - sum(1 for sink in received if sink not in archives)
+        expanded_budget = upload_ingest.ARCHIVE_EXPANDED_MAX_BYTES
+        for sink in received:
+            if sink not in archives:
+                finish_document(sink, user_id)
+                continue
+            try:
+                sink.close()
+                with metrics.span('extract_archive'):
+                    members, refused = upload_ingest.extract_archive(
+                        sink.filepath, lambda filename: open_document_sink(filename, user_id),
+                        UPLOAD_CHUNK_SIZE, max_files=max(0, budget), max_expanded=max(0, expanded_budget)
+                    )
+            except UploadRejected as e:
+                rejected.append((archives[sink], e))
+                continue
+            finally:
+                sink.discard()
+            budget -= len(members) + len(refused)
+            expanded_budget -= sum(member.size for member in members)
+            rejected.extend(refused)
+            for member in members:
+                finish_document(member, user_id)
+        
+        # Files refused while they were being written leave an empty document folder
+        for sink, (doc_id, filename, filepath) in uploads.items():
+            if sink not in finished:
+                shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
+        
+        rejected_files = [
+            {"filename": filename, "error": str(e), "status_code": e.status_code} for filename, e in rejected
+        ]
+        if not documents:
+            if not rejected_files:
+                return {"error": "No files provided"}, 400
+            return {"error": "None of the files could be accepted", "rejected": rejected_files}, 400
         
-        # Add to processing queue
-        document_queue.put(doc_id)
+        # Every file gets the batch's shared metadata, and its own name as its title
+        batch_id = str(uuid.uuid4())
+        upload_fields = dict(get_upload_fields(fields), title='')
+        docs = [
+            new_document_data(doc_id, filename, filepath, content_hash, size, upload_fields, batch_id)
+            for doc_id, filename, filepath, content_hash, size in documents
+        ]
         
-        # Create status URL
-        status_url = f"{ngrok_url}/document_status/{doc_id}"
+        # One metadata write and one queue insert for the whole batch
+        documents_data.put_many({doc["doc_id"]: doc for doc in docs})
+        registered = True
+        for doc in docs:
+            if doc["processing_complete"]:
+                # Linked to an identical file, so its own bytes are not kept
+                storage_quota.release(user_id, doc["size"])
+        upload_batches.create(
+            batch_id, user_id, [doc["doc_id"] for doc in docs], rejected_files,
+            {key: upload_fields[key] for key in ('description', 'category', 'tags')}
+        )
+        queued = []
+        for doc in docs:
+            if doc["processing_complete"]:
+                publish_duplicate(doc)
+            else:
+                document_status.set(doc["doc_id"], "queued", user_id=user_id)
+                queued.append(doc)
+        enqueue_documents(queued)
         
         return {
             "success": True,
-            "message": "Document received and queued for processing",
+            "message": f"{len(docs)} documents received, {len(queued)} queued for processing",
+            "batch_id": batch_id,
+            "status_url": f"{ngrok_url}/batches/{batch_id}",
+            "documents": [
+                {
+                    "document_id": doc["doc_id"],
+                    "filename": doc["filename"],
+                    "status": doc["status"],
+                    "status_url": f"{ngrok_url}/document_status/{doc['doc_id']}"
+                }
+                for doc in docs
+            ],
+            "rejected": rejected_files,
+        }, 200
+        
+    except Exception as e:
+        # Nothing of a failed batch is kept
+        if not registered:
+            for doc_id, filename, filepath, content_hash, size in documents:
+                storage_quota.release(user_id, size)
+            for sink, (doc_id, filename, filepath) in uploads.items():
+                if sink not in finished:
+                    sink.discard()
+                shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
+        for sink in archives:
+            sink.discard()
+        if isinstance(e, UploadRejected):
+            return e.to_response()
+        print(f"Error processing bulk upload: {str(e)}")
+        return {"error": str(e)}, 500
+
+def estimate_job(doc_data):
+    """Get the (priority class, cost) of processing a document from its size and page count"""
+    size = doc_data.get("size", 0)
+    ext = get_file_ext(doc_data.get("filename", ""))
+    pages = doc_data.get("page_count") or 0
+    if ext == 'pdf' and not pages:
+        try:
+            pages = count_pdf_pages(doc_data["filepath"])
+        except Exception:
+            pages = 0
+    
+    # Roughly one unit of work per page or megabyte
+    cost = 1.0 + pages + size / (1024 * 1024)
+    
+    if ext in IMAGE_EXTENSIONS or (size <= SMALL_FILE_BYTES and pages <= SMALL_FILE_PAGES):
+        priority = job_scheduler.PRIORITY_INTERACTIVE
+    elif size > BULK_FILE_BYTES or pages > BULK_FILE_PAGES:
+        priority = job_scheduler.PRIORITY_BULK
+    else:
+        priority = job_scheduler.PRIORITY_NORMAL
+    return priority, cost
+
+def enqueue_document(doc_id, doc_data):
+    """Journal a document's job and queue it under its user's fair share"""
+    priority, cost = estimate_job(doc_data)
+    user_id = doc_data.get("metadata", {}).get("user_id", "")
+    job_journal_db.enqueue(doc_id, user_id, priority, cost)
+    return document_queue.put(doc_id, user_id=user_id, priority=priority, cost=cost)
+
+def enqueue_documents(docs):
+    """Journal and queue a group of documents together"""
+    jobs = []
+    for doc_data in docs:
+        priority, cost = estimate_job(doc_data)
+        jobs.append((doc_data["doc_id"], doc_data.get("metadata", {}).get("user_id", ""), priority, cost))
+    if jobs:
+        job_journal_db.enqueue_many(jobs)
+        document_queue.put_many(jobs)
+
+def schedule_job(job):
+    """Put a journaled job back on the in-memory queue"""
+    document_status.set(job["doc_id"], "queued", user_id=job["user_id"])
+    return document_queue.put(
+        job["doc_id"],
+        user_id=job["user_id"],
+        priority=job["priority"],
+        cost=job["cost"],
+        enqueued_at=job["enqueued_at"]
+    )
+
+def schedule_or_fail_job(job):
+    """Queue a job the journal handed back, or mark its document failed if the journal dead-lettered it"""
+    if job["state"] != 'dead':
+        return schedule_job(job)
+    print(f"Document {job['doc_id']} failed after {job['attempts']} attempts: {job['last_error']}")
+    document_status.set(job["doc_id"], "error", error=job["last_error"])
+    doc_data = documents_data.get(job["doc_id"])
+    if doc_data:
+        doc_data['status'] = 'error'
+        doc_data['error'] = job["last_error"]
+        documents_data[job["doc_id"]] = doc_data
+    return False
+
+def is_transient_error(error):
+    """Tell failures worth retrying (a crashed pool process, I/O trouble, a busy database) from bad input"""
+    if isinstance(error, (FileNotFoundError, IsADirectoryError, PermissionError)):
+        return False
+    return isinstance(error, (BrokenProcessPool, OSError, TimeoutError, MemoryError, sqlite3.OperationalError))
+
+def new_document_data(doc_id, filename, filepath, content_hash, size, fields, batch_id=None):
+    """Build the record of a fully received upload, linked to an identical processed file if there is one"""
+    doc_dir = os.path.dirname(filepath)
+    
+    # Get metadata from request
+    metadata = {
+        "title": fields.get('title') or filename,
+        "description": fields.get('description', ''),
+        "category": fields.get('category', ''),
+        "tags": fields.get('tags', ''),
+        "user_id": fields.get('user_id', ''),
+        "upload_date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    
+    doc_data = {
+        "doc_id": doc_id,
+        "filepath": filepath,
+        "filename": filename,
+        "metadata": metadata,
+        "size": size,
+        "content_hash": content_hash,
+        "content_ref": False,
+        "processing_complete": False,
+        "status": "queued"
+    }
+    if batch_id:
+        doc_data["batch_id"] = batch_id
+    
+    # Link to the results of an identical file that was already processed
+    cached = content_cache.acquire(content_hash, get_file_ext(filename))
+    if cached:
+        shutil.rmtree(doc_dir, ignore_errors=True)
+        doc_data.update({
+            "filepath": cached["filepath"],
+            "text_file": cached["text_file"],
+            "images": cached["images"],
+            "image_count": cached["image_count"],
+            "deduplicated_from": cached["doc_id"],
+            "content_ref": True,
+            "processing_complete": True,
+            "status": "completed"
+        })
+        if cached.get("page_count") is not None:
+            doc_data["page_count"] = cached["page_count"]
+    return doc_data
+
+def publish_duplicate(doc_data):
+    """Mark a document linked to an identical file as completed and index it"""
+    doc_id = doc_data["doc_id"]
+    document_status.set(
+        doc_id, "completed", user_id=doc_data["metadata"]["user_id"], page_count=doc_data.get("page_count")
+    )
+    
+    # Index the copy in the background; the extracted text is already there
+    Thread(target=index_duplicate_document, args=(doc_id, doc_data, doc_data["deduplicated_from"]), daemon=True).start()
+
+def register_upload(doc_id, filename, filepath, content_hash, size, fields, ngrok_url):
+    """Record a fully received upload and queue it, or link it to an identical processed file"""
+    doc_data = new_document_data(doc_id, filename, filepath, content_hash, size, fields)
+    if doc_data["processing_complete"]:
+        documents_data[doc_id] = doc_data
+        # The upload's own bytes were dropped in favour of the identical file
+        storage_quota.release(doc_data["metadata"]["user_id"], size)
+        publish_duplicate(doc_data)
+        
+        return {
+            "success": True,
+            "message": "Document already processed",
             "document_id": doc_id,
-            "status_url": status_url
+            "status_url": f"{ngrok_url}/document_status/{doc_id}"
         }, 200
+    
+    # Store document data
+    documents_data[doc_id] = doc_data
+    
+    # Set initial status
+    document_status.set(doc_id, "queued", user_id=doc_data["metadata"]["user_id"])
+    
+    # Add to processing queue
+    enqueue_document(doc_id, doc_data)
+    
+    # Create status URL
+    status_url = f"{ngrok_url}/document_status/{doc_id}"
+    
+    return {
+        "success": True,
+        "message": "Document received and queued for processing",
+        "document_id": doc_id,
+        "status_url": status_url
+    }, 200
+
+def get_upload_progress(session, offset):
+    """Describe how far a resumable upload has got"""
+    return {
+        "upload_id": session["upload_id"],
+        "offset": offset,
+        "size": session["total_size"],
+        "complete": offset == session["total_size"],
+    }
+
+def create_upload_session_data(data, ngrok_url):
+    """Start a resumable upload; the file is then sent in chunks and committed"""
+    try:
+        try:
+            total_size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return {"error": "Missing or invalid file size"}, 400
+        if total_size < 0:
+            return {"error": "Missing or invalid file size"}, 400
         
+        doc_id, filename, filepath = prepare_upload_path(data.get('filename', ''))
+        try:
+            session = resumable_uploads.create(doc_id, filepath, filename, total_size, get_upload_fields(data))
+        except Exception:
+            shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
+            raise
+        
+        return dict(
+            get_upload_progress(session, 0),
+            chunk_size=upload_ingest.RESUMABLE_CHUNK_BYTES,
+            upload_url=f"{ngrok_url}/uploads/{session['upload_id']}"
+        ), 201
+        
+    except UploadRejected as e:
+        return e.to_response()
     except Exception as e:
-        print(f"Error processing document upload: {str(e)}")
+        print(f"Error creating upload: {str(e)}")
         return {"error": str(e)}, 500
 
+def get_upload_session_data(upload_id):
+    """Get the offset a resumable upload should continue from"""
+    session, offset = resumable_uploads.get(upload_id)
+    if session is None:
+        return {"error": "Upload not found"}, 404
+    return get_upload_progress(session, offset), 200
+
+def append_upload_data(upload_id, offset, stream):
+    """Write one chunk of a resumable upload at the given offset"""
+    try:
+        try:
+            offset = int(offset)
+        except (TypeError, ValueError):
+            return {"error": "Missing or invalid offset"}, 400
+        
+        new_offset = resumable_uploads.append(upload_id, offset, stream, UPLOAD_CHUNK_SIZE)
+        session, _ = resumable_uploads.get(upload_id)
+        return get_upload_progress(session, new_offset), 200
+        
+    except UploadRejected as e:
+        return e.to_response()
+    except Exception as e:
+        print(f"Error appending to upload {upload_id}: {str(e)}")
+        return {"error": str(e)}, 500
+
+def commit_upload_data(upload_id, expected_sha256, ngrok_url):
+    """Finish a resumable upload and queue the document"""
+    try:
+        session, content_hash, size = resumable_uploads.finish(upload_id, expected_sha256)
+        return register_upload(
+            session["doc_id"], session["filename"], session["filepath"],
+            content_hash, size, session["fields"], ngrok_url
+        )
+        
+    except UploadRejected as e:
+        return e.to_response()
+    except Exception as e:
+        print(f"Error committing upload {upload_id}: {str(e)}")
+        return {"error": str(e)}, 500
+
+def abort_upload_data(upload_id):
+    """Cancel a resumable upload and delete what was received"""
+    try:
+        resumable_uploads.abort(upload_id)
+        return {"success": True, "upload_id": upload_id}, 200
+    except UploadRejected as e:
+        return e.to_response()
+
 def get_document_status_data(doc_id):
     """Get status information for a document"""
     try:
-        # Check if document exists
-        if doc_id not in documents_data:
-            return {"error": "Document not found"}, 404
-            
         # Get document data
-        doc_data = documents_data[doc_id]
+        doc_data = documents_data.get(doc_id)
+        if not doc_data:
+            return {"error": "Document not found"}, 404
         
-        # Get status
-        status = document_status.get(doc_id, "unknown")
+        # Get status (documents not touched since the last restart keep their stored one)
+        status = document_status.get(doc_id) or doc_data.get("status", "unknown")
         
         # Return status and basic metadata
         result = {
@@ -282,6 +1137,35 @@ def get_document_status_data(doc_id):
             "filename": doc_data.get("filename", ""),
             "metadata": doc_data.get("metadata", {}),
         }
+        if doc_data.get("batch_id"):
+            result["batch_id"] = doc_data["batch_id"]
+        
+        # Report where a queued document stands
+        queued = document_queue.position(doc_id)
+        if queued:
+            position, waited, priority = queued
+            result["queue_position"] = position
+            result["queue_depth"] = document_queue.qsize()
+            result["queued_seconds"] = waited
+            result["priority"] = priority
+            result["estimated_wait_seconds"] = estimate_queue_wait(position)
+        
+        # Explain failed and retried jobs
+        if status in ("error", "retrying"):
+            job = job_journal_db.get(doc_id)
+            if job:
+                result["attempts"] = job["attempts"]
+                result["last_error"] = job["last_error"]
+                if job["next_attempt_at"]:
+                    result["retry_in_seconds"] = round(max(0.0, job["next_attempt_at"] - time.time()), 1)
+        
+        # Report page progress for PDFs
+        progress = document_progress.get(doc_id)
+        if progress:
+            result["pages_done"] = progress["pages_done"]
+            result["pages_total"] = progress["pages_total"]
+        elif "page_count" in doc_data:
+            result["pages_done"] = result["pages_total"] = doc_data["page_count"]
         
         # If processing is complete, add more data
         if doc_data.get("processing_complete", False):
@@ -297,15 +1181,177 @@ def get_document_status_data(doc_id):
         print(f"Error getting document status: {str(e)}")
         return {"error": str(e)}, 500
 
-def get_document_text_data(doc_id):
-    """Get extracted text for a document"""
+def get_status_filter(args):
+    """Read the doc_ids (a list or comma separated), batch_id and/or user_id a status query is about"""
+    doc_ids = args.get('doc_ids') or []
+    if isinstance(doc_ids, str):
+        doc_ids = doc_ids.split(',')
+    if not isinstance(doc_ids, list):
+        raise ValueError("doc_ids must be a list")
+    doc_ids = list(dict.fromkeys(str(doc_id).strip() for doc_id in doc_ids if str(doc_id).strip()))
+    user_id = args.get('user_id')
+    if len(doc_ids) > STATUS_BATCH_MAX:
+        raise ValueError(f"At most {STATUS_BATCH_MAX} doc_ids per request")
+    
+    # A bulk upload's documents (bounded by the upload's file limit)
+    batch_id = args.get('batch_id')
+    if batch_id:
+        batch = upload_batches.get(batch_id)
+        if batch is None:
+            raise ValueError("Unknown batch_id")
+        doc_ids = list(dict.fromkeys(doc_ids + batch["doc_ids"]))
+    
+    if not doc_ids and user_id is None:
+        raise ValueError("Give doc_ids, batch_id and/or user_id")
+    return doc_ids, user_id
+
+def collect_statuses(doc_ids, user_id=None):
+    """Get (entries by doc_id, missing doc_ids, cursor) from the status index"""
+    # Before startup has indexed everything, a user's documents come from the store
+    if user_id is not None and not document_status.seeded:
+        doc_ids = doc_ids + [doc["doc_id"] for doc in documents_data.query(user_id=user_id)]
+    
+    documents, cursor = document_status.snapshot(doc_ids, user_id)
+    missing = []
+    for doc_id in doc_ids:
+        if doc_id in documents:
+            continue
+        doc_data = documents_data.get(doc_id)
+        if doc_data:
+            documents[doc_id] = document_status.add_stored(doc_data)
+        else:
+            missing.append(doc_id)
+    
+    # Page progress of documents being extracted
+    for doc_id, entry in documents.items():
+        progress = document_progress.get(doc_id)
+        if progress:
+            entry["pages_done"] = progress["pages_done"]
+            entry["pages_total"] = progress["pages_total"]
+    return documents, missing, cursor
+
+def get_document_statuses_data(args):
+    """Get the status of many documents at once from the in-memory index, with a cursor for waiting on changes"""
+    try:
+        doc_ids, user_id = get_status_filter(args)
+        documents, missing, cursor = collect_statuses(doc_ids, user_id)
+        return {"documents": documents, "missing": missing, "cursor": cursor}, 200
+        
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        print(f"Error getting document statuses: {str(e)}")
+        return {"error": str(e)}, 500
+
+def get_batch_data(batch_id):
+    """Get the progress of a bulk upload: its documents' statuses added up, and the files it refused"""
+    try:
+        batch = upload_batches.get(batch_id)
+        if batch is None:
+            return {"error": "Batch not found"}, 404
+        
+        documents, missing, cursor = collect_statuses(batch["doc_ids"])
+        
+        # Deleted documents no longer count as outstanding work
+        counts = {}
+        for entry in documents.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        if missing:
+            counts["deleted"] = counts.get("deleted", 0) + len(missing)
+        total = len(batch["doc_ids"])
+        finished = counts.get("completed", 0) + counts.get("error", 0) + counts.get("deleted", 0)
+        
+        return {
+            "batch_id": batch_id,
+            "user_id": batch["user_id"],
+            "created_at": batch["created_at"],
+            "total": total,
+            "completed": counts.get("completed", 0),
+            "failed": counts.get("error", 0),
+            "pending": total - finished,
+            "by_status": counts,
+            "progress": round(finished / total, 4) if total else 1.0,
+            "done": finished == total,
+            "documents": documents,
+            "rejected": batch["rejected"],
+            "cursor": cursor,
+        }, 200
+        
+    except Exception as e:
+        print(f"Error getting batch {batch_id}: {str(e)}")
+        return {"error": str(e)}, 500
+
+def parse_status_wait(args, cursor=None):
+    """Read (cursor, timeout) of a status wait; without a cursor the client starts from a snapshot"""
+    cursor = args.get('cursor', cursor)
+    timeout = min(max(0.0, float(args.get('timeout', 30))), STATUS_WAIT_MAX_SECONDS)
+    return (None if cursor in (None, '') else int(cursor)), timeout
+
+def wait_document_events_data(args):
+    """Long-poll: answer with the status changes after cursor as soon as there are any (or at the timeout)"""
+    try:
+        doc_ids, user_id = get_status_filter(args)
+        cursor, timeout = parse_status_wait(args)
+        
+        # No cursor yet: hand out the current statuses and the cursor to wait from
+        if cursor is None:
+            return get_document_statuses_data(args)
+        
+        events, cursor, resync = document_status.wait(cursor, timeout, doc_ids, user_id)
+        result = {"events": events, "cursor": cursor}
+        if resync:
+            result["resync"] = True
+        return result, 200
+        
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        print(f"Error waiting for document events: {str(e)}")
+        return {"error": str(e)}, 500
+
+def estimate_queue_wait(position):
+    """Estimate how long a queued document waits, from the average job time so far"""
+    with worker_stats_lock:
+        jobs = sum(stats["jobs_processed"] for stats in worker_stats.values())
+        busy = sum(stats["busy_seconds"] for stats in worker_stats.values())
+        workers = max(1, len(worker_stats))
+    if not jobs:
+        return None
+    return round(busy / jobs * position / workers, 1)
+
+def get_document_text_path(doc_id):
+    """Get the text file of a processed document, or an error response"""
+    doc_data = documents_data.get(doc_id)
+    if not doc_data:
+        return None, ({"error": "Document not found"}, 404)
+    if not doc_data.get("processing_complete", False) or "text_file" not in doc_data:
+        return None, ({
+            "error": "Text not available yet. Document processing may still be in progress."
+        }, 400)
+    return doc_data["text_file"], None
+
+def get_document_text_data(doc_id, args=None):
+    """Get extracted text for a document, optionally one page (page=) or a byte range (offset=, limit=)"""
     try:
-        # Check if document exists
-        if doc_id not in documents_data:
-            return {"error": "Document not found"}, 404
-            
         # Get document data
-        doc_data = documents_data[doc_id]
+        doc_data = documents_data.get(doc_id)
+        if not doc_data:
+            return {"error": "Document not found"}, 404
+        
+        # Serve the pages finished so far while a PDF is still being processed
+        if not doc_data.get("processing_complete", False) and doc_id in document_progress:
+            text_content, page_numbers = get_partial_text(doc_id)
+            if text_content is not None:
+                progress = document_progress.get(doc_id, {})
+                return {
+                    "document_id": doc_id,
+                    "filename": doc_data.get("filename", ""),
+                    "text_content": text_content,
+                    "partial": True,
+                    "pages_available": page_numbers,
+                    "pages_done": progress.get("pages_done", len(page_numbers)),
+                    "pages_total": progress.get("pages_total", 0)
+                }, 200
         
         # Check if text is available
         if not doc_data.get("processing_complete", False) or "text_file" not in doc_data:
@@ -313,10 +1359,40 @@ def get_document_text_data(doc_id):
                 "error": "Text not available yet. Document processing may still be in progress."
             }, 400
             
-        # Get text content
         text_file = doc_data["text_file"]
-        with open(text_file, 'r', encoding='utf-8') as f:
-            text_content = f.read()
+        args = args or {}
+        
+        # Paged reads seek straight to the requested page
+        if args.get('page'):
+            page_number = int(args['page'])
+            text_content, pages_total = read_text_page(text_file, page_number)
+            if text_content is None:
+                return {"error": f"Page {page_number} not found", "pages_total": pages_total}, 404
+            return {
+                "document_id": doc_id,
+                "filename": doc_data.get("filename", ""),
+                "page": page_number,
+                "pages_total": pages_total,
+                "text_content": text_content
+            }, 200
+        
+        # Byte-range reads for clients fetching the text in pieces
+        if args.get('offset') or args.get('limit'):
+            offset = max(0, int(args.get('offset', 0)))
+            limit = min(max(1, int(args.get('limit', TEXT_RANGE_MAX_BYTES))), TEXT_RANGE_MAX_BYTES)
+            total_bytes = text_store.open_text(text_file).total_bytes
+            text_content, next_offset = read_text_range(text_file, offset, limit)
+            return {
+                "document_id": doc_id,
+                "filename": doc_data.get("filename", ""),
+                "offset": offset,
+                "next_offset": next_offset if next_offset < total_bytes else None,
+                "total_bytes": total_bytes,
+                "text_content": text_content
+            }, 200
+        
+        # Get text content
+        text_content = text_store.open_text(text_file).read_text()
             
         return {
             "document_id": doc_id,
@@ -324,21 +1400,326 @@ def get_document_text_data(doc_id):
             "text_content": text_content
         }, 200
         
+    except ValueError as e:
+        return {"error": f"Invalid page, offset or limit: {str(e)}"}, 400
     except Exception as e:
         print(f"Error getting document text: {str(e)}")
         return {"error": str(e)}, 500
 
+def holds_content_ref(doc_data):
+    """Whether a document holds a reference on shared content (failed and unfinished ones never took one)"""
+    if "content_ref" in doc_data:
+        return doc_data["content_ref"]
+    # Records from before the flag: a completed document kept its hash only if it registered or linked it
+    return bool(doc_data.get("content_hash")) and doc_data.get("processing_complete", False)
+
+def delete_document_data(doc_id):
+    """Delete a document, removing its files once no other document shares them"""
+    try:
+        doc_data = documents_data.get(doc_id)
+        if not doc_data:
+            return {"error": "Document not found"}, 404
+        
+        if document_status.get(doc_id) in ("queued", "processing"):
+            return {"error": "Document is still being processed"}, 409
+        
+        # Shared content is only removed with its last reference
+        remove_files = True
+        if holds_content_ref(doc_data):
+            remaining = content_cache.release(doc_data["content_hash"], get_file_ext(doc_data["filename"]))
+            remove_files = remaining == 0
+        
+        documents_data.delete(doc_id)
+        document_status.remove(doc_id)
+        job_journal_db.remove(doc_id)
+        storage_quota.release(doc_data.get("metadata", {}).get("user_id", ""), get_charged_size(doc_data))
+        vector_index.remove_document(doc_id)
+        search_index.remove_document(doc_id)
+        
+        if remove_files:
+            shutil.rmtree(os.path.dirname(doc_data["filepath"]), ignore_errors=True)
+            if doc_data.get("text_file"):
+                text_store.remove_text_file(doc_data["text_file"])
+            for img in doc_data.get("images", []):
+                if os.path.exists(img["path"]):
+                    os.remove(img["path"])
+                image_variants.remove_variants(img["filename"])
+        
+        return {
+            "success": True,
+            "document_id": doc_id,
+            "files_removed": remove_files
+        }, 200
+        
+    except Exception as e:
+        print(f"Error deleting document: {str(e)}")
+        return {"error": str(e)}, 500
+
+def retry_document_data(doc_id):
+    """Queue a document whose processing failed for another round of attempts"""
+    try:
+        doc_data = documents_data.get(doc_id)
+        if not doc_data:
+            return {"error": "Document not found"}, 404
+        
+        status = document_status.get(doc_id) or doc_data.get("status")
+        if status != "error":
+            return {"error": f"Only failed documents can be retried (status: {status})"}, 409
+        
+        doc_data["status"] = "queued"
+        doc_data.pop("error", None)
+        documents_data[doc_id] = doc_data
+        document_status.set(doc_id, "queued", user_id=doc_data.get("metadata", {}).get("user_id", ""))
+        enqueue_document(doc_id, doc_data)
+        
+        return {
+            "success": True,
+            "document_id": doc_id,
+            "status": "queued"
+        }, 200
+        
+    except Exception as e:
+        print(f"Error retrying document: {str(e)}")
+        return {"error": str(e)}, 500
+
+def search_documents_data(args):
+    """Full-text search over document text and metadata, with filters and pagination"""
+    try:
+        query = args.get('q', '').strip()
+        if not query:
+            return {"error": "Missing search query (q)"}, 400
+        
+        page = max(1, int(args.get('page', 1)))
+        per_page = min(max(1, int(args.get('per_page', 20))), 100)
+        tags = [tag.strip() for tag in args.get('tags', '').split(',') if tag.strip()]
+        
+        total, results = search_index.search(
+            query,
+            user_id=args.get('user_id'),
+            category=args.get('category'),
+            tags=tags,
+            limit=per_page,
+            offset=(page - 1) * per_page
+        )
+        
+        return {
+            "query": query,
+            "total": total,
+            "page": page,
+            "per_page": per_page,
+            "results": results
+        }, 200
+        
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        print(f"Error searching documents: {str(e)}")
+        return {"error": str(e)}, 500
+
+def list_documents_data(args):
+    """List documents filtered by user_id, category and/or status"""
+    try:
+        limit = min(int(args.get('limit', 50)), 500)
+        offset = int(args.get('offset', 0))
+        documents = documents_data.query(
+            user_id=args.get('user_id'),
+            category=args.get('category'),
+            status=args.get('status'),
+            limit=limit,
+            offset=offset
+        )
+        
+        return {
+            "documents": documents,
+            "limit": limit,
+            "offset": offset
+        }, 200
+        
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    except Exception as e:
+        print(f"Error listing documents: {str(e)}")
+        return {"error": str(e)}, 500
+
 def get_image_path(filename):
     """Get the path to an image file"""
     return os.path.join(UPLOAD_FOLDER, 'images', filename)
 
-def start_document_processing():
-    """Initialize and start the document processing worker"""
+def get_processing_stats():
+    """Get queue depth and per-worker utilization of the processing engine"""
+    now = time.time()
+    workers = []
+    with worker_stats_lock:
+        for worker_id, stats in sorted(worker_stats.items()):
+            uptime = max(now - stats["started_at"], 1e-9)
+            busy = stats["busy_seconds"]
+            # Count the in-flight job towards utilization as well
+            if stats["busy_since"] is not None:
+                busy += now - stats["busy_since"]
+            workers.append({
+                "worker_id": worker_id,
+                "jobs_processed": stats["jobs_processed"],
+                "busy_seconds": round(busy, 3),
+                "utilization": round(min(busy / uptime, 1.0), 4),
+                "current_document": stats["current_document"],
+            })
+    
+    return {
+        "workers": len(workers),
+        "queue_depth": document_queue.qsize(),
+        "scheduler": document_queue.stats(),
+        "jobs": job_journal_db.stats(),
+        "per_worker": workers,
+        "image_variants": image_variants.stats(),
+        "ocr": ocr_service.stats(),
+        "storage_quota": storage_quota.stats(),
+        "resumable_uploads": resumable_uploads.stats(),
+        "upload_batches": upload_batches.stats(),
+    }
+
+def get_image_variant_path(filename, width_param, accept_webp):
+    """Get the image to serve for /document_image: the original, or a cached resized copy"""
+    image_path = get_image_path(filename)
+    width = image_pipeline.resolve_variant_width(width_param)
+    if width is None or not os.path.exists(image_path):
+        return image_path
+    return image_variants.get(image_path, width, 'WEBP' if accept_webp else 'JPEG')
+
+def create_processing_pool(num_workers):
+    """Create the extraction process pool"""
+    # Spawn fresh interpreters so pool processes don't inherit Flask/ngrok threads
+    return ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+def restart_processing_pool():
+    """Replace the pool after one of its processes died (e.g. killed for using too much memory)"""
+    global processing_pool
+    
+    with processing_pool_lock:
+        broken = processing_pool
+        if broken is None or not getattr(broken, '_broken', True):
+            return
+        processing_pool = create_processing_pool(broken._max_workers)
+    broken.shutdown(wait=False)
+    print("Document processing pool restarted")
+
+def recover_jobs():
+    """Re-queue the jobs a previous run left unfinished"""
+    recovered = 0
+    for job in job_journal_db.recover():
+        doc_data = documents_data.get(job["doc_id"])
+        if not doc_data:
+            job_journal_db.remove(job["doc_id"])
+        elif doc_data.get("status") == "completed":
+            # Finished, but the server stopped before the journal was updated
+            job_journal_db.complete(job["doc_id"])
+        elif schedule_or_fail_job(job):
+            recovered += 1
+    
+    # Documents queued before the journal existed
+    for status in ("queued", "processing"):
+        for doc_data in documents_data.query(status=status):
+            if job_journal_db.get(doc_data["doc_id"]) is None and enqueue_document(doc_data["doc_id"], doc_data):
+                document_status.set(doc_data["doc_id"], "queued", user_id=doc_data.get("metadata", {}).get("user_id", ""))
+                recovered += 1
+    
+    # Jobs waiting out a retry backoff are picked up by the maintenance thread
+    if recovered:
+        print(f"Recovered {recovered} unfinished document jobs")
+    return recovered
+
+def run_job_maintenance():
+    """Keep this process's job leases alive and queue retries and abandoned jobs again"""
+    last_renewal = 0
+    while not maintenance_stop.wait(JOB_MAINTENANCE_INTERVAL):
+        try:
+            if time.time() - last_renewal >= job_journal_db.lease_seconds / 3:
+                job_journal_db.renew()
+                last_renewal = time.time()
+            for job in job_journal_db.due_retries() + job_journal_db.reclaim_expired():
+                schedule_or_fail_job(job)
+        except Exception as e:
+            print(f"Error maintaining document jobs: {str(e)}")
+
+def start_document_processing(num_workers=None):
+    """Initialize and start the document processing pool and its dispatcher threads"""
+    global processing_pool
+    
     init_document_folders()
+    num_workers = max(1, num_workers or PROCESSING_WORKERS)
+    processing_pool = create_processing_pool(num_workers)
+    
+    # Start one dispatcher thread per pool process
+    for worker_id in range(num_workers):
+        with worker_stats_lock:
+            worker_stats[worker_id] = {
+                "jobs_processed": 0,
+                "busy_seconds": 0.0,
+                "current_document": None,
+                "busy_since": None,
+                "started_at": time.time(),
+            }
+        doc_thread = Thread(target=process_document_worker, args=(worker_id,))
+        doc_thread.daemon = True
+        doc_thread.start()
+        worker_threads.append(doc_thread)
+    
+    # Recovery runs in the background, so the server can listen right away
+    maintenance_stop.clear()
+    processing_ready.clear()
+    Thread(target=finish_startup, daemon=True).start()
+    
+    print(f"Document processing started with {num_workers} workers")
+    return worker_threads
+
+def finish_startup():
+    """Open the metadata, pick up where the last run stopped, then keep leases and retries moving"""
+    started = time.time()
+    try:
+        documents_data.load()
+        
+        # Index every document's status in memory, for batch queries and change feeds
+        document_status.seed(documents_data.query())
+        recover_jobs()
+        processing_ready.set()
+        print(f"Document processing ready in {time.time() - started:.2f}s")
+    except Exception as e:
+        # Stays not ready; /ready keeps answering 503
+        print(f"Error recovering document jobs: {str(e)}")
+    
+    Thread(target=run_job_maintenance, daemon=True).start()
+    
+    # Older documents are added to the search index without blocking startup
+    backfill_search_index()
+    
+    # Then text files from before the compressed format are rewritten
+    if CONVERT_LEGACY_TEXT:
+        try:
+            convert_legacy_text_files()
+        except Exception as e:
+            print(f"Error converting text files: {str(e)}")
+
+def is_processing_ready():
+    """Whether documents can be processed: workers running and unfinished jobs recovered"""
+    return processing_ready.is_set() and processing_pool is not None and bool(worker_threads)
+
+def stop_document_processing(timeout=None):
+    """Gracefully stop processing: drain the queue, then shut down the pool"""
+    global processing_pool
+    
+    # Poison pills queue up behind pending documents, so those finish first
+    for _ in worker_threads:
+        document_queue.put(None)
+    for doc_thread in worker_threads:
+        doc_thread.join(timeout)
+    worker_threads.clear()
+    maintenance_stop.set()
+    processing_ready.clear()
     
-    # Start document processing worker thread
-    doc_thread = Thread(target=process_document_worker)
-    doc_thread.daemon = True
-    doc_thread.start()
+    if processing_pool is not None:
+        processing_pool.shutdown(wait=True)
+        processing_pool = None
     
-    return doc_thread 
\ No newline at end of file
+    print("Document processing stopped")
@@ -0,0 +1,82 @@
+import sys
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Simulated generation: a fixed reply, one word per token
+FAKE_REPLY = "This is a canned reply from the fake FastChat server used for load testing."
+TOKEN_DELAY = 0.01
+
+class FakeFastChatHandler(BaseHTTPRequestHandler):
+    """Minimal OpenAI-compatible API: /health, /v1/models and /v1/chat/completions"""
+
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are separate writes; without this, delayed ACKs add ~40 ms per reply
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/v1/models":
+            self._send_json(200, {"object": "list", "data": [{"id": "vicuna-7b-v1.5", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            self._send_json(404, {"error": "not found"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        tokens = FAKE_REPLY.split(" ")
+
+        if not payload.get("stream"):
+            time.sleep(TOKEN_DELAY * len(tokens))
+            self._send_json(200, {
+                "object": "chat.completion",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": FAKE_REPLY}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            })
+            return
+
+        # Stream OpenAI-style chunks using chunked transfer encoding
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            time.sleep(TOKEN_DELAY)
+            chunk = {"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": token if i == 0 else " " + token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+def run_fake_fastchat(host="127.0.0.1", port=8000):
+    """Serve the fake FastChat API until interrupted"""
+    server = ThreadingHTTPServer((host, port), FakeFastChatHandler)
+    server.daemon_threads = True
+    print(f"Fake FastChat listening on http://{host}:{port}")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    # Usage: python fake_fastchat.py [port]
+    run_fake_fastchat(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
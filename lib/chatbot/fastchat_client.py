@@ -0,0 +1,388 @@
+import json
+import time
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# A backend failing this many requests in a row is taken out of rotation for a while
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_OPEN_SECONDS = 10
+
+# Connecting to a replica that is down should fail fast, so the request can move on
+CONNECT_TIMEOUT = 3.05
+
+# Weight of each new sample in the moving average of upstream latency
+LATENCY_EWMA_WEIGHT = 0.2
+
+class UpstreamBusyError(Exception):
+    """Raised when a request can't get a FastChat slot in time"""
+
+class NoBackendAvailableError(UpstreamBusyError):
+    """Raised when every FastChat backend is unhealthy, or out of rotation after failures"""
+
+class BackendFailedError(Exception):
+    """A backend answered with a server error"""
+
+def summarize_latency(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return {
+        "latency_p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+        "latency_p99_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000, 1),
+    }
+
+def is_first_token(line):
+    """Whether a streamed line carries generated text (or ends the stream), not just the role"""
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return True
+    try:
+        return bool(json.loads(payload)['choices'][0].get('delta', {}).get('content'))
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return True
+
+class PeekedStream:
+    """A streamed response read up to its first token, which proves the backend is generating"""
+
+    def __init__(self, response):
+        self.response = response
+        self.lines = response.iter_lines(decode_unicode=True)
+        self.buffered = []
+        for line in self.lines:
+            self.buffered.append(line)
+            if line and line.startswith("data:") and is_first_token(line):
+                break
+
+    def iter_lines(self, decode_unicode=True, **kwargs):
+        buffered, self.buffered = self.buffered, []
+        yield from buffered
+        yield from self.lines
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+class Backend:
+    """One OpenAI-compatible server, with its load, health and circuit breaker state"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        self.consecutive_failures = 0
+        # closed: in rotation; open: skipped until open_until; half_open: one trial request
+        self.circuit = 'closed'
+        self.open_until = 0.0
+        self.healthy = True
+        self.last_probe = None
+        self.last_error = None
+        self.latency = deque(maxlen=1000)
+
+    def stats(self):
+        return dict(
+            url=self.url,
+            healthy=self.healthy,
+            circuit=self.circuit,
+            in_flight=self.in_flight,
+            requests_total=self.requests_total,
+            errors_total=self.errors_total,
+            consecutive_failures=self.consecutive_failures,
+            last_error=self.last_error,
+            last_probe=self.last_probe,
+            **summarize_latency(list(self.latency))
+        )
+
+class FastChatClient:
+    """Shared keep-alive HTTP client for a pool of FastChat backends, with a bounded number of in-flight requests.
+
+    Requests go to the healthy backend with the fewest outstanding requests. A backend that fails
+    is retried on another one, as long as nothing has been sent to the app yet.
+    """
+
+    def __init__(self, hosts, max_concurrent=16, max_queued=64, queue_timeout=30, retries=1,
+                 probe_interval=5, probe_path='/v1/models'):
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.backends = [Backend(host) for host in hosts]
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.probe_interval = probe_interval
+        self.probe_path = probe_path
+        self.probe_stop = threading.Event()
+        self.probe_thread = None
+
+        # One pooled session for every request, sized to the concurrency limit of each backend
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, len(hosts)), pool_maxsize=max_concurrent)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # max_concurrent applies per backend, so capacity grows with the replicas
+        self.slots = threading.BoundedSemaphore(max_concurrent * max(1, len(hosts)))
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.requests_total = 0
+        self.rejected_total = 0
+        self.errors_total = 0
+        self.retried_total = 0
+        self.queue_wait = deque(maxlen=1000)
+        self.latency_ewma = 0.0
+        self.latency_updated = 0.0
+
+    @contextmanager
+    def slot(self):
+        """Wait (bounded) for a free upstream slot"""
+        with self.lock:
+            if self.waiting >= self.max_queued:
+                self.rejected_total += 1
+                metrics.fastchat_errors.inc(backend='', path='', kind='busy')
+                raise UpstreamBusyError("Too many chat requests are waiting for the model")
+            self.waiting += 1
+
+        started = time.time()
+        with metrics.span('fastchat_queue'):
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+        with self.lock:
+            self.waiting -= 1
+            self.queue_wait.append(time.time() - started)
+            if not acquired:
+                self.rejected_total += 1
+            else:
+                self.in_flight += 1
+                self.requests_total += 1
+        if not acquired:
+            metrics.fastchat_errors.inc(backend='', path='', kind='busy')
+            raise UpstreamBusyError("Timed out waiting for a free model slot")
+
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+
+    def _is_routable(self, backend, now):
+        """Whether a backend may take a request (lock held); an open circuit turns half-open once it expires"""
+        if not backend.healthy:
+            return False
+        if backend.circuit == 'open' and now >= backend.open_until:
+            backend.circuit = 'half_open'
+        if backend.circuit == 'open':
+            return False
+        # Half-open backends get a single trial request at a time
+        return backend.circuit == 'closed' or backend.in_flight == 0
+
+    def _acquire_backend(self, exclude):
+        """Pick the routable backend with the fewest outstanding requests, or None"""
+        with self.lock:
+            now = time.time()
+            candidates = [b for b in self.backends if b not in exclude and self._is_routable(b, now)]
+            if not candidates:
+                return None
+            least = min(b.in_flight for b in candidates)
+            backend = random.choice([b for b in candidates if b.in_flight == least])
+            backend.in_flight += 1
+            backend.requests_total += 1
+            return backend
+
+    def _release_backend(self, backend):
+        with self.lock:
+            backend.in_flight -= 1
+
+    def _record_success(self, backend, latency):
+        with self.lock:
+            backend.consecutive_failures = 0
+            backend.circuit = 'closed'
+            backend.latency.append(latency)
+            if self.latency_updated:
+                self.latency_ewma += LATENCY_EWMA_WEIGHT * (latency - self.latency_ewma)
+            else:
+                self.latency_ewma = latency
+            self.latency_updated = time.time()
+
+    def _record_failure(self, backend, error):
+        """Count a failure; enough of them in a row (or a failed trial) opens the circuit"""
+        with self.lock:
+            self.errors_total += 1
+            backend.errors_total += 1
+            backend.consecutive_failures += 1
+            backend.last_error = str(error)
+            if backend.circuit == 'half_open' or backend.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if backend.circuit != 'open':
+                    print(f"FastChat backend {backend.url} taken out of rotation: {str(error)}")
+                backend.circuit = 'open'
+                backend.open_until = time.time() + CIRCUIT_OPEN_SECONDS
+
+    @contextmanager
+    def post(self, path, payload, stream=False, timeout=60):
+        """POST to a FastChat backend while holding a slot; the slot is held until the response is closed.
+
+        Connection errors, timeouts and 5xx answers are retried on another backend. Streams are
+        read up to their first token first, so a replica that accepts but never generates is retried too.
+        """
+        with self.slot():
+            tried = []
+            failed_response = None
+            last_error = None
+            for attempt in range(self.retries + 1):
+                backend = self._acquire_backend(tried)
+                if backend is None:
+                    break
+                tried.append(backend)
+                if attempt:
+                    with self.lock:
+                        self.retried_total += 1
+
+                started = time.perf_counter()
+                response = None
+                try:
+                    with metrics.span('fastchat'):
+                        response = self.session.post(
+                            backend.url + path, json=payload, timeout=(CONNECT_TIMEOUT, timeout), stream=stream
+                        )
+                        if response.status_code >= 500:
+                            raise BackendFailedError(f"{backend.url} answered {response.status_code}")
+                        if stream and response.status_code == 200:
+                            response = PeekedStream(response)
+                except (requests.exceptions.RequestException, BackendFailedError) as e:
+                    self._release_backend(backend)
+                    self._record_failure(backend, e)
+                    if isinstance(e, requests.exceptions.Timeout):
+                        kind = 'timeout'
+                    elif isinstance(e, BackendFailedError):
+                        kind = f"http_{response.status_code}"
+                    else:
+                        kind = 'connection'
+                    metrics.fastchat_errors.inc(backend=backend.url, path=path, kind=kind)
+
+                    # The last server error is handed to the caller if no other backend succeeds
+                    if failed_response is not None:
+                        failed_response.close()
+                    failed_response = None
+                    if isinstance(e, BackendFailedError):
+                        failed_response = response
+                    elif response is not None:
+                        response.close()
+                    last_error = e
+                    continue
+
+                latency = time.perf_counter() - started
+                self._record_success(backend, latency)
+                metrics.fastchat_request_seconds.observe(
+                    latency, backend=backend.url, path=path, status=str(response.status_code)
+                )
+                if failed_response is not None:
+                    failed_response.close()
+                try:
+                    yield response
+                finally:
+                    response.close()
+                    self._release_backend(backend)
+                return
+
+            if failed_response is not None:
+                try:
+                    yield failed_response
+                finally:
+                    failed_response.close()
+                return
+            if last_error is not None:
+                raise last_error
+            raise NoBackendAvailableError("No FastChat backend is available")
+
+    def _ordered_backends(self):
+        """Backends from most to least likely to answer"""
+        with self.lock:
+            now = time.time()
+            return sorted(self.backends, key=lambda b: (not self._is_routable(b, now), b.in_flight))
+
+    def get(self, path, timeout=5):
+        """GET from the first backend that answers, without taking a slot (used for health checks)"""
+        last_error = None
+        for backend in self._ordered_backends():
+            try:
+                return self.session.get(backend.url + path, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                last_error = e
+        raise last_error or NoBackendAvailableError("No FastChat backend is configured")
+
+    def probe(self):
+        """Check every backend once; ones that don't answer are left out of routing until they do"""
+        for backend in self.backends:
+            error = None
+            try:
+                response = self.session.get(backend.url + self.probe_path, timeout=2)
+                if response.status_code != 200:
+                    error = f"Health probe answered {response.status_code}"
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+            with self.lock:
+                if backend.healthy and error:
+                    print(f"FastChat backend {backend.url} failed its health probe: {error}")
+                backend.healthy = error is None
+                backend.last_probe = time.time()
+                if error:
+                    backend.last_error = error
+                elif backend.circuit == 'open':
+                    # Answering probes again: let a trial request through right away
+                    backend.open_until = 0.0
+
+    def _run_probes(self):
+        while not self.probe_stop.wait(self.probe_interval):
+            try:
+                self.probe()
+            except Exception as e:
+                print(f"Error probing FastChat backends: {str(e)}")
+
+    def start_health_checks(self):
+        """Probe the backends in the background every probe_interval seconds"""
+        if self.probe_thread is None and self.probe_interval > 0:
+            self.probe_stop.clear()
+            self.probe_thread = threading.Thread(target=self._run_probes, daemon=True, name='fastchat-probes')
+            self.probe_thread.start()
+
+    def stop_health_checks(self):
+        self.probe_stop.set()
+        self.probe_thread = None
+
+    def recent_latency(self, max_age=60):
+        """Moving average of upstream response time, or 0 if nothing has answered within max_age seconds"""
+        with self.lock:
+            if time.time() - self.latency_updated > max_age:
+                return 0.0
+            return self.latency_ewma
+
+    def backend_stats(self):
+        """Get load, health, circuit state and latency of every backend"""
+        with self.lock:
+            return [backend.stats() for backend in self.backends]
+
+    def stats(self):
+        """Get concurrency counters and queue-wait latency"""
+        with self.lock:
+            waits = sorted(self.queue_wait)
+            result = {
+                "max_concurrent": self.max_concurrent,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "requests_total": self.requests_total,
+                "rejected_total": self.rejected_total,
+                "errors_total": self.errors_total,
+                "retried_total": self.retried_total,
+                "latency_ewma_ms": round(self.latency_ewma * 1000, 1),
+            }
+        if waits:
+            result["queue_wait_p50_ms"] = round(waits[len(waits) // 2] * 1000, 1)
+            result["queue_wait_p99_ms"] = round(waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000, 1)
+        result["backends"] = self.backend_stats()
+        return result
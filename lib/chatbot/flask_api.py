@@ -1,119 +1,433 @@
 import sys
 import subprocess
-import pkg_resources
+import importlib.util
 import os
+import hmac
+import math
 import time
+import functools
 import threading
+from collections import deque
+from contextlib import ExitStack
 
-# Check and install required packages
-required_packages = ['flask', 'flask-cors', 'pyngrok', 'requests', 'PyPDF2', 'pillow']
-installed_packages = [pkg.key for pkg in pkg_resources.working_set]
+# Fast startup: never pip install anything (FAST_STARTUP=1, or --fast on the command line)
+FAST_STARTUP = os.environ.get('FAST_STARTUP', '0') == '1' or (__name__ == '__main__' and '--fast' in sys.argv)
 
-missing_packages = [pkg for pkg in required_packages if pkg.lower() not in installed_packages]
+# Required packages and the module each one provides
+required_packages = {
+    'flask': 'flask', 'flask-cors': 'flask_cors', 'pyngrok': 'pyngrok', 'requests': 'requests',
+    'PyPDF2': 'PyPDF2', 'pillow': 'PIL', 'numpy': 'numpy',
+}
 
-if missing_packages:
-    print(f"Installing missing packages: {', '.join(missing_packages)}")
-    subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing_packages])
-    print("All required packages installed successfully!")
+def install_missing_packages():
+    """Install required packages that can't be found (a lookup, nothing is imported)"""
+    missing_packages = [pkg for pkg, module in required_packages.items() if importlib.util.find_spec(module) is None]
+    if missing_packages:
+        print(f"Installing missing packages: {', '.join(missing_packages)}")
+        subprocess.check_call([sys.executable, '-m', 'pip', 'install', *missing_packages])
+        print("All required packages installed successfully!")
 
-from flask import Flask, request, jsonify, send_from_directory
+if not FAST_STARTUP:
+    install_missing_packages()
+
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 import requests
 import json
 
 # Import document processing module
 import document_processor
+import upload_ingest
+import metrics
+import text_store
+from fastchat_client import FastChatClient, UpstreamBusyError
+from rate_limiter import AdmissionController, AdmissionRejected, RoutePolicy
+from response_cache import ResponseCache, make_cache_key
+from chat_history import HistoryManager, TokenCounter
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
 
+# Refuse oversized request bodies before reading them (with headroom for the form fields)
+app.config['MAX_CONTENT_LENGTH'] = upload_ingest.UPLOAD_MAX_BYTES + upload_ingest.MB
+
 # FastChat settings
 FASTCHAT_HOST = "http://localhost:8000"  # Default FastChat server address
+FASTCHAT_CONTROLLER = "http://localhost:21001"
+
+# OpenAI-compatible chat backends, comma separated; setting this uses servers started elsewhere
+FASTCHAT_BACKENDS = [
+    host.strip() for host in os.environ.get('FASTCHAT_BACKENDS', FASTCHAT_HOST).split(',') if host.strip()
+]
+FASTCHAT_EXTERNAL_BACKENDS = 'FASTCHAT_BACKENDS' in os.environ
+
+# Model workers started locally behind the controller; with more than one, each gets its own GPU
+# (the i-th of CUDA_VISIBLE_DEVICES if set, else GPU i)
+FASTCHAT_LOCAL_WORKERS = int(os.environ.get('FASTCHAT_LOCAL_WORKERS', 1))
+
+# Other backends a failed chat request is retried on, and how often backends are health probed
+FASTCHAT_RETRIES = int(os.environ.get('FASTCHAT_RETRIES', 1))
+FASTCHAT_PROBE_INTERVAL = float(os.environ.get('FASTCHAT_PROBE_INTERVAL', 5))
 API_PREFIX = "/v1/chat/completions"
 
+# How long FastChat may take to come up (loading the model is the slow part)
+FASTCHAT_STARTUP_TIMEOUT = float(os.environ.get('FASTCHAT_STARTUP_TIMEOUT', 900))
+
+# /ready re-probes FastChat at most this often
+READY_PROBE_INTERVAL = 2.0
+
+# Upstream limits: concurrent FastChat requests per backend, and how many may wait (and how long) for a slot
+FASTCHAT_MAX_CONCURRENCY = int(os.environ.get('FASTCHAT_MAX_CONCURRENCY', 16))
+FASTCHAT_MAX_QUEUE = int(os.environ.get('FASTCHAT_MAX_QUEUE', 64))
+FASTCHAT_QUEUE_TIMEOUT = float(os.environ.get('FASTCHAT_QUEUE_TIMEOUT', 30))
+
+# Shared, connection-pooled client for every FastChat call, balancing across the backends
+fastchat = FastChatClient(
+    FASTCHAT_BACKENDS,
+    max_concurrent=FASTCHAT_MAX_CONCURRENCY,
+    max_queued=FASTCHAT_MAX_QUEUE,
+    queue_timeout=FASTCHAT_QUEUE_TIMEOUT,
+    retries=FASTCHAT_RETRIES,
+    probe_interval=FASTCHAT_PROBE_INTERVAL
+)
+
+def collect_backend_stats(field):
+    return lambda: [((backend["url"],), int(backend[field])) for backend in fastchat.backend_stats()]
+
+metrics.GaugeCallback(
+    'fastchat_backend_in_flight', 'Requests outstanding on each FastChat backend', ('backend',),
+    collect_backend_stats("in_flight")
+)
+metrics.GaugeCallback(
+    'fastchat_backend_healthy', 'Whether each FastChat backend passes its health probe', ('backend',),
+    collect_backend_stats("healthy")
+)
+metrics.GaugeCallback(
+    'fastchat_backend_circuit_open', 'Whether each FastChat backend is out of rotation after failures', ('backend',),
+    lambda: [((backend["url"],), int(backend["circuit"] == 'open')) for backend in fastchat.backend_stats()]
+)
+
+# Chat model settings
+CHAT_MODEL = "vicuna-7b-v1.5"
+CHAT_TEMPERATURE = 0.7
+CHAT_MAX_TOKENS = 800
+
+# Context window budgeting: old turns are summarized (or dropped) to fit the model's context
+CHAT_CONTEXT_WINDOW = int(os.environ.get('CHAT_CONTEXT_WINDOW', 4096))
+CHAT_TOKENIZER = os.environ.get('CHAT_TOKENIZER', 'lmsys/vicuna-7b-v1.5')
+CHAT_SUMMARIZE_HISTORY = os.environ.get('CHAT_SUMMARIZE_HISTORY', '1') == '1'
+CHAT_SUMMARY_TOKENS = 256
+
+# Browser/app cache lifetime for served files; image names are unique, so images never change
+TEXT_CACHE_MAX_AGE = 3600
+IMAGE_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# Retrieval: number of document chunks added to the prompt when the app sends doc_ids
+CHAT_RAG_TOP_K = int(os.environ.get('CHAT_RAG_TOP_K', 4))
+
+# Response cache: only (near) deterministic requests at or below this temperature are cached, so
+# sampled answers at the default CHAT_TEMPERATURE are not replayed unless this is raised
+CHAT_CACHE_ENABLED = os.environ.get('CHAT_CACHE_ENABLED', '1') == '1'
+CHAT_CACHE_MAX_TEMPERATURE = float(os.environ.get('CHAT_CACHE_MAX_TEMPERATURE', 0.2))
+response_cache = ResponseCache(
+    max_entries=int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', 2048)),
+    max_bytes=int(os.environ.get('CHAT_CACHE_MAX_MB', 32)) * 1024 * 1024,
+    ttl=int(os.environ.get('CHAT_CACHE_TTL', 3600)),
+    persist_path=os.environ.get('CHAT_CACHE_FILE') or None
+)
+
+# Status streams close after this long (EventSource reconnects with Last-Event-ID); idle ones get a
+# comment line this often so proxies keep them open
+STATUS_STREAM_SECONDS = 300
+STATUS_KEEPALIVE_SECONDS = 15
+
+# Rate limits per client (requests per second, burst; a rate of 0 turns the limit off), keyed by
+# user_id (X-User-Id header, ?user_id or a JSON body's user_id) or else the client's IP. The IP
+# also has a bucket of its own, whatever user_id it sends
+CHAT_RATE = float(os.environ.get('CHAT_RATE_LIMIT', 1))
+CHAT_BURST = float(os.environ.get('CHAT_RATE_BURST', 5))
+UPLOAD_RATE = float(os.environ.get('UPLOAD_RATE_LIMIT', 0.2))
+UPLOAD_BURST = float(os.environ.get('UPLOAD_RATE_BURST', 10))
+DEFAULT_RATE = float(os.environ.get('API_RATE_LIMIT', 20))
+DEFAULT_BURST = float(os.environ.get('API_RATE_BURST', 100))
+
+# Requests of a kind running at once; 0 leaves it uncapped
+CHAT_MAX_IN_FLIGHT = int(os.environ.get(
+    'CHAT_MAX_IN_FLIGHT', FASTCHAT_MAX_CONCURRENCY * len(FASTCHAT_BACKENDS) + FASTCHAT_MAX_QUEUE
+))
+UPLOAD_MAX_IN_FLIGHT = int(os.environ.get('UPLOAD_MAX_IN_FLIGHT', 16))
+STATUS_STREAM_MAX_OPEN = int(os.environ.get('STATUS_STREAM_MAX_OPEN', 256))
+
+# Load shedding: new chats are refused while this many wait for a model slot or upstream answers take
+# longer than this (moving average), and new uploads while this many documents are queued
+CHAT_SHED_QUEUE_DEPTH = int(os.environ.get('CHAT_SHED_QUEUE_DEPTH', FASTCHAT_MAX_QUEUE * 3 // 4))
+CHAT_SHED_LATENCY = float(os.environ.get('CHAT_SHED_LATENCY_SECONDS', 20))
+UPLOAD_SHED_QUEUE_DEPTH = int(os.environ.get('UPLOAD_SHED_QUEUE_DEPTH', 500))
+
+# Traces and the profiler expose stack traces and request details, so they are off unless this
+# token is set, and then need it in an X-Admin-Token header
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Reverse proxies (ngrok counts as one) in front of the server; the client's address is then the
+# X-Forwarded-For entry the outermost of them added. With none, the header is ignored, since anyone can send it.
+# Run as a script, the server starts ngrok itself and defaults to 1
+RATE_LIMIT_TRUSTED_PROXIES = int(os.environ.get('RATE_LIMIT_TRUSTED_PROXIES', 0))
+
+# Largest JSON body read before the route runs, to find the user_id to rate limit by
+CLIENT_KEY_BODY_MAX = 64 * 1024
+
+def shed_chat():
+    """Refuse new chats early while the model is backed up, rather than letting them time out in the queue"""
+    waiting = fastchat.waiting
+    if waiting >= CHAT_SHED_QUEUE_DEPTH:
+        return f"The chat model is busy ({waiting} requests waiting), try again shortly", 5
+    latency = fastchat.recent_latency()
+    if latency >= CHAT_SHED_LATENCY:
+        return "The chat model is answering slowly, try again shortly", latency
+    return None
+
+def shed_uploads():
+    """Refuse new uploads while the processing queue is too deep to finish them in reasonable time"""
+    depth = document_processor.document_queue.qsize()
+    if depth >= UPLOAD_SHED_QUEUE_DEPTH:
+        return f"Document processing is backed up ({depth} documents queued), try again later", 30
+    return None
+
+# Health checks and metrics scrapes are never limited
+admission = AdmissionController(
+    default=RoutePolicy('default', DEFAULT_RATE, DEFAULT_BURST, 0),
+    exempt=('health', 'ready', 'get_metrics')
+)
+admission.add_policy(('chat',), RoutePolicy('chat', CHAT_RATE, CHAT_BURST, CHAT_MAX_IN_FLIGHT, shed=shed_chat))
+admission.add_policy(
+    ('process_document', 'process_documents', 'create_upload', 'retry_document'),
+    RoutePolicy('upload', UPLOAD_RATE, UPLOAD_BURST, UPLOAD_MAX_IN_FLIGHT, shed=shed_uploads)
+)
+admission.add_policy(
+    ('document_events', 'poll_document_events'),
+    RoutePolicy('status_stream', DEFAULT_RATE, DEFAULT_BURST, STATUS_STREAM_MAX_OPEN)
+)
+
+metrics.GaugeCallback(
+    'admission_in_flight', 'Requests running per admission policy', ('policy',), admission.in_flight
+)
+
+# Recent chat latency samples, reported by /chat_metrics
+chat_metrics = {
+    "requests": 0,
+    "streaming_requests": 0,
+    "time_to_first_token": deque(maxlen=1000),
+    "total_time": deque(maxlen=1000),
+}
+chat_metrics_lock = threading.Lock()
+
 # ngrok settings
 NGROK_AUTH_TOKEN = ""  # Will be set via command line arg
 NGROK_URL = ""  # Will be updated after ngrok starts
 
-# Flag to check if FastChat is already set up
+# Set once FastChat answers with the chat model loaded
 fastchat_setup_complete = False
 
+# Last FastChat readiness probe: (checked at, ready)
+fastchat_probe = {"checked_at": 0.0, "ready": False}
+
+@app.before_request
+def start_request_timing():
+    """Time every request, and trace its spans when tracing is on (or the request asks for it)"""
+    g.request_started = time.perf_counter()
+    if metrics.TRACING_ENABLED or request.headers.get('X-Trace') == '1':
+        metrics.start_trace(request.method + ' ' + request.path)
+
+@app.after_request
+def record_request_timing(response):
+    """Record the request's latency; traced requests get their spans in a Server-Timing header"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        # Label by route template, so /document_status/<doc_id> is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - started, route=route, method=request.method, status=str(response.status_code)
+        )
+    trace = metrics.end_trace(status=response.status_code)
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+    return response
+
+def get_client_address():
+    """The address a request came from, looking through the configured proxies only"""
+    if RATE_LIMIT_TRUSTED_PROXIES > 0:
+        forwarded = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    return request.remote_addr or ''
+
+def get_client_key(address):
+    """Who a request counts against: its user_id if it gives one, else the client's address"""
+    user_id = request.headers.get('X-User-Id') or request.args.get('user_id')
+    if not user_id and request.is_json and (request.content_length or 0) <= CLIENT_KEY_BODY_MAX:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            user_id = data.get('user_id')
+    if user_id:
+        return f"user:{user_id}"
+    return f"ip:{address}"
+
+@app.before_request
+def admit_request():
+    """Turn requests away before they do any work when a client is over its rate or the server is overloaded"""
+    try:
+        address = get_client_address()
+        g.admission = admission.admit(request.endpoint, get_client_key(address), address)
+    except AdmissionRejected as e:
+        result, status_code = e.to_response()
+        return jsonify(result), status_code, {"Retry-After": str(e.retry_after)}
+
+@app.after_request
+def hold_admission(response):
+    """Free the request's concurrency slot, or for a generated stream once the stream is closed"""
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        # Passthrough bodies (files) are closed by the server without the response's close hooks
+        if response.is_streamed and not response.direct_passthrough:
+            response.call_on_close(ticket.release)
+        else:
+            ticket.release()
+    return response
+
+@app.teardown_request
+def release_admission(error=None):
+    """Free the slot of a request that never produced a response"""
+    ticket = g.pop('admission', None)
+    if ticket is not None:
+        ticket.release()
+
+def wait_until(check, timeout, initial_delay=0.1, max_delay=2.0):
+    """Poll check() with exponential backoff until it returns true; False if the timeout passes first"""
+    deadline = time.time() + timeout
+    delay = initial_delay
+    while True:
+        try:
+            if check():
+                return True
+        except (requests.exceptions.RequestException, ValueError):
+            pass
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+def is_fastchat_ready():
+    """Whether FastChat's API server is up and serves the chat model"""
+    response = fastchat.get("/v1/models", timeout=2)
+    if response.status_code != 200:
+        return False
+    return any(model.get("id") == CHAT_MODEL for model in response.json().get("data", []))
+
+def is_controller_ready():
+    return requests.post(f"{FASTCHAT_CONTROLLER}/list_models", timeout=2).status_code == 200
+
+def start_fastchat_process(name, args, env=None):
+    """Start a FastChat component in the background, logging to fastchat_<name>.log"""
+    log_file = open(f"fastchat_{name}.log", "ab")
+    return subprocess.Popen([sys.executable, "-m", *args], stdout=log_file, stderr=subprocess.STDOUT, env=env)
+
+def get_worker_gpu(index):
+    """The GPU a local model worker is pinned to: the index-th visible one, wrapping around"""
+    visible = [gpu.strip() for gpu in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(',') if gpu.strip()]
+    return visible[index % len(visible)] if visible else str(index)
+
 def setup_fastchat():
-    """Set up and start FastChat model and API server"""
+    """Set up and start FastChat model and API server, polling each part until it is up"""
     global fastchat_setup_complete
     
     if fastchat_setup_complete:
         print("FastChat is already set up.")
         return
     
-    print("Setting up FastChat...")
+    # A FastChat left running by the previous run (e.g. across a restart) is reused as is
+    if wait_until(is_fastchat_ready, 0):
+        print("FastChat API server is already running!")
+        fastchat_setup_complete = True
+        return
     
-    # Check if FastChat is already cloned
-    if not os.path.exists("FastChat"):
-        print("Cloning FastChat repository...")
-        subprocess.run(["git", "clone", "https://github.com/lm-sys/FastChat.git"], check=True)
+    # Backends configured with FASTCHAT_BACKENDS are run elsewhere; just wait for one to serve the model
+    if FASTCHAT_EXTERNAL_BACKENDS:
+        print(f"Waiting for FastChat backends: {', '.join(FASTCHAT_BACKENDS)}")
+        if wait_until(is_fastchat_ready, FASTCHAT_STARTUP_TIMEOUT):
+            print("FastChat backends are serving!")
+            fastchat_setup_complete = True
+        else:
+            print(f"Warning: no FastChat backend is serving {CHAT_MODEL} after {FASTCHAT_STARTUP_TIMEOUT:.0f}s")
+        return
     
-    # Install FastChat
-    print("Installing FastChat...")
-    os.chdir("FastChat")
-    subprocess.run([sys.executable, "-m", "pip", "install", "--upgrade", "pip"], check=True)
-    subprocess.run([sys.executable, "-m", "pip", "install", "-e", ".[model_worker,webui]"], check=True)
+    print("Setting up FastChat...")
     
-    # Start controller in background
-    print("Starting FastChat controller...")
-    controller_process = subprocess.Popen(
-        [sys.executable, "-m", "fastchat.serve.controller"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
+    if importlib.util.find_spec("fastchat") is None:
+        if FAST_STARTUP:
+            print("FastChat is not installed and fast startup skips installing it; run once without --fast")
+            return
+        
+        # Check if FastChat is already cloned
+        if not os.path.exists("FastChat"):
+            print("Cloning FastChat repository...")
+            subprocess.run(["git", "clone", "https://github.com/lm-sys/FastChat.git"], check=True)
+        
+        # Install FastChat (without changing this process's working directory)
+        print("Installing FastChat...")
+        subprocess.run([sys.executable, "-m", "pip", "install", "--upgrade", "pip"], check=True, cwd="FastChat")
+        subprocess.run([sys.executable, "-m", "pip", "install", "-e", ".[model_worker,webui]"], check=True, cwd="FastChat")
     
-    # Wait for controller to start
-    time.sleep(5)
+    # Start controller in background
+    if not wait_until(is_controller_ready, 0):
+        print("Starting FastChat controller...")
+        start_fastchat_process("controller", ["fastchat.serve.controller"])
+        if not wait_until(is_controller_ready, 60):
+            print("Warning: FastChat controller did not come up")
+            return
     
-    # Start model worker in background
+    # Model workers register with the controller once loaded, and the controller spreads requests
+    # across them; the API server only needs the controller
     print("Starting FastChat model worker (this might take a while to load the model)...")
-    model_worker_process = subprocess.Popen(
-        [sys.executable, "-m", "fastchat.serve.model_worker", "--model-path", "lmsys/vicuna-7b-v1.5"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    
-    # Wait for model worker to start
-    time.sleep(10)
-    
-    # Start API server in background
+    workers = max(1, FASTCHAT_LOCAL_WORKERS)
+    for i in range(workers):
+        port = 21002 + i
+        # Each worker loads its own copy of the model, so several need a GPU each
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=get_worker_gpu(i)) if workers > 1 else None
+        start_fastchat_process(f"model_worker_{i}", [
+            "fastchat.serve.model_worker", "--model-path", "lmsys/vicuna-7b-v1.5",
+            "--port", str(port), "--worker-address", f"http://localhost:{port}"
+        ], env=env)
     print("Starting FastChat API server...")
-    api_server_process = subprocess.Popen(
-        [sys.executable, "-m", "fastchat.serve.openai_api_server", "--host", "0.0.0.0", "--port", "8000"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+    start_fastchat_process(
+        "api_server", ["fastchat.serve.openai_api_server", "--host", "0.0.0.0", "--port", "8000"]
     )
     
-    # Wait for API server to start
-    time.sleep(5)
-    
-    # Change back to original directory
-    os.chdir("..")
-    
-    # Check if API server is running
-    try:
-        response = requests.get(f"{FASTCHAT_HOST}/health")
-        if response.status_code == 200:
-            print("FastChat API server is running!")
-            fastchat_setup_complete = True
-        else:
-            print(f"FastChat API server returned status code: {response.status_code}")
-    except requests.exceptions.ConnectionError:
-        print("Warning: Could not connect to FastChat API server. It might still be starting up.")
-        # We'll still set this to True as the server might just need more time
+    if wait_until(is_fastchat_ready, FASTCHAT_STARTUP_TIMEOUT):
+        print("FastChat API server is running!")
         fastchat_setup_complete = True
-    
-    print("FastChat setup complete!")
+    else:
+        print(f"Warning: FastChat is not serving {CHAT_MODEL} after {FASTCHAT_STARTUP_TIMEOUT:.0f}s")
+
+def get_fastchat_readiness():
+    """FastChat readiness for /ready, probed at most every READY_PROBE_INTERVAL seconds"""
+    now = time.time()
+    if now - fastchat_probe["checked_at"] >= READY_PROBE_INTERVAL:
+        fastchat_probe["ready"] = wait_until(is_fastchat_ready, 0)
+        fastchat_probe["checked_at"] = now
+    return fastchat_probe["ready"]
+
+def get_ngrok_url():
+    """Get the public URL of the first ngrok tunnel, if it is up"""
+    global NGROK_URL
+    tunnels = requests.get("http://localhost:4040/api/tunnels", timeout=2).json()["tunnels"]
+    if tunnels:
+        NGROK_URL = tunnels[0]["public_url"]
+    return bool(tunnels)
 
 def start_ngrok(auth_token, port):
     """Start ngrok and get the public URL"""
-    global NGROK_URL
-    
     # Check if ngrok is installed
     try:
         subprocess.run(["ngrok", "--version"], check=True, capture_output=True)
@@ -127,111 +441,607 @@ def start_ngrok(auth_token, port):
     # Start ngrok in a separate process
     ngrok_process = subprocess.Popen(
         ["ngrok", "http", str(port)],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
     )
     
-    # Wait for ngrok to initialize
-    time.sleep(2)
-    
-    # Get ngrok URL from API
-    try:
-        response = requests.get("http://localhost:4040/api/tunnels")
-        tunnels = response.json()["tunnels"]
-        if tunnels:
-            NGROK_URL = tunnels[0]["public_url"]
-            print(f"ngrok URL: {NGROK_URL}")
-            return True
-    except Exception as e:
-        print(f"Error getting ngrok URL: {e}")
+    # Poll ngrok's local API until the tunnel is up
+    if wait_until(get_ngrok_url, 30, initial_delay=0.05, max_delay=0.5):
+        print(f"ngrok URL: {NGROK_URL}")
+        return True
     
     print("Failed to start ngrok or get URL")
     return False
 
+@app.route('/health', methods=['GET'])
+def health():
+    """Liveness: the server process is up and answering"""
+    return jsonify({"status": "ok"})
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness: documents can be processed and FastChat serves the chat model (503 until then)"""
+    checks = {
+        "documents": document_processor.is_processing_ready(),
+        "fastchat": get_fastchat_readiness(),
+    }
+    is_ready = all(checks.values())
+    return jsonify({"ready": is_ready, "checks": checks}), 200 if is_ready else 503
+
 @app.route('/update_api_url', methods=['GET'])
 def get_api_url():
     """Return the current ngrok URL for the app to use"""
     return jsonify({"url": f"{NGROK_URL}/chat"})
 
+def build_chat_messages(data):
+    """Format the app's message and conversation history for FastChat"""
+    message = data.get('message', '')
+    conversation_history = data.get('conversation_history', [])
+    
+    # Format the conversation history for FastChat
+    messages = []
+    
+    # Add system message if not present
+    if not conversation_history or conversation_history[0].get('role') != 'SYSTEM':
+        messages.append({
+            "role": "system",
+            "content": "You are a helpful AI assistant."
+        })
+    
+    # Add conversation history
+    for msg in conversation_history:
+        role = "user" if msg.get('role') == "USER" else "assistant"
+        messages.append({
+            "role": role,
+            "content": msg.get('content', '')
+        })
+    
+    # If the last message in history isn't the current message, add it
+    if not messages or messages[-1]['content'] != message:
+        messages.append({
+            "role": "user",
+            "content": message
+        })
+    
+    return messages
+
+def add_document_context(messages, query, doc_ids):
+    """Put the document chunks most relevant to the question into the system prompt"""
+    chunks = document_processor.retrieve_document_chunks(query, doc_ids, CHAT_RAG_TOP_K)
+    if not chunks:
+        return messages, []
+    
+    excerpts = "\n\n".join(
+        f"[{i+1}] ({chunk['filename']}, page {chunk['page'] or 1}) {chunk['text']}"
+        for i, chunk in enumerate(chunks)
+    )
+    context = (
+        "Answer using the following excerpts from the user's documents when they are relevant, "
+        f"and cite them by number.\n\n{excerpts}"
+    )
+    
+    messages = list(messages)
+    if messages and messages[0]["role"] == "system":
+        messages[0] = {"role": "system", "content": f"{messages[0]['content']}\n\n{context}"}
+    else:
+        messages.insert(0, {"role": "system", "content": context})
+    
+    sources = [
+        {"document_id": chunk["doc_id"], "page": chunk["page"], "score": chunk["score"]}
+        for chunk in chunks
+    ]
+    return messages, sources
+
+def record_chat_timing(streaming, time_to_first_token, total_time):
+    """Record latency samples for /chat_metrics"""
+    with chat_metrics_lock:
+        chat_metrics["requests"] += 1
+        if streaming:
+            chat_metrics["streaming_requests"] += 1
+        if time_to_first_token is not None:
+            chat_metrics["time_to_first_token"].append(time_to_first_token)
+        chat_metrics["total_time"].append(total_time)
+    if time_to_first_token is not None:
+        metrics.chat_first_token_seconds.observe(time_to_first_token, streaming=str(bool(streaming)).lower())
+    metrics.chat_response_seconds.observe(total_time, streaming=str(bool(streaming)).lower())
+
+def summarize_samples(samples):
+    """Get count, mean and percentiles (in ms) of latency samples"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+    def percentile(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+def summarize_history(previous_summary, turns):
+    """Ask the model for a short summary of older conversation turns"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+    if previous_summary:
+        transcript = f"Summary so far: {previous_summary}\n{transcript}"
+    
+    # Keep the summarization prompt itself inside the context window
+    max_chars = (CHAT_CONTEXT_WINDOW - CHAT_SUMMARY_TOKENS - 128) * 3
+    transcript = transcript[-max_chars:]
+    
+    payload = {
+        "model": CHAT_MODEL,
+        "messages": [
+            {
+                "role": "system",
+                "content": "Summarize the conversation below in a few sentences. Keep names, facts, decisions and open questions."
+            },
+            {"role": "user", "content": transcript}
+        ],
+        "temperature": 0,
+        "max_tokens": CHAT_SUMMARY_TOKENS
+    }
+    with fastchat.post(API_PREFIX, payload) as fastchat_response:
+        fastchat_response.raise_for_status()
+        return fastchat_response.json()['choices'][0]['message']['content'].strip()
+
+history_manager = HistoryManager(
+    context_window=CHAT_CONTEXT_WINDOW,
+    max_new_tokens=CHAT_MAX_TOKENS,
+    summary_tokens=CHAT_SUMMARY_TOKENS,
+    token_counter=TokenCounter(CHAT_TOKENIZER),
+    summarizer=summarize_history if CHAT_SUMMARIZE_HISTORY else None
+)
+
+def get_chat_cache_key(data, fastchat_payload):
+    """Get the response cache key for a chat request, or None if it must not be cached"""
+    if not CHAT_CACHE_ENABLED:
+        return None
+    
+    # The app can skip the cache with "cache": false or Cache-Control: no-cache
+    if data.get('cache') is False or 'no-cache' in request.headers.get('Cache-Control', ''):
+        response_cache.record_bypass()
+        return None
+    if fastchat_payload["temperature"] > CHAT_CACHE_MAX_TEMPERATURE:
+        return None
+    
+    return make_cache_key(
+        fastchat_payload["model"],
+        fastchat_payload["messages"],
+        fastchat_payload["temperature"],
+        fastchat_payload["max_tokens"]
+    )
+
+def stream_cached_chat(cached_response, sources=None):
+    """Send a cached response in the same event format as a live stream"""
+    yield f"data: {json.dumps({'delta': cached_response})}\n\n"
+    done = {'done': True, 'response': cached_response, 'time_to_first_token_ms': 0.0, 'cached': True}
+    if sources:
+        done['sources'] = sources
+    yield f"data: {json.dumps(done)}\n\n"
+
+def stream_chat(fastchat_payload, cache_key=None, sources=None):
+    """Relay FastChat's streamed deltas to the app as server-sent events.
+
+    The first step only opens the upstream stream and yields an empty chunk; chat() takes it before
+    sending headers, so a busy or unavailable FastChat is a 503 here too, not an error event.
+    """
+    started = time.time()
+    time_to_first_token = None
+    parts = []
+    finished = False
+    
+    upstream = ExitStack()
+    fastchat_response = upstream.enter_context(
+        fastchat.post(API_PREFIX, dict(fastchat_payload, stream=True), stream=True)
+    )
+    try:
+        with upstream:
+            yield ""
+            if fastchat_response.status_code != 200:
+                print(f"FastChat error: {fastchat_response.status_code} - {fastchat_response.text}")
+                yield f"event: error\ndata: {json.dumps({'error': f'Error from FastChat: {fastchat_response.text}'})}\n\n"
+                return
+            
+            for line in fastchat_response.iter_lines(decode_unicode=True):
+                # OpenAI-style stream: "data: {chunk}" lines, ended by "data: [DONE]"
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    finished = True
+                    break
+                
+                delta = json.loads(payload)['choices'][0].get('delta', {}).get('content')
+                if not delta:
+                    continue
+                if time_to_first_token is None:
+                    time_to_first_token = time.time() - started
+                parts.append(delta)
+                yield f"data: {json.dumps({'delta': delta})}\n\n"
+        
+        total_time = time.time() - started
+        record_chat_timing(True, time_to_first_token, total_time)
+        # A stream cut off before [DONE], or with no answer at all, must not be replayed from the cache
+        if cache_key and finished and parts:
+            response_cache.put(cache_key, ''.join(parts))
+        done = {
+            'done': True,
+            'response': ''.join(parts),
+            'time_to_first_token_ms': round((time_to_first_token or total_time) * 1000, 1)
+        }
+        if sources:
+            done['sources'] = sources
+        yield f"data: {json.dumps(done)}\n\n"
+        
+    except Exception as e:
+        print(f"Error in chat stream: {str(e)}")
+        yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
 @app.route('/chat', methods=['POST'])
 def chat():
     """Handle chat requests from the app and forward to FastChat"""
     try:
         data = request.json
-        message = data.get('message', '')
-        conversation_history = data.get('conversation_history', [])
+        try:
+            temperature = float(data.get('temperature', CHAT_TEMPERATURE))
+        except (TypeError, ValueError):
+            temperature = None
+        if temperature is None or not math.isfinite(temperature) or temperature < 0:
+            return jsonify({"error": "temperature must be a non-negative number"}), 400
+        messages = build_chat_messages(data)
         
-        # Format the conversation history for FastChat
-        messages = []
+        # Ground the answer in the user's processed documents
+        sources = []
+        doc_ids = data.get('doc_ids') or []
+        if isinstance(doc_ids, str):
+            doc_ids = doc_ids.split(',')
+        if not isinstance(doc_ids, list):
+            return jsonify({"error": "doc_ids must be a list or a comma separated string"}), 400
+        doc_ids = [str(doc_id).strip() for doc_id in doc_ids if str(doc_id).strip()]
+        if doc_ids:
+            with metrics.span('retrieval'):
+                messages, sources = add_document_context(messages, data.get('message', ''), doc_ids)
         
-        # Add system message if not present
-        if not conversation_history or conversation_history[0].get('role') != 'SYSTEM':
-            messages.append({
-                "role": "system",
-                "content": "You are a helpful AI assistant."
-            })
-        
-        # Add conversation history
-        for msg in conversation_history:
-            role = "user" if msg.get('role') == "USER" else "assistant"
-            messages.append({
-                "role": role,
-                "content": msg.get('content', '')
-            })
-        
-        # If the last message in history isn't the current message, add it
-        if not messages or messages[-1]['content'] != message:
-            messages.append({
-                "role": "user",
-                "content": message
-            })
+        # Fit the conversation into the context window
+        with metrics.span('history'):
+            messages, context_info = history_manager.compact(messages)
+        context_headers = {"X-Context-Tokens-Saved": str(context_info["tokens_saved"])}
         
         # Prepare the request to FastChat
         fastchat_payload = {
-            "model": "vicuna-7b-v1.5",
+            "model": CHAT_MODEL,
             "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 800
+            "temperature": temperature,
+            "max_tokens": CHAT_MAX_TOKENS
         }
         
-        # Send request to FastChat
-        fastchat_response = requests.post(
-            f"{FASTCHAT_HOST}{API_PREFIX}",
-            json=fastchat_payload,
-            timeout=60
-        )
+        # Answer repeated questions from the response cache
+        cache_key = get_chat_cache_key(data, fastchat_payload)
+        cached_response = response_cache.get(cache_key) if cache_key else None
+        streaming = data.get('stream') or request.accept_mimetypes.best == 'text/event-stream'
         
-        if fastchat_response.status_code == 200:
-            response_data = fastchat_response.json()
-            assistant_message = response_data['choices'][0]['message']['content']
-            return jsonify({"response": assistant_message})
-        else:
-            print(f"FastChat error: {fastchat_response.status_code} - {fastchat_response.text}")
-            return jsonify({"error": f"Error from FastChat: {fastchat_response.text}"}), 500
+        # Stream tokens as they are generated if the app asks for it
+        if streaming:
+            if cached_response is not None:
+                events = stream_cached_chat(cached_response, sources)
+            else:
+                # Open the upstream stream now, while an error can still change the status code
+                events = stream_chat(fastchat_payload, cache_key, sources)
+                next(events)
+                events = stream_with_context(events)
+            return Response(
+                events,
+                mimetype='text/event-stream',
+                headers=dict(context_headers, **{"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+            )
+        
+        if cached_response is not None:
+            result = {"response": cached_response}
+            if sources:
+                result["sources"] = sources
+            response = jsonify(result)
+            response.headers["X-Cache"] = "HIT"
+            response.headers.update(context_headers)
+            return response
+        
+        # Send request to FastChat
+        started = time.time()
+        with fastchat.post(API_PREFIX, fastchat_payload) as fastchat_response:
+            total_time = time.time() - started
+            
+            if fastchat_response.status_code == 200:
+                response_data = fastchat_response.json()
+                assistant_message = response_data['choices'][0]['message']['content']
+                
+                # Without streaming the first token arrives with the whole answer
+                record_chat_timing(False, total_time, total_time)
+                if cache_key:
+                    response_cache.put(cache_key, assistant_message)
+                result = {"response": assistant_message}
+                if sources:
+                    result["sources"] = sources
+                response = jsonify(result)
+                response.headers["X-Cache"] = "MISS" if cache_key else "BYPASS"
+                response.headers["X-Time-To-First-Token-Ms"] = str(round(total_time * 1000, 1))
+                response.headers.update(context_headers)
+                return response
+            else:
+                print(f"FastChat error: {fastchat_response.status_code} - {fastchat_response.text}")
+                return jsonify({"error": f"Error from FastChat: {fastchat_response.text}"}), 500
             
+    except UpstreamBusyError as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "5"}
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/chat_metrics', methods=['GET'])
+def get_chat_metrics():
+    """Report chat latency, including time to first token"""
+    with chat_metrics_lock:
+        return jsonify({
+            "requests": chat_metrics["requests"],
+            "streaming_requests": chat_metrics["streaming_requests"],
+            "time_to_first_token": summarize_samples(list(chat_metrics["time_to_first_token"])),
+            "total_time": summarize_samples(list(chat_metrics["total_time"])),
+            "upstream": fastchat.stats(),
+            "cache": response_cache.stats(),
+            "history": history_manager.stats(),
+            "retrieval": document_processor.vector_index.stats(),
+        })
+
+@app.route('/backends', methods=['GET'])
+def get_backends():
+    """Report each FastChat backend's health, circuit state, in-flight requests and latency"""
+    return jsonify({"backends": fastchat.backend_stats()})
+
+@app.route('/rate_limits', methods=['GET'])
+def get_rate_limits():
+    """Report every admission policy's limits, requests in flight and admit/reject counts"""
+    return jsonify({
+        "policies": admission.stats(),
+        "shedding": {
+            "chat_waiting": fastchat.waiting,
+            "chat_queue_threshold": CHAT_SHED_QUEUE_DEPTH,
+            "chat_latency_seconds": round(fastchat.recent_latency(), 3),
+            "chat_latency_threshold_seconds": CHAT_SHED_LATENCY,
+            "document_queue_depth": document_processor.document_queue.qsize(),
+            "document_queue_threshold": UPLOAD_SHED_QUEUE_DEPTH,
+        }
+    })
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose counters and latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def require_admin(view):
+    """Hide a debugging route unless ADMIN_TOKEN is set, then require it in the X-Admin-Token header"""
+    @functools.wraps(view)
+    def guarded(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Not found"}), 404
+        if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+            return jsonify({"error": "Admin token required"}), 403
+        return view(*args, **kwargs)
+    return guarded
+
+@app.route('/traces', methods=['GET'])
+@require_admin
+def get_traces():
+    """List the most recent traced requests and jobs with their spans"""
+    try:
+        limit = min(max(1, int(request.args.get('limit', 50))), metrics.TRACE_HISTORY)
+        return jsonify({"tracing_enabled": metrics.TRACING_ENABLED, "traces": metrics.get_recent_traces(limit)})
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+@app.route('/profiler/start', methods=['POST'])
+@require_admin
+def start_profiler():
+    """Start sampling every thread's stack (seconds, interval_ms)"""
+    try:
+        data = request.get_json(silent=True) or request.args
+        seconds = float(data.get('seconds', 30))
+        interval = float(data.get('interval_ms', 10)) / 1000
+        if not (math.isfinite(seconds) and math.isfinite(interval)):
+            raise ValueError("not a finite number")
+        if not metrics.profiler.start(seconds, interval):
+            return jsonify({"error": "The profiler is already running"}), 409
+        return jsonify({"success": True, "seconds": min(seconds, metrics.PROFILER_MAX_SECONDS)})
+        
+    except ValueError:
+        return jsonify({"error": "Invalid seconds or interval_ms"}), 400
+
+@app.route('/profiler/stop', methods=['POST'])
+@require_admin
+def stop_profiler():
+    """Stop the profiler early and return what it sampled"""
+    metrics.profiler.stop()
+    return jsonify(metrics.profiler.report())
+
+@app.route('/profiler', methods=['GET'])
+@require_admin
+def get_profile():
+    """Get the last profile: the top stacks, or ?format=collapsed for flame graph tools"""
+    if request.args.get('format') == 'collapsed':
+        return Response(metrics.profiler.collapsed(), mimetype='text/plain')
+    try:
+        return jsonify(metrics.profiler.report(min(max(1, int(request.args.get('limit', 50))), 1000)))
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
 @app.route('/process_document', methods=['POST'])
 def process_document():
     """Handle document upload and processing by forwarding to the document processor"""
     try:
-        # Check if file is in the request
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
-            
-        file = request.files['file']
-        
-        # Process the document upload using the document processor module
-        result, status_code = document_processor.handle_document_upload(file, request.form, NGROK_URL)
+        # The body is parsed as it streams in, so the file never sits in memory or a temp file
+        result, status_code = document_processor.handle_document_upload(
+            request.stream, request.content_type, NGROK_URL
+        )
         
         return jsonify(result), status_code
         
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"Upload is larger than the {upload_ingest.UPLOAD_MAX_BYTES // upload_ingest.MB} MB limit"}), 413
     except Exception as e:
         print(f"Error processing document upload: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/process_documents', methods=['POST'])
+def process_documents():
+    """Upload many documents in one request: several files in a form, ZIP archives, or a raw ZIP body"""
+    try:
+        # A batch may be larger than a single document
+        request.max_content_length = upload_ingest.BULK_UPLOAD_MAX_BYTES + upload_ingest.MB
+        result, status_code = document_processor.handle_bulk_upload(
+            request.stream, request.content_type, request.args, NGROK_URL
+        )
+        
+        return jsonify(result), status_code
+        
+    except RequestEntityTooLarge:
+        return jsonify({"error": f"Upload is larger than the {upload_ingest.BULK_UPLOAD_MAX_BYTES // upload_ingest.MB} MB limit"}), 413
+    except Exception as e:
+        print(f"Error processing bulk upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """Get the combined progress of a bulk upload"""
+    try:
+        result, status_code = document_processor.get_batch_data(batch_id)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error getting batch: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload"""
+    try:
+        data = request.get_json(silent=True) or request.form
+        result, status_code = document_processor.create_upload_session_data(data, NGROK_URL)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error creating upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    """Get the offset a resumable upload should continue from"""
+    try:
+        result, status_code = document_processor.get_upload_session_data(upload_id)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error getting upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def append_upload(upload_id):
+    """Append a chunk (the raw request body) to a resumable upload"""
+    try:
+        offset = request.headers.get('Upload-Offset', request.args.get('offset'))
+        result, status_code = document_processor.append_upload_data(upload_id, offset, request.stream)
+        return jsonify(result), status_code
+        
+    except RequestEntityTooLarge:
+        return jsonify({"error": "Chunk is too large"}), 413
+    except Exception as e:
+        print(f"Error appending to upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/uploads/<upload_id>/commit', methods=['POST'])
+def commit_upload(upload_id):
+    """Finish a resumable upload and queue the document for processing"""
+    try:
+        data = request.get_json(silent=True) or {}
+        result, status_code = document_processor.commit_upload_data(upload_id, data.get('sha256'), NGROK_URL)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error committing upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def abort_upload(upload_id):
+    """Cancel a resumable upload"""
+    try:
+        result, status_code = document_processor.abort_upload_data(upload_id)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error aborting upload: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/document_status', methods=['GET', 'POST'])
+def get_document_statuses():
+    """Get the status of many documents at once: doc_ids (list or comma separated) and/or user_id"""
+    try:
+        args = request.args
+        if request.method == 'POST':
+            args = request.get_json(silent=True) or request.args
+        result, status_code = document_processor.get_document_statuses_data(args)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error getting document statuses: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+def stream_document_events(doc_ids, user_id, cursor):
+    """Relay document status changes as server-sent events, starting with a snapshot if there is no cursor"""
+    board = document_processor.document_status
+    deadline = time.time() + STATUS_STREAM_SECONDS
+    yield "retry: 2000\n\n"
+    
+    resync = cursor is None
+    while True:
+        # New clients, and ones too far behind, get the current statuses first
+        if resync:
+            snapshot, _ = document_processor.get_document_statuses_data({"doc_ids": doc_ids, "user_id": user_id})
+            cursor = snapshot.get("cursor", board.seq)
+            yield f"id: {cursor}\nevent: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+        
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        events, cursor, resync = board.wait(cursor, min(STATUS_KEEPALIVE_SECONDS, remaining), doc_ids, user_id)
+        for event in events:
+            yield f"id: {event['seq']}\ndata: {json.dumps(event)}\n\n"
+        if not events and not resync:
+            yield ": keepalive\n\n"
+
+@app.route('/document_events', methods=['GET'])
+def document_events():
+    """Push status changes of documents (doc_ids and/or user_id) as server-sent events"""
+    try:
+        doc_ids, user_id = document_processor.get_status_filter(request.args)
+        cursor, _ = document_processor.parse_status_wait(request.args, request.headers.get('Last-Event-ID'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return Response(
+        stream_with_context(stream_document_events(doc_ids, user_id, cursor)),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/document_events/poll', methods=['GET'])
+def poll_document_events():
+    """Long-poll for status changes after a cursor (doc_ids and/or user_id, timeout up to 60 s)"""
+    try:
+        result, status_code = document_processor.wait_document_events_data(request.args)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error polling document events: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/document_status/<doc_id>', methods=['GET'])
 def get_document_status(doc_id):
     """Get the processing status of a document"""
@@ -247,19 +1057,128 @@ def get_document_status(doc_id):
 def get_document_text(doc_id):
     """Get the extracted text of a document"""
     try:
-        result, status_code = document_processor.get_document_text_data(doc_id)
+        result, status_code = document_processor.get_document_text_data(doc_id, request.args)
         return jsonify(result), status_code
         
     except Exception as e:
         print(f"Error getting document text: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+def send_text_store(text_file):
+    """Send a compressed text file as plain text, with the same ETag, caching and Range support as send_file"""
+    text = text_store.open_text(text_file)
+    stat = os.stat(text_file)
+    response = Response(
+        text_store.TextStream(text), mimetype='text/plain; charset=utf-8', direct_passthrough=True
+    )
+    response.content_length = text.total_bytes
+    response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    response.last_modified = stat.st_mtime
+    response.cache_control.public = True
+    response.cache_control.max_age = TEXT_CACHE_MAX_AGE
+    return response.make_conditional(request, accept_ranges=True, complete_length=text.total_bytes)
+
+@app.route('/document_text/<doc_id>/raw', methods=['GET'])
+def get_document_text_raw(doc_id):
+    """Stream the extracted text file with Range, ETag and Last-Modified support"""
+    try:
+        text_file, error = document_processor.get_document_text_path(doc_id)
+        if error:
+            result, status_code = error
+            return jsonify(result), status_code
+        
+        # Compressed text is decompressed as it streams; a Range only decompresses the blocks it covers
+        if text_store.is_text_store(text_file):
+            return send_text_store(text_file)
+        
+        # conditional=True handles If-None-Match/If-Modified-Since and Range (206) requests;
+        # the body is streamed through the server's file wrapper (sendfile where available)
+        return send_file(
+            os.path.abspath(text_file),
+            mimetype='text/plain; charset=utf-8',
+            conditional=True,
+            etag=True,
+            max_age=TEXT_CACHE_MAX_AGE
+        )
+        
+    except Exception as e:
+        print(f"Error getting document text: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/document/<doc_id>', methods=['DELETE'])
+def delete_document(doc_id):
+    """Delete a document and, once unshared, its extracted files"""
+    try:
+        result, status_code = document_processor.delete_document_data(doc_id)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error deleting document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/document/<doc_id>/retry', methods=['POST'])
+def retry_document(doc_id):
+    """Process a failed document again"""
+    try:
+        result, status_code = document_processor.retry_document_data(doc_id)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error retrying document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/search', methods=['GET'])
+def search_documents():
+    """Search document text and metadata (q, category, tags, user_id, page, per_page)"""
+    try:
+        result, status_code = document_processor.search_documents_data(request.args)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error searching documents: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/documents', methods=['GET'])
+def list_documents():
+    """List documents, optionally filtered by user_id, category and status"""
+    try:
+        result, status_code = document_processor.list_documents_data(request.args)
+        return jsonify(result), status_code
+        
+    except Exception as e:
+        print(f"Error listing documents: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/processing_stats', methods=['GET'])
+def get_processing_stats():
+    """Get document queue depth and per-worker utilization"""
+    return jsonify(document_processor.get_processing_stats())
+
 @app.route('/document_image/<filename>', methods=['GET'])
 def get_document_image(filename):
     """Get a document image"""
     try:
-        image_path = document_processor.get_image_path(filename)
-        return send_from_directory(os.path.dirname(image_path), os.path.basename(image_path))
+        # ?w= picks a resized variant (thumb, small, preview, large or a pixel width)
+        image_path = document_processor.get_image_variant_path(
+            filename,
+            request.args.get('w'),
+            'image/webp' in request.headers.get('Accept', '')
+        )
+        response = send_from_directory(
+            os.path.abspath(os.path.dirname(image_path)),
+            os.path.basename(image_path),
+            conditional=True,
+            etag=True,
+            max_age=IMAGE_CACHE_MAX_AGE
+        )
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        if request.args.get('w'):
+            response.vary.add('Accept')
+        return response
+        
+    except ValueError:
+        return jsonify({"error": "Invalid image width"}), 400
     except Exception as e:
         print(f"Error getting document image: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -269,23 +1188,27 @@ if __name__ == '__main__':
     print("This server connects your Flutter app to the FastChat model and handles document processing")
     
     # Get ngrok auth token from command line
-    if len(sys.argv) > 1:
-        NGROK_AUTH_TOKEN = sys.argv[1]
+    args = [arg for arg in sys.argv[1:] if arg != '--fast']
+    if args:
+        NGROK_AUTH_TOKEN = args[0]
     else:
-        print("Usage: python flask_api.py <ngrok_auth_token>")
+        print("Usage: python flask_api.py [--fast] <ngrok_auth_token>")
         sys.exit(1)
     
-    # Start FastChat in the background
+    # Start FastChat in the background; /ready reports when it can answer
     fastchat_thread = threading.Thread(target=setup_fastchat)
     fastchat_thread.daemon = True
     fastchat_thread.start()
     
+    # Probe the FastChat backends so unhealthy ones leave (and rejoin) the rotation
+    fastchat.start_health_checks()
+    
     # Start document processing 
     document_processor.start_document_processing()
     
-    # Wait for FastChat to initialize (can be adjusted)
-    print("Waiting for FastChat to initialize...")
-    time.sleep(10)
+    # Requests arrive through the ngrok agent, so their address is the one it forwards
+    if 'RATE_LIMIT_TRUSTED_PROXIES' not in os.environ:
+        RATE_LIMIT_TRUSTED_PROXIES = 1
     
     # Start ngrok with Flask port
     port = 5000
@@ -300,6 +1223,11 @@ if __name__ == '__main__':
         
         # Start Flask app
         print("Starting Flask server...")
-        app.run(host='0.0.0.0', port=port)
+        try:
+            app.run(host='0.0.0.0', port=port)
+        finally:
+            # Let queued documents finish before the pool goes away
+            document_processor.stop_document_processing()
+            response_cache.save()
     else:
         print("Failed to start ngrok. Exiting.") 
\ No newline at end of file
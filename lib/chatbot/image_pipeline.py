@@ -0,0 +1,212 @@
+import os
+import io
+import shutil
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+import metrics
+
+# Named variant widths; numeric ?w= values are rounded up to the nearest of these
+VARIANT_SIZES = {'thumb': 160, 'small': 320, 'preview': 640, 'large': 1280}
+VARIANT_WIDTHS = sorted(VARIANT_SIZES.values())
+
+# Disk budget of the variant cache, trimmed least-recently-used first
+VARIANT_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_VARIANT_CACHE_MB', 512)) * 1024 * 1024
+VARIANT_QUALITY = 80
+
+# Image formats kept byte-for-byte; anything else is converted to PNG
+PASSTHROUGH_FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
+COLOR_MODES = {'/DeviceRGB': 'RGB', '/DeviceGray': 'L', '/DeviceCMYK': 'CMYK'}
+
+def get_pdf_filters(xobject):
+    """Get the list of stream filters on a PDF object"""
+    filters = xobject.get('/Filter')
+    if filters is None:
+        return []
+    if isinstance(filters, list):
+        return [str(f) for f in filters]
+    return [str(filters)]
+
+def encode_png(img):
+    """Get the PNG bytes of an image, in a mode PNG (and the app's decoder) can hold"""
+    if img.mode not in ('1', 'L', 'LA', 'I;16', 'P', 'RGB', 'RGBA'):
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+def pdf_image_to_file(xobject):
+    """Get (extension, bytes) for a PDF image XObject, keeping JPEG data as it is and making the rest PNG"""
+    filters = get_pdf_filters(xobject)
+
+    # get_data() undoes the other filters but leaves JPEG streams encoded
+    if filters and filters[-1] == '/DCTDecode':
+        return 'jpg', xobject.get_data()
+    if filters and filters[-1] == '/JPXDecode':
+        # The app can't display JPEG 2000
+        with Image.open(io.BytesIO(xobject.get_data())) as img:
+            return 'png', encode_png(img)
+
+    # Raw pixels: rebuild the image and store it losslessly
+    width, height = int(xobject['/Width']), int(xobject['/Height'])
+    data = xobject.get_data()
+    color_space = xobject.get('/ColorSpace')
+    color_space = color_space.get_object() if color_space is not None else '/DeviceRGB'
+
+    if isinstance(color_space, list) and color_space[0] == '/Indexed':
+        base = color_space[1].get_object()
+        lookup = color_space[3].get_object()
+        lookup = lookup.get_data() if hasattr(lookup, 'get_data') else bytes(lookup)
+        img = Image.frombytes('P', (width, height), data)
+        if base == '/DeviceGray':
+            lookup = b"".join(lookup[i:i + 1] * 3 for i in range(len(lookup)))
+        img.putpalette(lookup)
+    elif int(xobject.get('/BitsPerComponent', 8)) == 1:
+        img = Image.frombytes('1', (width, height), data)
+    else:
+        if isinstance(color_space, list):
+            # ICCBased and friends: fall back on the component count
+            color_space = {1: '/DeviceGray', 3: '/DeviceRGB', 4: '/DeviceCMYK'}.get(
+                len(data) // max(1, width * height), '/DeviceRGB'
+            )
+        img = Image.frombytes(COLOR_MODES.get(color_space, 'RGB'), (width, height), data)
+
+    return 'png', encode_png(img)
+
+def store_image_file(src_path, dest_dir, name):
+    """Store an uploaded image under its real format, copying already-compressed files as they are"""
+    with Image.open(src_path) as img:
+        image_format = img.format
+        if image_format in PASSTHROUGH_FORMATS:
+            filename = f"{name}.{PASSTHROUGH_FORMATS[image_format]}"
+            shutil.copyfile(src_path, os.path.join(dest_dir, filename))
+        else:
+            filename = f"{name}.png"
+            with open(os.path.join(dest_dir, filename), 'wb') as f:
+                f.write(encode_png(img))
+    return filename
+
+def resolve_variant_width(value):
+    """Map a ?w= value (a size name or pixel width) to one of the cached widths; None for the original"""
+    if value in (None, '', 'full'):
+        return None
+    if value in VARIANT_SIZES:
+        return VARIANT_SIZES[value]
+    width = int(value)
+    for allowed in VARIANT_WIDTHS:
+        if width <= allowed:
+            return allowed
+    return None
+
+class VariantCache:
+    """On-demand resized copies of images, kept on disk under an LRU byte budget"""
+
+    def __init__(self, folder, max_bytes=VARIANT_CACHE_MAX_BYTES):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.entries = None
+        self.size_bytes = 0
+        self.counters = {"hits": 0, "generated": 0, "evicted": 0}
+
+    def _load(self):
+        """Scan existing variants, oldest first (called with the lock held)"""
+        if self.entries is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        files = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(files))
+        self.size_bytes = sum(self.entries.values())
+
+    def _evict(self):
+        """Drop least recently used variants until the cache fits its budget (lock held)"""
+        while self.size_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size_bytes -= size
+            self.counters["evicted"] += 1
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+
+    def get(self, source_path, width, image_format):
+        """Get the path of a variant, generating it on first request"""
+        stem = os.path.splitext(os.path.basename(source_path))[0]
+        ext = 'webp' if image_format == 'WEBP' else 'jpg'
+        name = f"{stem}_{width}.{ext}"
+        path = os.path.join(self.folder, name)
+
+        with self.lock:
+            self._load()
+            if name in self.entries and os.path.exists(path):
+                self.entries.move_to_end(name)
+                self.counters["hits"] += 1
+                # Keep recency across restarts
+                os.utime(path)
+                return path
+            key_lock = self.key_locks.setdefault(name, threading.Lock())
+
+        # One thread generates a given variant; others wait for it
+        with key_lock:
+            generated = not os.path.exists(path)
+            if generated:
+                with metrics.span('image_variant'):
+                    self._generate(source_path, path, width, image_format)
+            size = os.path.getsize(path)
+            if generated:
+                metrics.bytes_written.inc(size, folder='images')
+            with self.lock:
+                if name not in self.entries:
+                    self.entries[name] = size
+                    self.size_bytes += size
+                    self.counters["generated"] += 1
+                self.key_locks.pop(name, None)
+                self._evict()
+        return path
+
+    def _generate(self, source_path, path, width, image_format):
+        with Image.open(source_path) as img:
+            # Let the JPEG decoder downscale while decoding
+            img.draft('RGB', (width, width * 4))
+            img.thumbnail((width, max(1, width * img.height // max(1, img.width))), Image.LANCZOS)
+            if image_format == 'JPEG' or img.mode not in ('RGB', 'RGBA'):
+                if img.mode in ('RGBA', 'LA', 'P'):
+                    img = img.convert('RGBA')
+                    background = Image.new('RGB', img.size, (255, 255, 255))
+                    background.paste(img, mask=img.split()[-1])
+                    img = background
+                else:
+                    img = img.convert('RGB')
+            tmp_path = path + '.tmp'
+            img.save(tmp_path, format=image_format, quality=VARIANT_QUALITY)
+        os.replace(tmp_path, path)
+
+    def remove_variants(self, filename):
+        """Delete every cached variant of an image"""
+        stem = os.path.splitext(filename)[0]
+        with self.lock:
+            self._load()
+            for name in [n for n in self.entries if n.rsplit('_', 1)[0] == stem]:
+                self.size_bytes -= self.entries.pop(name)
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                variants=len(self.entries) if self.entries is not None else None,
+                size_bytes=self.size_bytes,
+                max_bytes=self.max_bytes
+            )
@@ -0,0 +1,231 @@
+import os
+import time
+import random
+import socket
+import sqlite3
+import threading
+
+# Attempts a job gets before it is dead-lettered, and the retry backoff
+JOB_MAX_ATTEMPTS = int(os.environ.get('DOC_JOB_MAX_ATTEMPTS', 4))
+JOB_RETRY_BASE_SECONDS = float(os.environ.get('DOC_JOB_RETRY_BASE_SECONDS', 5))
+JOB_RETRY_MAX_SECONDS = 600
+
+# A running job whose lease is not renewed within this time is handed out again
+JOB_LEASE_SECONDS = int(os.environ.get('DOC_JOB_LEASE_SECONDS', 300))
+
+# Job states: queued -> running -> completed, or back to retrying/queued, or dead
+ACTIVE_STATES = ('queued', 'running', 'retrying')
+
+JOB_COLUMNS = "doc_id, user_id, priority, cost, state, attempts, last_error, enqueued_at, next_attempt_at"
+
+def get_owner_name():
+    """Identify this server process in job leases"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def is_owner_alive(owner):
+    """Check whether the process holding a lease still runs (only knowable on this host)"""
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def get_retry_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    delay = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** max(0, attempts - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+class JobJournal:
+    """Durable record of document processing jobs, so queued and running work survives restarts"""
+
+    def __init__(self, path, owner=None, max_attempts=JOB_MAX_ATTEMPTS, lease_seconds=JOB_LEASE_SECONDS):
+        self.path = path
+        self.owner = owner or get_owner_name()
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.local = threading.local()
+
+    def _conn(self):
+        """Get this thread's connection, creating the table on first use (connections can't be shared across threads)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "doc_id TEXT PRIMARY KEY, user_id TEXT NOT NULL DEFAULT '', "
+                "priority INTEGER NOT NULL, cost REAL NOT NULL, state TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, last_error TEXT, "
+                "lease_owner TEXT, lease_expires REAL, "
+                "enqueued_at REAL NOT NULL, next_attempt_at REAL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state)")
+            self.local.conn = conn
+        return conn
+
+    def _job(self, row):
+        return dict(zip([c.strip() for c in JOB_COLUMNS.split(',')], row))
+
+    def enqueue(self, doc_id, user_id, priority, cost):
+        """Record a job as queued; a finished or dead job starts over. False if it is already active"""
+        return self.enqueue_many([(doc_id, user_id, priority, cost)]) == 1
+
+    def enqueue_many(self, jobs):
+        """Record a group of jobs ((doc_id, user_id, priority, cost) each) in one transaction; returns how many were queued"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = 0
+            for doc_id, user_id, priority, cost in jobs:
+                updated += conn.execute(
+                    "INSERT INTO jobs (doc_id, user_id, priority, cost, state, attempts, enqueued_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', 0, ?, ?) "
+                    "ON CONFLICT(doc_id) DO UPDATE SET state = 'queued', attempts = 0, last_error = NULL, "
+                    "priority = excluded.priority, cost = excluded.cost, enqueued_at = excluded.enqueued_at, "
+                    "next_attempt_at = NULL, lease_owner = NULL, lease_expires = NULL, updated_at = excluded.updated_at "
+                    "WHERE jobs.state NOT IN ('queued', 'running', 'retrying')",
+                    (doc_id, user_id or '', priority, cost, now, now)
+                ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return updated
+
+    def start(self, doc_id):
+        """Lease a queued job to this process; returns the attempt number, or None if it isn't queued"""
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            updated = conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, "
+                "lease_expires = ?, updated_at = ? WHERE doc_id = ? AND state = 'queued'",
+                (self.owner, now + self.lease_seconds, now, doc_id)
+            ).rowcount
+            row = conn.execute("SELECT attempts FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row[0] if updated else None
+
+    def renew(self):
+        """Extend the leases of every job this process is running"""
+        now = time.time()
+        return self._conn().execute(
+            "UPDATE jobs SET lease_expires = ? WHERE state = 'running' AND lease_owner = ?",
+            (now + self.lease_seconds, self.owner)
+        ).rowcount
+
+    def complete(self, doc_id):
+        """Mark a job as finished"""
+        self._conn().execute(
+            "UPDATE jobs SET state = 'completed', last_error = NULL, lease_owner = NULL, "
+            "lease_expires = NULL, updated_at = ? WHERE doc_id = ?",
+            (time.time(), doc_id)
+        )
+
+    def fail(self, doc_id, error, transient):
+        """Record a failed attempt; returns (state, retry delay). Transient errors are retried with backoff"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT attempts FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None, None
+            attempts = row[0]
+            now = time.time()
+            if transient and attempts < self.max_attempts:
+                state, delay = 'retrying', get_retry_delay(attempts)
+            else:
+                state, delay = 'dead', None
+            conn.execute(
+                "UPDATE jobs SET state = ?, last_error = ?, next_attempt_at = ?, lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? WHERE doc_id = ?",
+                (state, str(error)[:2000], now + delay if delay else None, now, doc_id)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return state, delay
+
+    def _requeue(self, where, params, lost_error=None):
+        """Move matching jobs back to queued and return them.
+
+        With lost_error (their process died mid-job), jobs that already used every attempt are
+        dead-lettered with that error instead, so a document that keeps killing its worker is
+        not handed out forever; they are returned too, in state 'dead'.
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(f"SELECT {JOB_COLUMNS}, lease_owner FROM jobs WHERE {where}", params).fetchall()
+            now = time.time()
+            jobs = []
+            for row in rows:
+                job = self._job(row[:-1])
+                if lost_error and job["attempts"] >= self.max_attempts:
+                    job.update(state='dead', last_error=lost_error)
+                else:
+                    job.update(state='queued', next_attempt_at=None)
+                conn.execute(
+                    "UPDATE jobs SET state = ?, last_error = ?, next_attempt_at = NULL, lease_owner = NULL, "
+                    "lease_expires = NULL, updated_at = ? WHERE doc_id = ?",
+                    (job["state"], job["last_error"], now, job["doc_id"])
+                )
+                jobs.append(job)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return jobs
+
+    def due_retries(self):
+        """Jobs whose backoff has elapsed, moved back to queued"""
+        return self._requeue("state = 'retrying' AND next_attempt_at <= ?", (time.time(),))
+
+    def reclaim_expired(self):
+        """Running jobs whose lease ran out (their process hung or died), moved back to queued or dead-lettered"""
+        return self._requeue("state = 'running' AND lease_expires < ?", (time.time(),), "lease lost")
+
+    def recover(self):
+        """At startup: requeue jobs held by processes that no longer exist.
+
+        Returns the jobs this dead-lettered (out of attempts), then every queued job.
+        """
+        rows = self._conn().execute(
+            "SELECT DISTINCT lease_owner FROM jobs WHERE state = 'running' AND lease_owner IS NOT NULL"
+        ).fetchall()
+        dead = []
+        for (owner,) in rows:
+            if owner == self.owner or not is_owner_alive(owner):
+                jobs = self._requeue("state = 'running' AND lease_owner = ?", (owner,), "lease lost")
+                dead.extend(job for job in jobs if job["state"] == 'dead')
+        return dead + [
+            self._job(row) for row in self._conn().execute(
+                f"SELECT {JOB_COLUMNS} FROM jobs WHERE state = 'queued' ORDER BY enqueued_at"
+            )
+        ]
+
+    def get(self, doc_id):
+        row = self._conn().execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE doc_id = ?", (doc_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def remove(self, doc_id):
+        """Forget a job (its document was deleted)"""
+        self._conn().execute("DELETE FROM jobs WHERE doc_id = ?", (doc_id,))
+
+    def stats(self):
+        """Count jobs per state"""
+        counts = dict(self._conn().execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {state: counts.get(state, 0) for state in ACTIVE_STATES + ('completed', 'dead')}
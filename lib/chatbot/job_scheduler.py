@@ -0,0 +1,260 @@
+import os
+import time
+import heapq
+import threading
+from collections import deque
+from queue import Empty
+
+# Priority classes, served in this order (lower first)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_NORMAL: "normal", PRIORITY_BULK: "bulk"}
+
+# A job waiting this long is promoted one class, so bulk work is never starved
+PRIORITY_AGING_SECONDS = float(os.environ.get('DOC_SCHEDULER_AGING_SECONDS', 120))
+
+class FairScheduler:
+    """Drop-in replacement for the FIFO document queue: priority classes, fair share between users.
+
+    Within a class, users take turns in proportion to the work they have been given (start-time
+    fair queuing on each job's cost), so one user's bulk upload cannot hold up everyone else.
+    """
+
+    def __init__(self, aging_seconds=PRIORITY_AGING_SECONDS):
+        self.aging_seconds = aging_seconds
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.all_done = threading.Condition(self.lock)
+
+        # doc_id -> job; a user's jobs keep their arrival order
+        self.jobs = {}
+        self.running = set()
+        self.stop_signals = 0
+        self.unfinished = 0
+        self.seq = 0
+
+        # Fair-share clocks: the global virtual time and where each user's last job finished
+        self.virtual_time = 0.0
+        self.user_finish = {}
+
+        # Cached dispatch order, valid until the next change or the next time a queued job ages up a class
+        self.order_cache = None
+        self.order_expires = 0.0
+        self.recent_waits = deque(maxlen=500)
+        self.counters = {"enqueued": 0, "deduplicated": 0, "dispatched": 0, "promoted": 0}
+
+    def put(self, doc_id, user_id='', priority=PRIORITY_NORMAL, cost=1.0, enqueued_at=None):
+        """Queue a document; returns False if it is already queued or running"""
+        with self.lock:
+            # None is the worker stop signal, handed out once no real work is left
+            if doc_id is None:
+                self.stop_signals += 1
+                self.unfinished += 1
+                self.not_empty.notify()
+                return True
+
+            added = self._add(doc_id, user_id, priority, cost, enqueued_at)
+            if added:
+                self.not_empty.notify()
+            return added
+
+    def put_many(self, jobs):
+        """Queue a group of documents ((doc_id, user_id, priority, cost) each) at once; returns how many were added"""
+        with self.lock:
+            added = sum(1 for doc_id, user_id, priority, cost in jobs if self._add(doc_id, user_id, priority, cost))
+            if added:
+                self.not_empty.notify_all()
+            return added
+
+    def _add(self, doc_id, user_id, priority, cost, enqueued_at=None):
+        """Add one job unless it is already queued or running (lock held)"""
+        if doc_id in self.jobs or doc_id in self.running:
+            self.counters["deduplicated"] += 1
+            return False
+
+        self.seq += 1
+        self.jobs[doc_id] = {
+            "doc_id": doc_id,
+            "user_id": user_id or '',
+            "priority": priority,
+            "cost": max(float(cost), 1e-3),
+            "seq": self.seq,
+            "enqueued_at": enqueued_at or time.time(),
+        }
+        self.unfinished += 1
+        self.counters["enqueued"] += 1
+        self.order_cache = None
+        return True
+
+    def _effective_priority(self, job, now):
+        waited = now - job["enqueued_at"]
+        if self.aging_seconds <= 0:
+            return job["priority"]
+        return max(PRIORITY_INTERACTIVE, job["priority"] - int(waited // self.aging_seconds))
+
+    def _pick(self, jobs, virtual_time, user_finish, now):
+        """Choose the next job: best class, then the user furthest behind on their share, then arrival"""
+        best = None
+        best_key = None
+        for job in jobs:
+            start = max(virtual_time, user_finish.get(job["user_id"], 0.0))
+            key = (self._effective_priority(job, now), start, job["seq"])
+            if best_key is None or key < best_key:
+                best, best_key = job, key
+        return best, best_key[1]
+
+    def get(self, block=True, timeout=None):
+        """Take the next document id (or None, the stop signal)"""
+        with self.not_empty:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.jobs and not self.stop_signals:
+                if not block:
+                    raise Empty
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self.not_empty.wait(remaining)
+
+            if not self.jobs:
+                self.stop_signals -= 1
+                return None
+
+            now = time.time()
+            job, start = self._pick(self.jobs.values(), self.virtual_time, self.user_finish, now)
+            del self.jobs[job["doc_id"]]
+            self.running.add(job["doc_id"])
+
+            # Advance the clocks by the job's cost
+            self.virtual_time = start
+            self.user_finish[job["user_id"]] = start + job["cost"]
+            if not self.jobs:
+                # Drained queue: nobody is owed anything any more
+                self.user_finish.clear()
+                self.virtual_time = 0.0
+
+            if self._effective_priority(job, now) < job["priority"]:
+                self.counters["promoted"] += 1
+            self.counters["dispatched"] += 1
+            self.recent_waits.append(now - job["enqueued_at"])
+            self.order_cache = None
+            return job["doc_id"]
+
+    def task_done(self, doc_id=None):
+        """Mark a job taken with get() as finished"""
+        with self.lock:
+            if doc_id is not None:
+                self.running.discard(doc_id)
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.unfinished = 0
+                self.all_done.notify_all()
+
+    def join(self):
+        """Block until every queued job is finished"""
+        with self.all_done:
+            while self.unfinished:
+                self.all_done.wait()
+
+    def remove(self, doc_id):
+        """Take a queued (not yet running) document out of the queue"""
+        with self.lock:
+            if self.jobs.pop(doc_id, None) is None:
+                return False
+            self.order_cache = None
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                self.unfinished = 0
+                self.all_done.notify_all()
+            return True
+
+    def qsize(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def _dispatch_order(self):
+        """The order queued jobs would be dispatched in if nothing else arrived (lock held, cached)
+
+        Replays what get() would do in O(n log n): classes are served in turn, and within a class
+        a heap holds each user's oldest job keyed on (start, seq). Starts never fall below the
+        virtual time they were pushed at, so the heap minimum is always get()'s next pick.
+        """
+        now = time.time()
+        if self.order_cache is not None and now < self.order_expires:
+            return self.order_cache
+
+        # class -> user -> that user's jobs in arrival order
+        classes = {}
+        expires = float('inf')
+        for job in sorted(self.jobs.values(), key=lambda job: job["seq"]):
+            priority = self._effective_priority(job, now)
+            classes.setdefault(priority, {}).setdefault(job["user_id"], deque()).append(job)
+            if priority > PRIORITY_INTERACTIVE and self.aging_seconds > 0:
+                # The order changes when this job is next promoted
+                waited = now - job["enqueued_at"]
+                expires = min(expires, job["enqueued_at"] + (waited // self.aging_seconds + 1) * self.aging_seconds)
+
+        virtual_time = self.virtual_time
+        user_finish = dict(self.user_finish)
+        order = {}
+        for priority in sorted(classes):
+            users = classes[priority]
+            heap = [
+                (max(virtual_time, user_finish.get(user_id, 0.0)), queue[0]["seq"], user_id)
+                for user_id, queue in users.items()
+            ]
+            heapq.heapify(heap)
+            while heap:
+                start, _, user_id = heapq.heappop(heap)
+                job = users[user_id].popleft()
+                virtual_time = start
+                user_finish[user_id] = start + job["cost"]
+                order[job["doc_id"]] = len(order) + 1
+                if users[user_id]:
+                    heapq.heappush(heap, (user_finish[user_id], users[user_id][0]["seq"], user_id))
+
+        self.order_cache = order
+        self.order_expires = expires
+        return order
+
+    def position(self, doc_id):
+        """Get (1-based queue position, seconds waited, priority name) of a queued document, or None"""
+        with self.lock:
+            job = self.jobs.get(doc_id)
+            if job is None:
+                return None
+            return (
+                self._dispatch_order()[doc_id],
+                round(time.time() - job["enqueued_at"], 3),
+                PRIORITY_NAMES[job["priority"]],
+            )
+
+    def is_running(self, doc_id):
+        with self.lock:
+            return doc_id in self.running
+
+    def stats(self):
+        """Get queue depth per class and user, and recent wait times"""
+        with self.lock:
+            by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+            by_user = {}
+            for job in self.jobs.values():
+                by_priority[PRIORITY_NAMES[job["priority"]]] += 1
+                by_user[job["user_id"]] = by_user.get(job["user_id"], 0) + 1
+            waits = sorted(self.recent_waits)
+
+        def percentile(p):
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))], 3) if waits else 0.0
+
+        return dict(
+            self.counters,
+            depth=sum(by_priority.values()),
+            running=len(self.running),
+            by_priority=by_priority,
+            by_user=by_user,
+            wait_seconds_mean=round(sum(waits) / len(waits), 3) if waits else 0.0,
+            wait_seconds_p95=percentile(0.95),
+        )
@@ -0,0 +1,241 @@
+import os
+import json
+import sqlite3
+import threading
+
+# Fields pulled out of each document record so they can be indexed
+INDEXED_FIELDS = ('user_id', 'category', 'status')
+
+def get_indexed_values(doc):
+    """Get the indexed field values of a document record"""
+    metadata = doc.get('metadata', {})
+    return {
+        'user_id': metadata.get('user_id', ''),
+        'category': metadata.get('category', ''),
+        'status': doc.get('status', ''),
+    }
+
+class JsonMetadataStore:
+    """Legacy store keeping every document in one JSON file, rewritten atomically"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.documents = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.documents = json.load(f)
+            except Exception as e:
+                print(f"Error loading {path}: {str(e)}")
+
+    def _flush(self):
+        """Rewrite the JSON file via a temp file so readers never see half a file"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.documents, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, doc_id, default=None):
+        with self.lock:
+            doc = self.documents.get(doc_id)
+            return json.loads(json.dumps(doc)) if doc is not None else default
+
+    def put(self, doc_id, doc):
+        with self.lock:
+            self.documents[doc_id] = doc
+            self._flush()
+
+    def put_many(self, docs):
+        with self.lock:
+            self.documents.update(docs)
+            self._flush()
+
+    def delete(self, doc_id):
+        with self.lock:
+            if self.documents.pop(doc_id, None) is not None:
+                self._flush()
+
+    def query(self, limit=None, offset=0, **filters):
+        for field in filters:
+            if field not in INDEXED_FIELDS:
+                raise ValueError(f"Cannot filter on {field}")
+        end = None if limit is None else offset + limit
+        with self.lock:
+            matches = [
+                doc for doc in self.documents.values()
+                if all(get_indexed_values(doc)[k] == v for k, v in filters.items() if v is not None)
+            ]
+            # Copies, like the SQLite store: callers must not edit the records in place
+            return [json.loads(json.dumps(doc)) for doc in matches[offset:end]]
+
+    def __contains__(self, doc_id):
+        return doc_id in self.documents
+
+    def __getitem__(self, doc_id):
+        doc = self.get(doc_id)
+        if doc is None:
+            raise KeyError(doc_id)
+        return doc
+
+    def __setitem__(self, doc_id, doc):
+        self.put(doc_id, doc)
+
+    def __len__(self):
+        return len(self.documents)
+
+class SqliteMetadataStore:
+    """Document store in SQLite (WAL mode) with per-document upserts and field indexes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "doc_id TEXT PRIMARY KEY, user_id TEXT, category TEXT, status TEXT, data TEXT NOT NULL)"
+        )
+        for field in INDEXED_FIELDS:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_documents_{field} ON documents ({field})")
+        conn.commit()
+
+    def _conn(self):
+        """Get this thread's connection (SQLite connections can't be shared across threads)"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def _row(self, doc_id, doc):
+        values = get_indexed_values(doc)
+        return (doc_id, values['user_id'], values['category'], values['status'], json.dumps(doc))
+
+    def get(self, doc_id, default=None):
+        row = self._conn().execute("SELECT data FROM documents WHERE doc_id = ?", (doc_id,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, doc_id, doc):
+        self.put_many({doc_id: doc})
+
+    def put_many(self, docs):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT INTO documents (doc_id, user_id, category, status, data) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(doc_id) DO UPDATE SET user_id = excluded.user_id, "
+                "category = excluded.category, status = excluded.status, data = excluded.data",
+                [self._row(doc_id, doc) for doc_id, doc in docs.items()]
+            )
+
+    def delete(self, doc_id):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+
+    def query(self, limit=None, offset=0, **filters):
+        clauses = []
+        params = []
+        for field, value in filters.items():
+            if field not in INDEXED_FIELDS:
+                raise ValueError(f"Cannot filter on {field}")
+            if value is not None:
+                clauses.append(f"{field} = ?")
+                params.append(value)
+
+        sql = "SELECT data FROM documents"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY rowid LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        return [json.loads(row[0]) for row in self._conn().execute(sql, params)]
+
+    def __contains__(self, doc_id):
+        return self._conn().execute("SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def __getitem__(self, doc_id):
+        doc = self.get(doc_id)
+        if doc is None:
+            raise KeyError(doc_id)
+        return doc
+
+    def __setitem__(self, doc_id, doc):
+        self.put(doc_id, doc)
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+class LazyMetadataStore:
+    """Opens the real store on first use, so importing the server neither reads nor migrates metadata"""
+
+    def __init__(self, opener):
+        self.opener = opener
+        self.store = None
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.store is not None
+
+    def load(self):
+        """Open the store now (if not opened yet) and return it"""
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    self.store = self.opener()
+        return self.store
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.load()
+
+    def __getitem__(self, doc_id):
+        return self.load()[doc_id]
+
+    def __setitem__(self, doc_id, doc):
+        self.load()[doc_id] = doc
+
+    def __len__(self):
+        return len(self.load())
+
+def migrate_json_to_store(json_path, store):
+    """One-shot migration of the old documents_data.json into another store"""
+    with open(json_path, 'r') as f:
+        documents = json.load(f)
+
+    store.put_many(documents)
+
+    # Keep the old file around, but out of the way so it isn't migrated twice
+    os.replace(json_path, json_path + '.migrated')
+    print(f"Migrated {len(documents)} documents from {json_path}")
+    return len(documents)
+
+def open_metadata_store(backend, folder):
+    """Open the configured metadata store backend ('sqlite' or 'json')"""
+    os.makedirs(folder, exist_ok=True)
+    json_path = os.path.join(folder, 'documents_data.json')
+
+    if backend == 'json':
+        return JsonMetadataStore(json_path)
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown metadata backend: {backend}")
+
+    store = SqliteMetadataStore(os.path.join(folder, 'documents.db'))
+    if os.path.exists(json_path) and len(store) == 0:
+        try:
+            migrate_json_to_store(json_path, store)
+        except Exception as e:
+            print(f"Error migrating {json_path}: {str(e)}")
+    return store
+
+if __name__ == '__main__':
+    import sys
+
+    # Usage: python metadata_store.py [document_data folder]
+    folder = sys.argv[1] if len(sys.argv) > 1 else 'document_data'
+    store = open_metadata_store('sqlite', folder)
+    print(f"{len(store)} documents in {store.path}")
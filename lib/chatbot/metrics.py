@@ -0,0 +1,340 @@
+import os
+import sys
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+# Record spans of every request and job (a single request can ask with an X-Trace header)
+TRACING_ENABLED = os.environ.get('METRICS_TRACING', '0') == '1'
+
+# Latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+PAGE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Finished traces kept for /traces
+TRACE_HISTORY = 200
+
+# Longest a profiler run may last, and its sampling interval bounds
+PROFILER_MAX_SECONDS = 300
+PROFILER_MIN_INTERVAL = 0.001
+
+registry = []
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def format_labels(names, values, extra=None):
+    """Render a label set as {a="x",b="y"}"""
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') + '"'
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class Metric:
+    """A named metric with one value per label combination"""
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, None, value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.label_names, key, extra)} {format_value(value)}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+class GaugeCallback(Metric):
+    """A gauge read at scrape time from a function returning [(label values, value)]"""
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels, callback):
+        super().__init__(name, description, labels)
+        self.callback = callback
+
+    def samples(self):
+        try:
+            return [(self.name, tuple(str(v) for v in key), None, value) for key, value in self.callback()]
+        except Exception as e:
+            print(f"Error collecting metric {self.name}: {str(e)}")
+            return []
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                # Buckets are cumulative in the exposition format
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append((self.name + '_bucket', key, ('le', format_value(bound)), cumulative))
+                samples.append((self.name + '_bucket', key, ('le', '+Inf'), count))
+                samples.append((self.name + '_sum', key, None, total))
+                samples.append((self.name + '_count', key, None, count))
+        return samples
+
+def render():
+    """Render every metric in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+# HTTP and upstream latency
+http_request_seconds = Histogram(
+    'http_request_duration_seconds', 'Time to answer a request (to the first byte for streams)',
+    ('route', 'method', 'status')
+)
+fastchat_request_seconds = Histogram(
+    'fastchat_request_duration_seconds', 'FastChat response time (to the headers for streams)',
+    ('backend', 'path', 'status')
+)
+fastchat_errors = Counter(
+    'fastchat_errors_total', 'Failed FastChat requests by backend and kind', ('backend', 'path', 'kind')
+)
+chat_first_token_seconds = Histogram(
+    'chat_time_to_first_token_seconds', 'Time until the first answer token reached the app', ('streaming',)
+)
+chat_response_seconds = Histogram('chat_response_seconds', 'Time to produce a whole chat answer', ('streaming',))
+
+# Admission control: requests let in or turned away (rate_limited, concurrency, shed) per policy
+admission_decisions = Counter(
+    'admission_decisions_total', 'Requests admitted or rejected before running, by policy and outcome',
+    ('policy', 'outcome')
+)
+
+# Document processing
+document_job_seconds = Histogram(
+    'document_job_duration_seconds', 'Time to process a document', ('file_type', 'outcome')
+)
+document_page_seconds = Histogram(
+    'document_seconds_per_page', 'Processing time of a completed document divided by its pages',
+    ('file_type',), buckets=PAGE_BUCKETS
+)
+bytes_written = Counter('document_bytes_written_total', 'Bytes written under document_data/', ('folder',))
+
+# Hot-path stages, whether or not they are traced
+span_seconds = Histogram('span_duration_seconds', 'Time spent in instrumented stages', ('span',))
+
+process_start_time = Gauge('process_start_time_seconds', 'When this server started (unix time)')
+process_start_time.set(time.time())
+
+class Trace:
+    """Timed spans of one request or job"""
+
+    def __init__(self, name, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+        self.duration = None
+        self.spans = []
+
+    def add(self, name, offset, duration):
+        self.spans.append((name, offset, duration))
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started_perf
+
+    def server_timing(self):
+        """Format the spans as a Server-Timing header (repeated stages are summed)"""
+        totals = {}
+        for name, _, duration in self.spans:
+            totals[name] = totals.get(name, 0.0) + duration
+        parts = [f"{name};dur={duration * 1000:.1f}" for name, duration in totals.items()]
+        if self.duration is not None:
+            parts.append(f"total;dur={self.duration * 1000:.1f}")
+        return ", ".join(parts)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "attributes": self.attributes,
+            "started": self.started,
+            "duration_ms": round((self.duration or 0.0) * 1000, 2),
+            "spans": [
+                {"name": name, "offset_ms": round(offset * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+                for name, offset, duration in self.spans
+            ],
+        }
+
+recent_traces = collections.deque(maxlen=TRACE_HISTORY)
+_local = threading.local()
+
+def start_trace(name, **attributes):
+    """Start tracing the spans run on this thread"""
+    _local.trace = Trace(name, **attributes)
+    return _local.trace
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+def end_trace(**attributes):
+    """Finish this thread's trace, if any, and keep it for /traces"""
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return None
+    _local.trace = None
+    trace.attributes.update(attributes)
+    trace.finish()
+    recent_traces.append(trace)
+    return trace
+
+def get_recent_traces(limit=50):
+    return [trace.to_dict() for trace in list(recent_traces)[-limit:]][::-1]
+
+@contextmanager
+def span(name):
+    """Time a stage: always into span_duration_seconds, and into the current trace if there is one"""
+    trace = getattr(_local, 'trace', None)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        span_seconds.observe(duration, span=name)
+        if trace is not None:
+            trace.add(name, started - trace.started_perf, duration)
+
+class SamplingProfiler:
+    """Samples every thread's stack at an interval; switched on at runtime for a bounded time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.interval = 0.01
+        self.started_at = None
+        self.stopped_at = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds=30, interval=0.01):
+        """Start a profiling run; returns False if one is already going"""
+        with self.lock:
+            if self.is_running():
+                return False
+            self.stacks = collections.Counter()
+            self.samples = 0
+            self.interval = max(PROFILER_MIN_INTERVAL, interval)
+            self.started_at = time.time()
+            self.stopped_at = None
+            self.stop_event.clear()
+            deadline = self.started_at + min(max(seconds, 0.1), PROFILER_MAX_SECONDS)
+            self.thread = threading.Thread(target=self._run, args=(deadline,), daemon=True, name='profiler')
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self, deadline):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval) and time.time() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            sampled = []
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                sampled.append(";".join(reversed(stack)))
+            del frames
+            with self.lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+        self.stopped_at = time.time()
+
+    def report(self, limit=50):
+        """Summarize the last run: the most sampled stacks, root first"""
+        with self.lock:
+            total = sum(self.stacks.values())
+            top = self.stacks.most_common(limit)
+            return {
+                "running": self.is_running(),
+                "started_at": self.started_at,
+                "stopped_at": self.stopped_at,
+                "interval_ms": round(self.interval * 1000, 2),
+                "samples": self.samples,
+                "stacks": [
+                    {"stack": stack, "count": count, "percent": round(count / total * 100, 2)}
+                    for stack, count in top
+                ],
+            }
+
+    def collapsed(self):
+        """The samples in the collapsed-stack format read by flamegraph tools"""
+        with self.lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+profiler = SamplingProfiler()
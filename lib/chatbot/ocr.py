@@ -0,0 +1,192 @@
+import io
+import os
+import time
+import shutil
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageFilter, ImageOps
+
+# Engine: 'auto' picks the tesseract binary, then easyocr; 'none' turns OCR off
+OCR_ENGINE = os.environ.get('DOC_OCR_ENGINE', 'auto')
+TESSERACT_CMD = os.environ.get('TESSERACT_CMD', 'tesseract')
+OCR_LANG = os.environ.get('DOC_OCR_LANG', 'eng')
+
+# Concurrent OCR jobs, and how many more may wait before callers block
+OCR_WORKERS = int(os.environ.get('DOC_OCR_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+OCR_MAX_PENDING = OCR_WORKERS * 8
+OCR_TIMEOUT = int(os.environ.get('DOC_OCR_TIMEOUT', 120))
+
+# Longest image side fed to the engine; phone photos are downscaled to this
+OCR_MAX_SIDE = 2000
+
+# Bumped whenever preprocessing changes, so cached results are redone
+OCR_PREPROCESS_VERSION = 1
+
+# tesseract language codes -> easyocr ones
+EASYOCR_LANGS = {'eng': 'en', 'fra': 'fr', 'deu': 'de', 'spa': 'es', 'ita': 'it', 'por': 'pt', 'ara': 'ar', 'urd': 'ur'}
+
+def get_ocr_engine_name():
+    """Resolve which OCR engine this process uses ('none' if nothing is installed)"""
+    if OCR_ENGINE != 'auto':
+        return OCR_ENGINE
+    if shutil.which(TESSERACT_CMD):
+        return 'tesseract'
+    try:
+        import easyocr  # noqa: F401
+        return 'easyocr'
+    except ImportError:
+        return 'none'
+
+def otsu_threshold(pixels):
+    """Grey level that best separates ink from paper (Otsu's method)"""
+    hist = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    weights = np.cumsum(hist)
+    sums = np.cumsum(hist * np.arange(256))
+    total, total_sum = weights[-1], sums[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = sums / weights
+        mean_high = (total_sum - sums) / (total - weights)
+        between = weights * (total - weights) * (mean_low - mean_high) ** 2
+    return int(np.nanargmax(between)) if np.isfinite(between).any() else 127
+
+def prepare_image(image_path):
+    """Downscale, straighten and binarize an image for OCR"""
+    with Image.open(image_path) as img:
+        # Let the JPEG decoder do most of the downscaling
+        img.draft('L', (OCR_MAX_SIDE, OCR_MAX_SIDE))
+        img = ImageOps.exif_transpose(img).convert('L')
+    if max(img.size) > OCR_MAX_SIDE:
+        img.thumbnail((OCR_MAX_SIDE, OCR_MAX_SIDE), Image.LANCZOS)
+
+    # Divide out the background so shadows and uneven light don't swallow the text
+    pixels = np.asarray(img, dtype=np.float32)
+    background = img.filter(ImageFilter.GaussianBlur(radius=max(8, max(img.size) // 40)))
+    background = np.maximum(np.asarray(background, dtype=np.float32), 1.0)
+    flat = np.clip(pixels / background * 255.0, 0, 255).astype(np.uint8)
+
+    threshold = otsu_threshold(flat)
+    return Image.fromarray(np.where(flat > threshold, 255, 0).astype(np.uint8)).convert('1')
+
+def run_tesseract(img, lang):
+    """OCR with the tesseract binary, one thread per call (the pool bounds concurrency)"""
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    result = subprocess.run(
+        [TESSERACT_CMD, 'stdin', 'stdout', '-l', lang, '--psm', '3'],
+        input=buffer.getvalue(),
+        capture_output=True,
+        timeout=OCR_TIMEOUT,
+        env=dict(os.environ, OMP_THREAD_LIMIT='1')
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"tesseract failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+    return result.stdout.decode('utf-8', 'replace')
+
+_easyocr_reader = None
+_easyocr_lock = threading.Lock()
+
+def run_easyocr(img, lang):
+    """OCR with easyocr (pip-installable, no system binary needed)"""
+    global _easyocr_reader
+    with _easyocr_lock:
+        if _easyocr_reader is None:
+            import easyocr
+            _easyocr_reader = easyocr.Reader([EASYOCR_LANGS.get(lang, 'en')], gpu=False, verbose=False)
+    lines = _easyocr_reader.readtext(np.asarray(img.convert('L')), detail=0, paragraph=True)
+    return "\n".join(lines)
+
+OCR_ENGINES = {'tesseract': run_tesseract, 'easyocr': run_easyocr}
+
+class OcrService:
+    """OCR on its own bounded thread pool, with results cached on disk by image hash"""
+
+    def __init__(self, cache_folder, workers=OCR_WORKERS, lang=OCR_LANG):
+        self.cache_folder = cache_folder
+        self.workers = workers
+        self.lang = lang
+        self.engine = None
+        self.pool = None
+        self.lock = threading.Lock()
+        self.pending = threading.BoundedSemaphore(workers + OCR_MAX_PENDING)
+        self.counters = {"images": 0, "cache_hits": 0, "errors": 0, "ocr_seconds": 0.0}
+
+    def available(self):
+        """Whether an OCR engine is installed"""
+        if self.engine is None:
+            self.engine = get_ocr_engine_name()
+            if self.engine not in OCR_ENGINES:
+                self.engine = 'none'
+            print(f"OCR engine: {self.engine}")
+        return self.engine != 'none'
+
+    def _cache_path(self, image_hash):
+        name = f"{image_hash}.{self.engine}.{self.lang}.v{OCR_PREPROCESS_VERSION}.txt"
+        return os.path.join(self.cache_folder, image_hash[:2], name)
+
+    def recognize(self, image_path):
+        """OCR one image file, or return the cached text of an identical image"""
+        with open(image_path, 'rb') as f:
+            image_hash = hashlib.sha256(f.read()).hexdigest()
+        cache_path = self._cache_path(image_hash)
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            with self.lock:
+                self.counters["cache_hits"] += 1
+            return text
+
+        started = time.time()
+        text = OCR_ENGINES[self.engine](prepare_image(image_path), self.lang).strip()
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(cache_path + '.tmp', cache_path)
+        with self.lock:
+            self.counters["images"] += 1
+            self.counters["ocr_seconds"] += time.time() - started
+        return text
+
+    def _recognize_all(self, image_paths):
+        try:
+            texts = []
+            for image_path in image_paths:
+                try:
+                    texts.append(self.recognize(image_path))
+                except Exception as e:
+                    print(f"Error running OCR on {image_path}: {str(e)}")
+                    with self.lock:
+                        self.counters["errors"] += 1
+            return "\n".join(text for text in texts if text)
+        finally:
+            self.pending.release()
+
+    def submit(self, image_paths):
+        """Queue OCR of some images (e.g. one scanned page); the future gives their joined text.
+
+        Blocks while the pool is saturated, so a big scan can't queue unbounded work.
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ocr')
+        self.pending.acquire()
+        try:
+            return self.pool.submit(self._recognize_all, list(image_paths))
+        except Exception:
+            self.pending.release()
+            raise
+
+    def stats(self):
+        with self.lock:
+            images = self.counters["images"]
+            return dict(
+                self.counters,
+                engine=self.engine,
+                workers=self.workers,
+                ocr_seconds=round(self.counters["ocr_seconds"], 3),
+                mean_ocr_ms=round(self.counters["ocr_seconds"] / images * 1000, 1) if images else 0.0,
+            )
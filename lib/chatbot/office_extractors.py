@@ -0,0 +1,239 @@
+import os
+import uuid
+import shutil
+import zipfile
+import posixpath
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+
+from PIL import Image
+
+import upload_ingest
+
+# LibreOffice, used to convert legacy .doc/.ppt files before extraction
+SOFFICE_CMD = os.environ.get('SOFFICE_CMD', 'soffice')
+CONVERT_TIMEOUT = int(os.environ.get('DOC_CONVERT_TIMEOUT', 300))
+
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+A_NS = '{http://schemas.openxmlformats.org/drawingml/2006/main}'
+P_NS = '{http://schemas.openxmlformats.org/presentationml/2006/main}'
+R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+NOTES_REL_TYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide'
+
+# Media copied as they are; other raster formats are converted to PNG, vector ones skipped
+PASSTHROUGH_MEDIA = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+CONVERTED_MEDIA = {'bmp', 'tif', 'tiff'}
+
+def iter_paragraphs(stream, paragraph_tag, text_tag, tab_tag=None, break_tag=None):
+    """Yield paragraph texts from an OOXML part without building its tree"""
+    parts = []
+    for event, elem in ET.iterparse(stream, events=('end',)):
+        if elem.tag == text_tag:
+            parts.append(elem.text or '')
+        elif elem.tag == tab_tag:
+            parts.append('\t')
+        elif elem.tag == break_tag:
+            parts.append('\n')
+        elif elem.tag == paragraph_tag:
+            yield ''.join(parts)
+            parts = []
+            # Finished paragraphs are dropped, so memory stays flat on huge documents
+            elem.clear()
+
+class MemberTooLarge(ValueError):
+    """A part of the document would expand too far to be read (a zip bomb)"""
+
+def open_member(archive, name):
+    """Open a part of the document, refusing one that expands past the same limits as uploaded archives.
+
+    zipfile never returns more than a member's declared size, so checking that is enough.
+    """
+    info = archive.getinfo(name)
+    limit, reason = upload_ingest.get_member_limit(info)
+    if info.file_size > limit:
+        raise MemberTooLarge(f"{name}: {reason}")
+    return archive.open(info)
+
+def has_member(archive, name):
+    try:
+        archive.getinfo(name)
+        return True
+    except KeyError:
+        return False
+
+def read_relationships(archive, part_name):
+    """Map relationship ids of a part to (type, target part name)"""
+    folder, name = posixpath.split(part_name)
+    rels_name = posixpath.join(folder, '_rels', name + '.rels')
+    if not has_member(archive, rels_name):
+        return {}
+    relationships = {}
+    with open_member(archive, rels_name) as f:
+        for rel in ET.parse(f).getroot().iter(REL_NS + 'Relationship'):
+            if rel.get('TargetMode') == 'External':
+                continue
+            target = posixpath.normpath(posixpath.join(folder, rel.get('Target')))
+            relationships[rel.get('Id')] = (rel.get('Type'), target.lstrip('/'))
+    return relationships
+
+def save_media(archive, member, img_dir, page):
+    """Copy an embedded image out of the archive, streaming it; None for unsupported formats"""
+    ext = member.rsplit('.', 1)[-1].lower()
+    if ext not in PASSTHROUGH_MEDIA and ext not in CONVERTED_MEDIA:
+        return None
+
+    name = str(uuid.uuid4())
+    try:
+        src = open_member(archive, member)
+    except MemberTooLarge as e:
+        print(f"Skipping embedded image {e}")
+        return None
+    with src:
+        if ext in PASSTHROUGH_MEDIA:
+            img_name = f"{name}.{'jpg' if ext == 'jpeg' else ext}"
+            with open(os.path.join(img_dir, img_name), 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+        else:
+            img_name = f"{name}.png"
+            with Image.open(src) as img:
+                img.save(os.path.join(img_dir, img_name), format='PNG', optimize=True)
+    return {'path': os.path.join(img_dir, img_name), 'page': page, 'filename': img_name}
+
+def extract_docx(filepath, img_dir):
+    """Extract the text and images of a .docx; returns (pages, images), split where Word broke pages"""
+    pages = [[]]
+    media_pages = {}
+    images = []
+    with zipfile.ZipFile(filepath) as archive:
+        relationships = read_relationships(archive, 'word/document.xml')
+        with open_member(archive, 'word/document.xml') as f:
+            depth = 0
+            body = None
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    depth += 1
+                    if elem.tag == W_NS + 'body':
+                        body = elem
+                    continue
+                depth -= 1
+
+                if elem.tag == W_NS + 'p':
+                    paragraph = []
+                    for node in elem.iter():
+                        if node.tag == W_NS + 't':
+                            paragraph.append(node.text or '')
+                        elif node.tag == W_NS + 'tab':
+                            paragraph.append('\t')
+                        elif node.tag == W_NS + 'br' and node.get(W_NS + 'type') != 'page':
+                            paragraph.append('\n')
+                        elif node.tag in (W_NS + 'lastRenderedPageBreak', W_NS + 'br'):
+                            # Explicit breaks and the ones Word last rendered both start a page
+                            if paragraph or any(p.strip() for p in pages[-1]):
+                                pages[-1].append(''.join(paragraph))
+                                paragraph = []
+                                pages.append([])
+                        elif node.tag == A_NS + 'blip':
+                            rel = relationships.get(node.get(R_NS + 'embed'))
+                            if rel:
+                                media_pages.setdefault(rel[1], len(pages))
+                    pages[-1].append(''.join(paragraph))
+                    elem.clear()
+
+                # Drop finished top-level blocks, so memory stays flat on huge documents
+                if body is not None and depth == 2:
+                    body.clear()
+
+        for member in archive.namelist():
+            if member.startswith('word/media/'):
+                image = save_media(archive, member, img_dir, media_pages.get(member, 1))
+                if image:
+                    images.append(image)
+
+    return ['\n'.join(p for p in page if p.strip()) for page in pages], images
+
+def get_slide_parts(archive):
+    """Get the slide part names in presentation order"""
+    relationships = read_relationships(archive, 'ppt/presentation.xml')
+    slides = []
+    with open_member(archive, 'ppt/presentation.xml') as f:
+        for event, elem in ET.iterparse(f, events=('end',)):
+            if elem.tag == P_NS + 'sldId':
+                rel = relationships.get(elem.get(R_NS + 'id'))
+                if rel:
+                    slides.append(rel[1])
+    return slides
+
+def extract_pptx(filepath, img_dir):
+    """Extract the text (with speaker notes) and images of a .pptx; returns (pages, images), one per slide"""
+    pages = []
+    images = []
+    seen_media = {}
+    with zipfile.ZipFile(filepath) as archive:
+        for slide_number, slide_part in enumerate(get_slide_parts(archive), 1):
+            with open_member(archive, slide_part) as f:
+                lines = [p for p in iter_paragraphs(f, A_NS + 'p', A_NS + 't', break_tag=A_NS + 'br') if p.strip()]
+
+            relationships = read_relationships(archive, slide_part)
+            for rel_type, target in relationships.values():
+                if rel_type == NOTES_REL_TYPE and has_member(archive, target):
+                    with open_member(archive, target) as f:
+                        notes = [p for p in iter_paragraphs(f, A_NS + 'p', A_NS + 't') if p.strip()]
+                    # The notes page repeats the slide number in a placeholder
+                    notes = [n for n in notes if n.strip() != str(slide_number)]
+                    if notes:
+                        lines.append("Notes: " + "\n".join(notes))
+                elif target.startswith('ppt/media/') and has_member(archive, target):
+                    # Media reused on several slides is stored once, on its first slide
+                    if target not in seen_media:
+                        seen_media[target] = save_media(archive, target, img_dir, slide_number)
+                        if seen_media[target]:
+                            images.append(seen_media[target])
+
+            pages.append("\n".join(lines))
+    return pages, images
+
+def find_soffice():
+    """Find the LibreOffice binary, if installed"""
+    return shutil.which(SOFFICE_CMD) or shutil.which('libreoffice')
+
+def convert_legacy_office(filepath, target_ext):
+    """Convert a .doc/.ppt to .docx/.pptx with LibreOffice; returns the temp folder and converted path"""
+    soffice = find_soffice()
+    if not soffice:
+        raise RuntimeError(f"Cannot read .{filepath.rsplit('.', 1)[-1]} files: LibreOffice (soffice) is not installed")
+
+    out_dir = tempfile.mkdtemp(prefix='office_convert_')
+    # A private profile per conversion, so parallel conversions don't fight over the lock file
+    profile = 'file://' + os.path.join(out_dir, 'profile')
+    try:
+        subprocess.run(
+            [soffice, f'-env:UserInstallation={profile}', '--headless', '--norestore',
+             '--convert-to', target_ext, '--outdir', out_dir, filepath],
+            capture_output=True, timeout=CONVERT_TIMEOUT, check=True
+        )
+        converted = os.path.join(out_dir, os.path.splitext(os.path.basename(filepath))[0] + '.' + target_ext)
+        if not os.path.exists(converted):
+            raise RuntimeError(f"LibreOffice did not convert {os.path.basename(filepath)}")
+    except Exception:
+        shutil.rmtree(out_dir, ignore_errors=True)
+        raise
+    return out_dir, converted
+
+def extract_office_document(filepath, img_dir):
+    """Extract any supported Office document; returns (pages, images)"""
+    ext = filepath.rsplit('.', 1)[-1].lower()
+    if ext == 'docx':
+        return extract_docx(filepath, img_dir)
+    if ext == 'pptx':
+        return extract_pptx(filepath, img_dir)
+
+    # Legacy binary formats go through a converter first
+    target_ext = {'doc': 'docx', 'ppt': 'pptx'}[ext]
+    out_dir, converted = convert_legacy_office(filepath, target_ext)
+    try:
+        return extract_office_document(converted, img_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
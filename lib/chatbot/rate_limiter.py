@@ -0,0 +1,187 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Buckets of at most this many clients are kept; the longest idle ones are dropped first
+MAX_TRACKED_CLIENTS = 100000
+
+# Each address also gets a bucket this many times a client's, shared by every user_id it sends
+# (several users may sit behind one NAT, but one host can't escape its limit by making up ids)
+ADDRESS_RATE_FACTOR = 4
+
+class AdmissionRejected(Exception):
+    """A request turned away before doing any work; 429 for rate limits, 503 when shedding load"""
+
+    def __init__(self, message, status_code=429, retry_after=1, reason='rate_limited'):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+    def to_response(self):
+        return {"error": str(self), "retry_after": self.retry_after}, self.status_code
+
+class TokenBucketLimiter:
+    """Token bucket per client: `rate` requests per second on average, bursts of up to `burst`"""
+
+    def __init__(self, rate, burst, max_clients=MAX_TRACKED_CLIENTS):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        # client -> (tokens, last refill); least recently seen first
+        self.buckets = OrderedDict()
+
+    def acquire(self, client, cost=1.0):
+        """Take cost tokens from a client's bucket; returns 0 if allowed, else seconds until it would be"""
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate if self.rate > 0 else 60.0
+            self.buckets[client] = (tokens, now)
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+            return wait
+
+    def stats(self):
+        with self.lock:
+            return {"rate_per_second": self.rate, "burst": self.burst, "clients": len(self.buckets)}
+
+class ConcurrencyLimiter:
+    """Caps how many requests of a route run at once; over the cap they are rejected, not queued"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+
+    def try_acquire(self):
+        with self.lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"limit": self.limit, "in_flight": self.in_flight, "peak": self.peak}
+
+class RoutePolicy:
+    """Limits for a group of routes.
+
+    shed is an optional function returning (message, retry_after) while the server is too
+    loaded to take this kind of request, or None.
+    """
+
+    def __init__(self, name, rate, burst, max_concurrent, shed=None, address_factor=ADDRESS_RATE_FACTOR):
+        self.name = name
+        self.rate_limiter = TokenBucketLimiter(rate, burst) if rate > 0 else None
+        self.address_limiter = (
+            TokenBucketLimiter(rate * address_factor, burst * address_factor) if rate > 0 else None
+        )
+        self.concurrency = ConcurrencyLimiter(max_concurrent) if max_concurrent > 0 else None
+        self.shed = shed
+
+class Admission:
+    """A request let in; release() frees its concurrency slot (only the first call counts)"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.released = False
+
+    def release(self):
+        if not self.released and self.policy.concurrency is not None:
+            self.released = True
+            self.policy.concurrency.release()
+
+class AdmissionController:
+    """Decides, before a request does any work, whether to let it in.
+
+    Checks, cheapest first: shedding (is the server overloaded for this kind of request?),
+    the rate limits of the client's address and of the client, then the route's concurrency cap. Endpoints without a policy of
+    their own get the default one; exempt endpoints are never limited.
+    """
+
+    def __init__(self, default=None, exempt=()):
+        self.policies = {}
+        self.groups = [default] if default else []
+        self.default = default
+        self.exempt = set(exempt)
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def add_policy(self, endpoints, policy):
+        """Apply a policy to the given Flask endpoints"""
+        self.groups.append(policy)
+        for endpoint in endpoints:
+            self.policies[endpoint] = policy
+
+    def _count(self, policy, outcome):
+        with self.lock:
+            counters = self.counters.setdefault(policy.name, {})
+            counters[outcome] = counters.get(outcome, 0) + 1
+        metrics.admission_decisions.inc(policy=policy.name, outcome=outcome)
+
+    def admit(self, endpoint, client, address=None):
+        """Let a request in, returning its Admission (None if it isn't limited), or raise AdmissionRejected.
+
+        client is who the request claims to be; address is where it really came from, limited either way.
+        """
+        if endpoint is None or endpoint in self.exempt:
+            return None
+        policy = self.policies.get(endpoint, self.default)
+        if policy is None:
+            return None
+
+        if policy.shed is not None:
+            overloaded = policy.shed()
+            if overloaded:
+                message, retry_after = overloaded
+                self._count(policy, 'shed')
+                raise AdmissionRejected(message, 503, retry_after, 'shed')
+
+        if policy.rate_limiter is not None:
+            wait = policy.address_limiter.acquire(address) if address is not None else 0
+            if wait <= 0:
+                wait = policy.rate_limiter.acquire(client)
+            if wait > 0:
+                self._count(policy, 'rate_limited')
+                raise AdmissionRejected("Too many requests, slow down", 429, wait, 'rate_limited')
+
+        if policy.concurrency is not None and not policy.concurrency.try_acquire():
+            self._count(policy, 'concurrency')
+            raise AdmissionRejected("The server is busy, try again shortly", 503, 1, 'concurrency')
+
+        self._count(policy, 'allowed')
+        return Admission(policy)
+
+    def in_flight(self):
+        """Requests running per policy, for /metrics"""
+        return [((policy.name,), policy.concurrency.in_flight) for policy in self.groups if policy.concurrency]
+
+    def stats(self):
+        with self.lock:
+            counters = {name: dict(values) for name, values in self.counters.items()}
+        return {
+            policy.name: {
+                "rate": policy.rate_limiter.stats() if policy.rate_limiter else None,
+                "address_rate": policy.address_limiter.stats() if policy.address_limiter else None,
+                "concurrency": policy.concurrency.stats() if policy.concurrency else None,
+                "decisions": counters.get(policy.name, {}),
+            }
+            for policy in self.groups
+        }
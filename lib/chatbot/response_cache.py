@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+def normalize_text(text):
+    """Normalize message text so trivially different prompts share a cache entry"""
+    return " ".join(text.split()).casefold()
+
+def make_cache_key(model, messages, temperature, max_tokens):
+    """Hash the parts of a chat request that determine its completion"""
+    normalized = {
+        "model": model,
+        "messages": [[m.get("role", ""), normalize_text(m.get("content", ""))] for m in messages],
+        "temperature": round(float(temperature), 3),
+        "max_tokens": max_tokens,
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+class ResponseCache:
+    """LRU + TTL cache of chat completions with a memory budget and optional disk snapshot"""
+
+    def __init__(self, max_entries=2048, max_bytes=32 * 1024 * 1024, ttl=3600, persist_path=None, persist_every=50):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.persist_path = persist_path
+        self.persist_every = persist_every
+
+        # key -> (expires_at, response); ordered oldest-used first
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+        self.dirty_writes = 0
+        self.counters = {"hits": 0, "misses": 0, "bypassed": 0, "evictions": 0, "expirations": 0}
+
+        if persist_path:
+            self.load()
+
+    def _entry_size(self, key, response):
+        return len(key) + len(response.encode('utf-8'))
+
+    def _remove(self, key):
+        _, response = self.entries.pop(key)
+        self.size_bytes -= self._entry_size(key, response)
+
+    def get(self, key):
+        """Get a cached response, or None on a miss"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            if entry[0] < time.time():
+                self._remove(key)
+                self.counters["expirations"] += 1
+                self.counters["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, key, response):
+        """Cache a response, evicting least recently used entries to stay within budget"""
+        size = self._entry_size(key, response)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.time() + self.ttl, response)
+            self.size_bytes += size
+            while len(self.entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters["evictions"] += 1
+            self.dirty_writes += 1
+            should_save = self.persist_path and self.dirty_writes >= self.persist_every
+
+        if should_save:
+            self.save()
+
+    def record_bypass(self):
+        with self.lock:
+            self.counters["bypassed"] += 1
+
+    def load(self):
+        """Load unexpired entries from the disk snapshot"""
+        if not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r') as f:
+                snapshot = json.load(f)
+        except Exception as e:
+            print(f"Error loading response cache: {str(e)}")
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, expires_at, response in snapshot:
+                if expires_at > now:
+                    self.entries[key] = (expires_at, response)
+                    self.size_bytes += self._entry_size(key, response)
+
+    def save(self):
+        """Write the cache to disk atomically"""
+        if not self.persist_path:
+            return
+        with self.lock:
+            snapshot = [[key, expires_at, response] for key, (expires_at, response) in self.entries.items()]
+            self.dirty_writes = 0
+        tmp_path = self.persist_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.persist_path)
+
+    def stats(self):
+        """Get hit/miss counters and memory use"""
+        with self.lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return dict(
+                self.counters,
+                entries=len(self.entries),
+                size_bytes=self.size_bytes,
+                max_bytes=self.max_bytes,
+                hit_rate=round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            )
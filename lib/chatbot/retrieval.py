@@ -0,0 +1,238 @@
+import os
+import re
+import json
+import time
+import zlib
+import threading
+
+import numpy as np
+
+# Chunking: windows of this many words, overlapping by CHUNK_OVERLAP words
+CHUNK_WORDS = 200
+CHUNK_OVERLAP = 40
+
+# Embedder: 'auto' uses sentence-transformers when installed, else feature hashing
+RAG_EMBEDDER = os.environ.get('RAG_EMBEDDER', 'auto')
+SENTENCE_MODEL = os.environ.get('RAG_SENTENCE_MODEL', 'all-MiniLM-L6-v2')
+HASHING_DIM = 1024
+
+PAGE_MARKER = re.compile(r"\n--- Page (\d+) ---\n")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+def chunk_text(text):
+    """Split extracted text into overlapping word windows, remembering each chunk's page"""
+    chunks = []
+    # PAGE_MARKER splits into [before, page, text, page, text, ...]
+    parts = PAGE_MARKER.split(text)
+    pages = [(None, parts[0])] + [(int(parts[i]), parts[i + 1]) for i in range(1, len(parts) - 1, 2)]
+
+    step = CHUNK_WORDS - CHUNK_OVERLAP
+    for page, page_text in pages:
+        words = page_text.split()
+        for start in range(0, len(words), step):
+            window = words[start:start + CHUNK_WORDS]
+            if window:
+                chunks.append({"page": page, "text": " ".join(window)})
+            if start + CHUNK_WORDS >= len(words):
+                break
+    return chunks
+
+def get_embedder_name():
+    """Resolve which embedder this process uses"""
+    if RAG_EMBEDDER != 'auto':
+        return RAG_EMBEDDER
+    try:
+        import sentence_transformers  # noqa: F401
+        return 'minilm'
+    except ImportError:
+        return 'hashing'
+
+_sentence_model = None
+
+def embed_texts(texts):
+    """Embed texts as L2-normalized float32 rows (safe to run in the process pool)"""
+    global _sentence_model
+
+    if get_embedder_name() == 'minilm':
+        if _sentence_model is None:
+            from sentence_transformers import SentenceTransformer
+            _sentence_model = SentenceTransformer(SENTENCE_MODEL, device='cpu')
+        return _sentence_model.encode(texts, batch_size=64, normalize_embeddings=True).astype(np.float32)
+
+    # Feature hashing of sublinear term frequencies; crc32 is stable across processes
+    vectors = np.zeros((len(texts), HASHING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        counts = {}
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            h = zlib.crc32(token.encode())
+            index = h % HASHING_DIM
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            counts[index] = counts.get(index, 0.0) + sign
+        if counts:
+            indexes = np.fromiter(counts.keys(), dtype=np.int64)
+            values = np.fromiter(counts.values(), dtype=np.float32)
+            vectors[row, indexes] = np.sign(values) * (1 + np.log(np.abs(values) + 1e-9))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-9)
+
+class VectorIndex:
+    """Append-only, memory-mapped chunk index with per-document row ranges"""
+
+    def __init__(self, folder):
+        self.folder = os.path.join(folder, get_embedder_name())
+        self.vectors_path = os.path.join(self.folder, 'vectors.f32')
+        self.chunks_path = os.path.join(self.folder, 'chunks.jsonl')
+        self.docs_path = os.path.join(self.folder, 'docs.jsonl')
+
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dim = None
+        self.rows = 0
+        self.doc_rows = {}
+        self.chunk_offsets = []
+        self.matrix = None
+        self.counters = {"queries": 0, "query_seconds": 0.0, "documents_indexed": 0}
+
+    def _load(self):
+        """Replay the document log and chunk offsets (done lazily on first use)"""
+        with self.lock:
+            if self.loaded:
+                return
+            os.makedirs(self.folder, exist_ok=True)
+
+            if os.path.exists(self.docs_path):
+                with open(self.docs_path, 'r') as f:
+                    for line in f:
+                        record = json.loads(line)
+                        if record.get("removed"):
+                            self.doc_rows.pop(record["doc_id"], None)
+                        else:
+                            self.doc_rows[record["doc_id"]] = (record["start"], record["end"])
+                            self.dim = record["dim"]
+
+            if os.path.exists(self.chunks_path):
+                with open(self.chunks_path, 'r+b') as f:
+                    offset = 0
+                    for line in f:
+                        if not line.endswith(b"\n"):
+                            f.truncate(offset)
+                            break
+                        self.chunk_offsets.append(offset)
+                        offset += len(line)
+            self.rows = len(self.chunk_offsets)
+
+            # Drop a torn tail left by a crash between the appends
+            if self.dim and os.path.exists(self.vectors_path):
+                vector_rows = os.path.getsize(self.vectors_path) // (self.dim * 4)
+                self.rows = min(self.rows, vector_rows)
+                with open(self.vectors_path, 'r+b') as f:
+                    f.truncate(self.rows * self.dim * 4)
+                del self.chunk_offsets[self.rows:]
+                self.doc_rows = {d: r for d, r in self.doc_rows.items() if r[1] <= self.rows}
+            self.loaded = True
+
+    def _matrix(self):
+        """Memory-map the vectors, re-mapping after appends"""
+        if self.matrix is None or self.matrix.shape[0] < self.rows:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.rows, self.dim))
+        return self.matrix
+
+    def _append_doc_record(self, record):
+        with open(self.docs_path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+
+    def add_document(self, doc_id, chunks, vectors):
+        """Append a document's chunks and vectors; replaces any earlier version of the document"""
+        self._load()
+        if len(chunks) == 0:
+            return
+        with self.lock:
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            self.dim = vectors.shape[1]
+
+            start = self.rows
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.chunks_path, 'ab') as f:
+                offset = f.tell()
+                for chunk in chunks:
+                    line = (json.dumps(dict(chunk, doc_id=doc_id)) + "\n").encode()
+                    self.chunk_offsets.append(offset)
+                    offset += len(line)
+                    f.write(line)
+
+            self.rows = start + len(chunks)
+            self.doc_rows[doc_id] = (start, self.rows)
+            self._append_doc_record({"doc_id": doc_id, "start": start, "end": self.rows, "dim": self.dim})
+            self.counters["documents_indexed"] += 1
+
+    def alias_document(self, doc_id, source_doc_id):
+        """Point a document at another document's chunks (used for deduplicated uploads)"""
+        self._load()
+        with self.lock:
+            if source_doc_id not in self.doc_rows:
+                return False
+            start, end = self.doc_rows[source_doc_id]
+            self.doc_rows[doc_id] = (start, end)
+            self._append_doc_record({"doc_id": doc_id, "start": start, "end": end, "dim": self.dim})
+            return True
+
+    def remove_document(self, doc_id):
+        """Forget a document (its rows stay in the files but are never searched)"""
+        self._load()
+        with self.lock:
+            if self.doc_rows.pop(doc_id, None) is not None:
+                self._append_doc_record({"doc_id": doc_id, "removed": True})
+
+    def _read_chunk(self, row):
+        with open(self.chunks_path, 'rb') as f:
+            f.seek(self.chunk_offsets[row])
+            return json.loads(f.readline())
+
+    def search(self, query, doc_ids, k=4):
+        """Get the k chunks of the given documents that best match the query"""
+        self._load()
+        started = time.time()
+        with self.lock:
+            ranges = [(d, self.doc_rows[d]) for d in doc_ids if d in self.doc_rows]
+            if not ranges or not self.rows:
+                return []
+            matrix = self._matrix()
+
+        # Deduplicated uploads share rows, so score each row once
+        rows = np.concatenate([np.arange(start, end) for _, (start, end) in ranges])
+        owners = np.concatenate([np.full(end - start, i) for i, (_, (start, end)) in enumerate(ranges)])
+        rows, first = np.unique(rows, return_index=True)
+        owners = owners[first]
+
+        # Score every candidate row with one matrix-vector product
+        query_vector = embed_texts([query])[0]
+        scores = matrix[rows] @ query_vector
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            chunk = self._read_chunk(int(rows[i]))
+            chunk["doc_id"] = ranges[owners[i]][0]
+            chunk["score"] = round(float(scores[i]), 4)
+            results.append(chunk)
+
+        with self.lock:
+            self.counters["queries"] += 1
+            self.counters["query_seconds"] += time.time() - started
+        return results
+
+    def stats(self):
+        """Get index size and query latency"""
+        with self.lock:
+            queries = self.counters["queries"]
+            return {
+                "embedder": os.path.basename(self.folder),
+                "documents": len(self.doc_rows),
+                "chunks": self.rows,
+                "documents_indexed": self.counters["documents_indexed"],
+                "queries": queries,
+                "mean_query_ms": round(self.counters["query_seconds"] / queries * 1000, 2) if queries else 0.0,
+            }
@@ -0,0 +1,105 @@
+import os
+import re
+import sqlite3
+import threading
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+def build_match_query(query, tags=None):
+    """Turn free text into a safe FTS5 query (every word must match, tags restrict the tags column)"""
+    terms = [f'"{token}"' for token in TOKEN_PATTERN.findall(query)]
+    for tag in tags or []:
+        tag_terms = TOKEN_PATTERN.findall(tag)
+        if tag_terms:
+            terms.append("tags : (" + " ".join(f'"{t}"' for t in tag_terms) + ")")
+    return " AND ".join(terms)
+
+class SearchIndex:
+    """Inverted index over extracted text and metadata, kept in SQLite FTS5 and updated in place"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+
+    def _conn(self):
+        """Get this thread's connection, creating the index on first use"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS doc_search USING fts5("
+                "title, description, tags, content, "
+                "doc_id UNINDEXED, user_id UNINDEXED, category UNINDEXED, "
+                "tokenize = 'porter unicode61')"
+            )
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def index_document(self, doc_id, doc_data, text_content):
+        """Add or replace a document in the index"""
+        metadata = doc_data.get("metadata", {})
+        conn = self._conn()
+        with self.write_lock, conn:
+            conn.execute("DELETE FROM doc_search WHERE doc_id = ?", (doc_id,))
+            conn.execute(
+                "INSERT INTO doc_search (title, description, tags, content, doc_id, user_id, category) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    metadata.get("title", doc_data.get("filename", "")),
+                    metadata.get("description", ""),
+                    metadata.get("tags", ""),
+                    text_content,
+                    doc_id,
+                    metadata.get("user_id", ""),
+                    metadata.get("category", ""),
+                )
+            )
+
+    def remove_document(self, doc_id):
+        """Remove a document from the index"""
+        conn = self._conn()
+        with self.write_lock, conn:
+            conn.execute("DELETE FROM doc_search WHERE doc_id = ?", (doc_id,))
+
+    def is_empty(self):
+        return self._conn().execute("SELECT 1 FROM doc_search LIMIT 1").fetchone() is None
+
+    def search(self, query, user_id=None, category=None, tags=None, limit=20, offset=0):
+        """Rank matching documents with BM25 (title weighs most); returns (total, results)"""
+        match = build_match_query(query, tags)
+        if not match:
+            return 0, []
+
+        where = "doc_search MATCH ?"
+        params = [match]
+        if user_id:
+            where += " AND user_id = ?"
+            params.append(user_id)
+        if category:
+            where += " AND category = ?"
+            params.append(category)
+
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM doc_search WHERE {where}", params).fetchone()[0]
+        rows = conn.execute(
+            "SELECT doc_id, title, category, tags, "
+            "snippet(doc_search, 3, '[', ']', '...', 16), "
+            "bm25(doc_search, 10.0, 4.0, 6.0, 1.0) AS rank "
+            f"FROM doc_search WHERE {where} ORDER BY rank LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+
+        results = [{
+            "document_id": row[0],
+            "title": row[1],
+            "category": row[2],
+            "tags": row[3],
+            "snippet": row[4],
+            # bm25() is lower-is-better; flip it so higher scores rank first
+            "score": round(-row[5], 4),
+        } for row in rows]
+        return total, results
@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+from collections import deque
+
+# Status changes kept for clients catching up; older cursors have to resync from a snapshot
+STATUS_HISTORY = int(os.environ.get('DOC_STATUS_HISTORY', 10000))
+
+class StatusBoard:
+    """In-memory index of every document's processing status, with a feed of the changes.
+
+    Reads work like the old status dict (get(doc_id) -> status). Every set() is numbered, so
+    clients can hold a cursor and wait for the changes after it instead of polling.
+    """
+
+    def __init__(self, history=STATUS_HISTORY):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+        # doc_id -> {"status", "user_id", "updated_at", ...details}
+        self.entries = {}
+        self.by_user = {}
+        self.events = deque(maxlen=history)
+        self.seq = 0
+        self.seeded = False
+        self.counters = {"changes": 0, "waits": 0, "resyncs": 0}
+
+    def _index(self, doc_id, entry):
+        old = self.entries.get(doc_id)
+        if old is not None and old["user_id"] != entry["user_id"]:
+            self.by_user.get(old["user_id"], set()).discard(doc_id)
+        self.entries[doc_id] = entry
+        self.by_user.setdefault(entry["user_id"], set()).add(doc_id)
+
+    def seed(self, documents):
+        """Index stored documents (at startup) without overriding statuses set since"""
+        with self.lock:
+            for doc in documents:
+                if doc["doc_id"] not in self.entries:
+                    self._index(doc["doc_id"], self._stored_entry(doc))
+            self.seeded = True
+
+    def _stored_entry(self, doc):
+        entry = {
+            "status": doc.get("status", "unknown"),
+            "user_id": doc.get("metadata", {}).get("user_id", ""),
+            "updated_at": None,
+        }
+        if doc.get("error"):
+            entry["error"] = doc["error"]
+        return entry
+
+    def add_stored(self, doc):
+        """Index one stored document if it isn't yet, and return its entry"""
+        with self.lock:
+            entry = self.entries.get(doc["doc_id"])
+            if entry is None:
+                entry = self._stored_entry(doc)
+                self._index(doc["doc_id"], entry)
+            return dict(entry)
+
+    def set(self, doc_id, status, user_id=None, **details):
+        """Record a status change and wake everyone waiting for one"""
+        with self.lock:
+            old = self.entries.get(doc_id)
+            if user_id is None:
+                user_id = old["user_id"] if old else ""
+            entry = {"status": status, "user_id": user_id, "updated_at": time.time()}
+            entry.update((key, value) for key, value in details.items() if value is not None)
+            self._index(doc_id, entry)
+
+            self.seq += 1
+            self.counters["changes"] += 1
+            self.events.append(dict(entry, seq=self.seq, document_id=doc_id))
+            self.changed.notify_all()
+
+    def get(self, doc_id, default=None):
+        with self.lock:
+            entry = self.entries.get(doc_id)
+            return entry["status"] if entry else default
+
+    def remove(self, doc_id):
+        """Drop a deleted document, telling its watchers"""
+        with self.lock:
+            entry = self.entries.pop(doc_id, None)
+            if entry is None:
+                return
+            self.by_user.get(entry["user_id"], set()).discard(doc_id)
+            self.seq += 1
+            self.counters["changes"] += 1
+            self.events.append({
+                "seq": self.seq, "document_id": doc_id, "status": "deleted",
+                "user_id": entry["user_id"], "updated_at": time.time()
+            })
+            self.changed.notify_all()
+
+    def snapshot(self, doc_ids=None, user_id=None):
+        """Get (entries by doc_id, cursor) for the given documents and/or a user's documents"""
+        with self.lock:
+            wanted = set(doc_ids or ())
+            if user_id is not None:
+                wanted |= self.by_user.get(user_id, set())
+            found = {doc_id: dict(self.entries[doc_id]) for doc_id in wanted if doc_id in self.entries}
+            return found, self.seq
+
+    def _matching(self, cursor, doc_ids, user_id):
+        """Changes after cursor for the filter, and whether the cursor is too old to continue from"""
+        if cursor > self.seq:
+            return [], True
+        if cursor < self.seq and (not self.events or self.events[0]["seq"] > cursor + 1):
+            return [], True
+        matches = []
+        for event in reversed(self.events):
+            if event["seq"] <= cursor:
+                break
+            if (doc_ids and event["document_id"] in doc_ids) or (user_id is not None and event["user_id"] == user_id):
+                matches.append(dict(event))
+        matches.reverse()
+        return matches, False
+
+    def wait(self, cursor, timeout, doc_ids=None, user_id=None):
+        """Block until there are changes after cursor for the filter, or the timeout passes.
+
+        Returns (events, new cursor, resync); resync means changes were missed and the
+        client should take a fresh snapshot.
+        """
+        doc_ids = set(doc_ids or ())
+        deadline = time.time() + timeout
+        with self.lock:
+            self.counters["waits"] += 1
+            while True:
+                events, resync = self._matching(cursor, doc_ids, user_id)
+                if resync:
+                    self.counters["resyncs"] += 1
+                    return [], self.seq, True
+                # Changes to other documents still move the cursor forward
+                cursor = self.seq
+                if events:
+                    return events, cursor, False
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return [], cursor, False
+                self.changed.wait(remaining)
+
+    def stats(self):
+        with self.lock:
+            counts = {}
+            for entry in self.entries.values():
+                counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            return dict(self.counters, documents=len(self.entries), by_status=counts, cursor=self.seq)
@@ -0,0 +1,71 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# document_processor keeps its data relative to the working directory, from import time on
+os.chdir(tempfile.mkdtemp(prefix='chatbot_test_'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_processor as dp
+import text_store
+
+def store_upload(name, content):
+    """Write an upload to its document folder and build its record, as register_upload does"""
+    doc_id, filename, filepath = dp.prepare_upload_path(name)
+    with open(filepath, 'wb') as f:
+        f.write(content)
+    return dp.new_document_data(doc_id, filename, filepath, 'same-hash', len(content), {'user_id': 'u'})
+
+def complete(doc_data):
+    """Finish a document the way the worker does, sharing its results"""
+    doc_data['text_file'] = dp.write_text_file(doc_data['doc_id'], ['extracted text'])
+    doc_data['images'] = []
+    doc_data['processing_complete'] = True
+    doc_data['status'] = 'completed'
+    assert dp.content_cache.register(
+        doc_data['content_hash'], 'txt', doc_data['doc_id'], dp.get_content_entry(doc_data)
+    )
+    doc_data['content_ref'] = True
+    dp.documents_data[doc_data['doc_id']] = doc_data
+    dp.release_text_file(doc_data['doc_id'])
+
+class DeleteSharedDocumentTest(unittest.TestCase):
+
+    def test_deleting_failed_copy_keeps_shared_files(self):
+        dp.init_document_folders()
+
+        # A failed before B finished; C was then linked to B's results
+        failed = store_upload('a.txt', b'same bytes')
+        failed.update(status='error', error='extraction failed')
+        dp.documents_data[failed['doc_id']] = failed
+        dp.document_status.set(failed['doc_id'], 'error')
+
+        original = store_upload('b.txt', b'same bytes')
+        complete(original)
+        dp.document_status.set(original['doc_id'], 'completed')
+
+        linked = store_upload('c.txt', b'same bytes')
+        self.assertEqual(linked['deduplicated_from'], original['doc_id'])
+        dp.documents_data[linked['doc_id']] = linked
+
+        # The failed copy never held a reference, so its own folder goes and B's count is untouched
+        result, status_code = dp.delete_document_data(failed['doc_id'])
+        self.assertEqual(status_code, 200)
+        self.assertTrue(result['files_removed'])
+        self.assertFalse(os.path.exists(os.path.dirname(failed['filepath'])))
+        self.assertEqual(dp.content_cache.stats()['references'], 2)
+
+        # Deleting B leaves the files C still points at
+        result, _ = dp.delete_document_data(original['doc_id'])
+        self.assertFalse(result['files_removed'])
+        self.assertTrue(os.path.exists(linked['filepath']))
+        self.assertIn('extracted text', text_store.open_text(linked['text_file']).read_text())
+
+        # The last reference takes the shared files with it
+        result, _ = dp.delete_document_data(linked['doc_id'])
+        self.assertTrue(result['files_removed'])
+        self.assertFalse(os.path.exists(linked['filepath']))
+
+if __name__ == '__main__':
+    unittest.main()
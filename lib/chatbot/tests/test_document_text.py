@@ -0,0 +1,38 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# document_processor keeps its data relative to the working directory, from import time on
+if 'document_processor' not in sys.modules:
+    os.chdir(tempfile.mkdtemp(prefix='chatbot_test_'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import document_processor as dp
+
+class PartialTextTest(unittest.TestCase):
+
+    def test_text_stays_available_until_the_record_is_completed(self):
+        dp.init_document_folders()
+        doc_id, filename, filepath = dp.prepare_upload_path('notes.pdf')
+        dp.documents_data[doc_id] = {"doc_id": doc_id, "filename": filename, "filepath": filepath, "status": "processing"}
+
+        # Pages served while extracting, then the file finished but the record not saved yet (indexing)
+        dp.document_progress[doc_id] = {"pages_done": 0, "pages_total": 2}
+        dp.append_page(doc_id, dp.open_text_file(doc_id), 1, 'page one ')
+        text_file = dp.write_text_file(doc_id, ['page one ', 'page two'])
+        result, status_code = dp.get_document_text_data(doc_id)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(result['text_content'], 'page one page two')
+        self.assertTrue(result['partial'])
+
+        doc_data = dict(dp.documents_data[doc_id], text_file=text_file, processing_complete=True, status='completed')
+        dp.documents_data[doc_id] = doc_data
+        dp.release_text_file(doc_id)
+        result, status_code = dp.get_document_text_data(doc_id)
+        self.assertEqual(status_code, 200)
+        self.assertNotIn('partial', result)
+        self.assertEqual(result['text_content'], 'page one page two')
+
+if __name__ == '__main__':
+    unittest.main()
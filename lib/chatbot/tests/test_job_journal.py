@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import job_journal
+
+class LostLeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(prefix='chatbot_test_'), 'jobs.db')
+        self.journal = job_journal.JobJournal(path, owner='test:1', max_attempts=2, lease_seconds=-1)
+        self.journal.enqueue('doc', 'u', 1, 1.0)
+
+    def test_expired_lease_is_requeued_until_attempts_run_out(self):
+        self.assertEqual(self.journal.start('doc'), 1)
+        self.assertEqual([job['state'] for job in self.journal.reclaim_expired()], ['queued'])
+
+        # The second attempt also dies with its process: no third one
+        self.assertEqual(self.journal.start('doc'), 2)
+        jobs = self.journal.reclaim_expired()
+        self.assertEqual([(job['state'], job['last_error']) for job in jobs], [('dead', 'lease lost')])
+        self.assertEqual(self.journal.get('doc')['state'], 'dead')
+        self.assertEqual(self.journal.reclaim_expired(), [])
+
+    def test_recover_dead_letters_exhausted_jobs(self):
+        self.journal.start('doc')
+        self.journal.reclaim_expired()
+        self.journal.start('doc')
+
+        # Restarted in the same process name, as after a crash
+        jobs = self.journal.recover()
+        self.assertEqual([(job['doc_id'], job['state']) for job in jobs], [('doc', 'dead')])
+        self.assertEqual(self.journal.stats()['dead'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import io
+import os
+import sys
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import upload_ingest
+from upload_ingest import MB
+
+class ArchiveLimitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp(prefix='chatbot_test_')
+        self.quota = upload_ingest.StorageQuota(lambda: (), user_quota=0, global_quota=0)
+
+    def make_archive(self, members):
+        path = os.path.join(self.folder, 'upload.zip')
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in members.items():
+                archive.writestr(name, content)
+        return path
+
+    def open_sink(self, filename):
+        return upload_ingest.UploadSink(os.path.join(self.folder, 'out-' + filename), self.quota, '')
+
+    def extract(self, path, **limits):
+        return upload_ingest.extract_archive(path, self.open_sink, 64 * 1024, **limits)
+
+    def test_highly_compressed_member_is_refused(self):
+        path = self.make_archive({'notes.txt': b'plain text\n' * 1000, 'bomb.txt': b'\0' * (20 * MB)})
+        sinks, rejected = self.extract(path)
+        self.assertEqual([os.path.basename(sink.filepath) for sink in sinks], ['out-notes.txt'])
+        self.assertEqual([(name, e.status_code) for name, e in rejected], [('bomb.txt', 413)])
+        self.assertIn('compressed size', str(rejected[0][1]))
+        self.assertFalse(os.path.exists(os.path.join(self.folder, 'out-bomb.txt')))
+
+    def test_declared_total_over_the_cap_refuses_the_archive(self):
+        path = self.make_archive({'a.txt': os.urandom(MB), 'b.txt': os.urandom(MB)})
+        with self.assertRaises(upload_ingest.UploadRejected) as raised:
+            self.extract(path, max_expanded=MB)
+        self.assertEqual(raised.exception.status_code, 413)
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def test_second_file_part_is_refused(self):
+        folder = tempfile.mkdtemp(prefix='chatbot_test_')
+        quota = upload_ingest.StorageQuota(lambda: (), user_quota=0, global_quota=0)
+        body = b"".join(
+            b'--b\r\nContent-Disposition: form-data; name="file"; filename="%s.txt"\r\n\r\n%s\r\n' % (name, name)
+            for name in (b'first', b'SECOND')
+        ) + b'--b--\r\n'
+        opened = []
+
+        def open_sink(filename, fields):
+            opened.append(upload_ingest.UploadSink(os.path.join(folder, filename), quota, ''))
+            return opened[-1]
+
+        with self.assertRaises(upload_ingest.UploadRejected):
+            upload_ingest.stream_multipart_upload(io.BytesIO(body), 'multipart/form-data; boundary=b', open_sink, 1024)
+        self.assertEqual(len(opened), 1)
+        self.assertFalse(os.path.exists(opened[0].filepath))
+        self.assertEqual(quota.stats()['total_bytes'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,387 @@
+import os
+import re
+import json
+import zlib
+import struct
+import bisect
+import threading
+from collections import OrderedDict
+
+# zstd compresses faster and smaller than zlib, but is optional
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Extracted text is stored compressed in blocks, with an index of pages at the end:
+#   header   b'PTXT', version, codec, 2 reserved bytes
+#   blocks   each compressed on its own, in the order they were written
+#   index    one (page, part, file offset, compressed length, text length) entry per block
+#   trailer  index offset, block count, b'PTXE'
+TEXT_STORE_EXT = '.ptxt'
+MAGIC = b'PTXT'
+END_MAGIC = b'PTXE'
+VERSION = 1
+HEADER = struct.Struct('<4sBB2x')
+BLOCK_ENTRY = struct.Struct('<IIQII')
+TRAILER = struct.Struct('<QI4s')
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_NAMES = {'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+# Codec for new text files: zstd when installed, zlib otherwise
+TEXT_CODEC = os.environ.get('DOC_TEXT_CODEC', 'zstd' if zstandard else 'zlib')
+TEXT_COMPRESSION_LEVEL = {CODEC_ZLIB: 6, CODEC_ZSTD: 3}
+
+# Pages longer than this are split into several blocks, so byte ranges only decompress what they need
+TEXT_BLOCK_BYTES = 64 * 1024
+
+# Page indexes of recently read text files kept in memory
+READER_CACHE_SIZE = 256
+
+# Page marker written before each page's text (see format_page_text)
+PAGE_MARKER = re.compile(rb"\n--- Page (\d+) ---\n")
+
+def get_codec(name):
+    codec = CODEC_NAMES.get(name)
+    if codec is None:
+        raise ValueError(f"Unknown text codec: {name}")
+    if codec == CODEC_ZSTD and zstandard is None:
+        raise ValueError("The zstd text codec needs the zstandard package")
+    return codec
+
+def compress(codec, data):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=TEXT_COMPRESSION_LEVEL[codec]).compress(data)
+    return zlib.compress(data, TEXT_COMPRESSION_LEVEL[codec])
+
+def decompress(codec, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise ValueError("This text file is zstd compressed; install the zstandard package")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+def is_text_store(path):
+    return path.endswith(TEXT_STORE_EXT)
+
+def get_store_path(text_file):
+    """Get where the compressed copy of a plain text file goes"""
+    return os.path.splitext(text_file)[0] + TEXT_STORE_EXT
+
+def get_legacy_index_path(text_file):
+    """Get the page offset index stored next to a plain text file"""
+    return text_file[:-len('.txt')] + '.idx.json'
+
+def decode_text(data):
+    """Decode UTF-8 bytes, backing off up to 3 bytes so a character cut at the end isn't mangled.
+
+    Returns (text, bytes used).
+    """
+    for cut in range(4):
+        try:
+            return data[:len(data) - cut].decode('utf-8'), len(data) - cut
+        except UnicodeDecodeError:
+            continue
+    return data.decode('utf-8', errors='replace'), len(data)
+
+class TextStoreWriter:
+    """Streams pages into a new text file; pages may come in any order, and be read back before close()"""
+
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = get_codec(codec or TEXT_CODEC)
+        self.tmp_path = path + '.tmp'
+        self.lock = threading.Lock()
+        self.file = open(self.tmp_path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.codec))
+        self.offset = HEADER.size
+        # page_number -> [(file offset, compressed length, text length)]
+        self.pages = {}
+        self.closed = False
+
+    def add_page(self, page_number, text):
+        """Compress and append a page; returns the bytes written"""
+        data = text.encode('utf-8')
+        blocks = []
+        written = 0
+        with self.lock:
+            for start in range(0, max(len(data), 1), TEXT_BLOCK_BYTES):
+                raw = data[start:start + TEXT_BLOCK_BYTES]
+                packed = compress(self.codec, raw) if raw else b''
+                self.file.write(packed)
+                blocks.append((self.offset, len(packed), len(raw)))
+                self.offset += len(packed)
+                written += len(packed)
+            self.file.flush()
+            self.pages[page_number] = blocks
+        return written
+
+    def page_numbers(self):
+        with self.lock:
+            return sorted(self.pages)
+
+    def read_page(self, page_number):
+        """Read back a page written so far (None if it isn't there yet)"""
+        with self.lock:
+            blocks = self.pages.get(page_number)
+            path = self.path if self.closed else self.tmp_path
+        if blocks is None:
+            return None
+        with open(path, 'rb') as f:
+            return b''.join(read_block(f, self.codec, offset, length) for offset, length, _ in blocks).decode('utf-8')
+
+    def close(self):
+        """Write the page index and move the file into place; returns the file's size"""
+        with self.lock:
+            entries = [
+                BLOCK_ENTRY.pack(page_number, part, offset, length, raw_length)
+                for page_number in sorted(self.pages)
+                for part, (offset, length, raw_length) in enumerate(self.pages[page_number])
+            ]
+            self.file.write(b''.join(entries))
+            self.file.write(TRAILER.pack(self.offset, len(entries), END_MAGIC))
+            self.file.close()
+            os.replace(self.tmp_path, self.path)
+            self.closed = True
+            return self.offset + len(entries) * BLOCK_ENTRY.size + TRAILER.size
+
+    def discard(self):
+        with self.lock:
+            if not self.closed:
+                self.file.close()
+                self.closed = True
+                if os.path.exists(self.tmp_path):
+                    os.remove(self.tmp_path)
+
+def read_block(f, codec, offset, length):
+    if not length:
+        return b''
+    f.seek(offset)
+    return decompress(codec, f.read(length))
+
+class TextStoreReader:
+    """Reads single pages or byte ranges of a text file, decompressing only the blocks involved"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, version, self.codec = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{path} is not a text store")
+            f.seek(-TRAILER.size, os.SEEK_END)
+            index_offset, count, end_magic = TRAILER.unpack(f.read(TRAILER.size))
+            if end_magic != END_MAGIC:
+                raise ValueError(f"{path} is incomplete")
+            f.seek(index_offset)
+            index = f.read(count * BLOCK_ENTRY.size)
+
+        # Blocks are indexed in page order; their text offsets follow from the lengths
+        self.blocks = []
+        self.block_starts = []
+        self.page_blocks = {}
+        position = 0
+        for i in range(count):
+            page_number, _, offset, length, raw_length = BLOCK_ENTRY.unpack_from(index, i * BLOCK_ENTRY.size)
+            self.blocks.append((offset, length, raw_length))
+            self.block_starts.append(position)
+            first, _ = self.page_blocks.get(page_number, (i, i))
+            self.page_blocks[page_number] = (first, i + 1)
+            position += raw_length
+        self.total_bytes = position
+        self.page_count = max(self.page_blocks, default=0)
+
+    def _read_blocks(self, first, end):
+        with open(self.path, 'rb') as f:
+            return b''.join(read_block(f, self.codec, offset, length) for offset, length, _ in self.blocks[first:end])
+
+    def read_page(self, page_number):
+        """Get one page's text; None past the last page"""
+        if not 1 <= page_number <= max(self.page_count, 1):
+            return None
+        if page_number not in self.page_blocks:
+            return ""
+        return self._read_blocks(*self.page_blocks[page_number]).decode('utf-8')
+
+    def read_range(self, offset, limit):
+        """Get up to limit bytes of the text from byte offset"""
+        if offset >= self.total_bytes or limit <= 0:
+            return b''
+        first = bisect.bisect_right(self.block_starts, offset) - 1
+        end = bisect.bisect_left(self.block_starts, offset + limit)
+        data = self._read_blocks(first, end)
+        start = offset - self.block_starts[first]
+        return data[start:start + limit]
+
+    def iter_bytes(self, start=0, end=None):
+        """Yield the text from start to end (bytes), a block at a time"""
+        end = self.total_bytes if end is None else min(end, self.total_bytes)
+        if start >= end:
+            return
+        first = bisect.bisect_right(self.block_starts, start) - 1
+        with open(self.path, 'rb') as f:
+            for i in range(first, len(self.blocks)):
+                block_start = self.block_starts[i]
+                if block_start >= end:
+                    break
+                offset, length, raw_length = self.blocks[i]
+                data = read_block(f, self.codec, offset, length)
+                yield data[max(0, start - block_start):end - block_start]
+
+    def read_text(self):
+        return b''.join(self.iter_bytes()).decode('utf-8')
+
+class LegacyTextReader:
+    """Same interface over a plain .txt file, paged by its .idx.json index or its page markers"""
+
+    def __init__(self, path):
+        self.path = path
+        self.total_bytes = os.path.getsize(path)
+        self._pages = None
+
+    def _load_pages(self):
+        """Byte ranges of pages 1..n, covering the whole file"""
+        if self._pages is not None:
+            return self._pages
+        index_path = get_legacy_index_path(self.path)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                self._pages = [(offset, length) for _, offset, length in json.load(f)["pages"]]
+            return self._pages
+
+        # No index: a page runs from its marker to the next one; text before the first marker goes with it
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        starts = {}
+        for match in PAGE_MARKER.finditer(data):
+            page_number = int(match.group(1))
+            if page_number > max(starts, default=0):
+                starts[page_number] = match.start()
+        if not starts:
+            self._pages = [(0, len(data))]
+            return self._pages
+
+        marked = sorted(starts)
+        ends = {page_number: starts[following] for page_number, following in zip(marked, marked[1:])}
+        ends[marked[-1]] = len(data)
+        starts[marked[0]] = 0
+
+        # Pages without a marker had no text
+        self._pages = [
+            (starts[n], ends[n] - starts[n]) if n in starts else (0, 0)
+            for n in range(1, marked[-1] + 1)
+        ]
+        return self._pages
+
+    @property
+    def page_count(self):
+        return len(self._load_pages())
+
+    def read_page(self, page_number):
+        pages = self._load_pages()
+        if not 1 <= page_number <= len(pages):
+            return None
+        offset, length = pages[page_number - 1]
+        return self.read_range(offset, length).decode('utf-8')
+
+    def read_range(self, offset, limit):
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return f.read(limit)
+
+    def iter_bytes(self, start=0, end=None):
+        end = self.total_bytes if end is None else min(end, self.total_bytes)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(TEXT_BLOCK_BYTES, end - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+
+    def read_text(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+class TextStream:
+    """Seekable stream of a text file's decoded bytes, so responses can serve Range requests from it"""
+
+    def __init__(self, text):
+        self.text = text
+        self.position = 0
+
+    def seekable(self):
+        return True
+
+    def seek(self, position):
+        self.position = position
+
+    def tell(self):
+        return self.position
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.text.read_range(self.position, TEXT_BLOCK_BYTES)
+        if not data:
+            raise StopIteration
+        self.position += len(data)
+        return data
+
+readers = OrderedDict()
+readers_lock = threading.Lock()
+
+def open_text(path):
+    """Open a document's text for reading, in either format (page indexes are cached)"""
+    if not is_text_store(path):
+        return LegacyTextReader(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with readers_lock:
+        cached = readers.get(path)
+        if cached and cached[0] == key:
+            readers.move_to_end(path)
+            return cached[1]
+    reader = TextStoreReader(path)
+    with readers_lock:
+        readers[path] = (key, reader)
+        while len(readers) > READER_CACHE_SIZE:
+            readers.popitem(last=False)
+    return reader
+
+def write_text(path, page_texts, codec=None):
+    """Write a whole document's pages at once; returns the file's size"""
+    writer = TextStoreWriter(path, codec)
+    try:
+        for page_number, page_text in enumerate(page_texts, 1):
+            writer.add_page(page_number, page_text)
+        return writer.close()
+    except Exception:
+        writer.discard()
+        raise
+
+def convert_text_file(text_file, codec=None):
+    """Write a compressed copy of a plain text file (the original is left alone); returns its path"""
+    legacy = LegacyTextReader(text_file)
+    store_path = get_store_path(text_file)
+    write_text(store_path, [legacy.read_page(n) for n in range(1, legacy.page_count + 1)], codec)
+
+    # The copy must read back as the same text before anything points at it
+    if open_text(store_path).read_text() != legacy.read_text():
+        os.remove(store_path)
+        raise ValueError(f"Converted text of {text_file} does not match the original")
+    return store_path
+
+def remove_text_file(text_file):
+    """Delete a text file, and the page index of a plain one"""
+    paths = [text_file]
+    if not is_text_store(text_file):
+        paths.append(get_legacy_index_path(text_file))
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+    with readers_lock:
+        readers.pop(text_file, None)
@@ -0,0 +1,731 @@
+import os
+import json
+import time
+import zlib
+import uuid
+import hashlib
+import zipfile
+import threading
+
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+
+MB = 1024 * 1024
+
+# Largest single document accepted, by either upload path
+UPLOAD_MAX_BYTES = int(os.environ.get('DOC_UPLOAD_MAX_MB', 100)) * MB
+
+# Stored bytes allowed per user and for the whole server (0 turns a quota off)
+USER_QUOTA_BYTES = int(os.environ.get('DOC_USER_QUOTA_MB', 1024)) * MB
+GLOBAL_QUOTA_BYTES = int(os.environ.get('DOC_GLOBAL_QUOTA_MB', 0)) * MB
+
+# Most files one bulk upload may hold (archive members included), and its largest request body
+BULK_MAX_FILES = int(os.environ.get('DOC_BULK_MAX_FILES', 200))
+BULK_UPLOAD_MAX_BYTES = int(os.environ.get('DOC_BULK_UPLOAD_MAX_MB', 500)) * MB
+
+# What ZIP archives in one request may expand to in total, and how many times its compressed size
+# a member may expand to (zip bombs); enforced while decompressing, whatever the storage quotas allow.
+# The ratio is measured against at least ARCHIVE_RATIO_MIN_BYTES, so small, very compressible files pass
+ARCHIVE_EXPANDED_MAX_BYTES = int(os.environ.get('DOC_ARCHIVE_EXPANDED_MAX_MB', 1024)) * MB
+ARCHIVE_MAX_RATIO = int(os.environ.get('DOC_ARCHIVE_MAX_RATIO', 100))
+ARCHIVE_RATIO_MIN_BYTES = 64 * 1024
+
+# Records of bulk uploads are kept this long for progress queries
+UPLOAD_BATCH_TTL = int(os.environ.get('DOC_UPLOAD_BATCH_TTL', 7 * 24 * 3600))
+
+# Resumable uploads left untouched this long are discarded
+RESUMABLE_UPLOAD_TTL = int(os.environ.get('DOC_RESUMABLE_UPLOAD_TTL', 24 * 3600))
+
+# Chunk size suggested to clients of the resumable upload endpoints
+RESUMABLE_CHUNK_BYTES = 8 * MB
+
+# Form fields (title, description, ...) are small; bigger ones are rejected
+FORM_FIELD_MAX_BYTES = 64 * 1024
+
+# Bytes inspected to recognise a file's real type
+SNIFF_BYTES = 8192
+
+MAGIC_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'PK\x03\x04', 'zip'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole'),
+]
+
+# File kinds each allowed extension may contain (DOCX/PPTX are ZIPs, DOC/PPT OLE containers)
+EXTENSION_KINDS = {
+    'pdf': {'pdf'},
+    'png': {'png'},
+    'jpg': {'jpg'},
+    'jpeg': {'jpg'},
+    'docx': {'zip'},
+    'doc': {'ole'},
+    'pptx': {'zip'},
+    'ppt': {'ole'},
+    'txt': {'text'},
+    'zip': {'zip'},
+}
+
+# Archive entries that are not documents: macOS resource forks and hidden files
+ARCHIVE_SKIPPED_PREFIXES = ('__MACOSX/', '.')
+
+class UploadRejected(Exception):
+    """An upload that was refused; carries the HTTP status and any extra response fields"""
+
+    def __init__(self, message, status_code=400, **extra):
+        super().__init__(message)
+        self.status_code = status_code
+        self.extra = extra
+
+    def to_response(self):
+        return dict({"error": str(self)}, **self.extra), self.status_code
+
+class UploadInterrupted(UploadRejected):
+    """The client went away mid-upload; bytes already written are kept for resumable uploads"""
+
+def sniff_file_kind(header):
+    """Recognise a file's type from its first bytes"""
+    # PDF readers accept a little junk before the header
+    if b'%PDF-' in header[:1024]:
+        return 'pdf'
+    for signature, kind in MAGIC_SIGNATURES:
+        if header.startswith(signature):
+            return kind
+    if header.startswith((b'\xff\xfe', b'\xfe\xff')) or b'\x00' not in header:
+        return 'text'
+    return None
+
+def check_file_kind(ext, header):
+    """Reject a file whose content does not match its extension"""
+    kind = sniff_file_kind(header)
+    if kind not in EXTENSION_KINDS.get(ext, ()):
+        raise UploadRejected(f"File content does not match its .{ext} extension", 415)
+
+def read_chunk(stream, size, limit=UPLOAD_MAX_BYTES):
+    """Read from a request stream, turning transport errors into upload errors"""
+    try:
+        return stream.read(size)
+    except RequestEntityTooLarge:
+        raise UploadRejected(f"Upload is larger than the {limit // MB} MB limit", 413)
+    except ClientDisconnected:
+        raise UploadInterrupted("Upload interrupted", 400)
+
+class StorageQuota:
+    """Bytes stored per user and in total, checked chunk by chunk as uploads stream in"""
+
+    def __init__(self, usage_loader, user_quota=USER_QUOTA_BYTES, global_quota=GLOBAL_QUOTA_BYTES):
+        # usage_loader() yields (user_id, size) for every stored document
+        self.usage_loader = usage_loader
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self.lock = threading.Lock()
+        self.user_bytes = None
+        self.total_bytes = 0
+        self.counters = {"rejected": 0}
+
+    def _load(self):
+        """Add up stored documents (done lazily, with the lock held)"""
+        if self.user_bytes is not None:
+            return
+        self.user_bytes = {}
+        for user_id, size in self.usage_loader():
+            self.user_bytes[user_id] = self.user_bytes.get(user_id, 0) + size
+            self.total_bytes += size
+
+    def check(self, user_id, nbytes):
+        """Raise UploadRejected if nbytes more would not fit, without reserving them"""
+        with self.lock:
+            self._load()
+            self._check(user_id, nbytes)
+
+    def _check(self, user_id, nbytes):
+        # Anonymous uploads are only bound by the global quota
+        if self.user_quota and user_id and self.user_bytes.get(user_id, 0) + nbytes > self.user_quota:
+            self.counters["rejected"] += 1
+            raise UploadRejected("Upload exceeds this user's storage quota", 413)
+        if self.global_quota and self.total_bytes + nbytes > self.global_quota:
+            self.counters["rejected"] += 1
+            raise UploadRejected("Server storage quota exceeded", 507)
+
+    def reserve(self, user_id, nbytes, force=False):
+        """Account for nbytes more of a user's data"""
+        with self.lock:
+            self._load()
+            if not force:
+                self._check(user_id, nbytes)
+            self.user_bytes[user_id] = self.user_bytes.get(user_id, 0) + nbytes
+            self.total_bytes += nbytes
+
+    def release(self, user_id, nbytes):
+        """Give back bytes of a deleted document or abandoned upload"""
+        with self.lock:
+            self._load()
+            self.user_bytes[user_id] = max(0, self.user_bytes.get(user_id, 0) - nbytes)
+            self.total_bytes = max(0, self.total_bytes - nbytes)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                self.counters,
+                total_bytes=self.total_bytes if self.user_bytes is not None else None,
+                user_quota_bytes=self.user_quota,
+                global_quota_bytes=self.global_quota,
+            )
+
+class UploadSink:
+    """Write an upload straight to its final path, hashing, sniffing and metering it as it goes"""
+
+    def __init__(self, filepath, quota, user_id, max_bytes=UPLOAD_MAX_BYTES, offset=0, digest=None):
+        self.filepath = filepath
+        self.ext = filepath.rsplit('.', 1)[-1].lower() if '.' in filepath else ''
+        self.quota = quota
+        self.user_id = user_id
+        self.max_bytes = max_bytes
+        self.start = offset
+        self.size = offset
+        self.reserved = 0
+
+        # Appending to a resumable upload: drop anything past the agreed offset
+        if offset:
+            self.file = open(filepath, 'r+b')
+            self.file.seek(offset)
+            self.file.truncate()
+        else:
+            self.file = open(filepath, 'wb')
+        self.digest = digest if digest is not None else hashlib.sha256()
+        self.header = b"" if offset == 0 else None
+
+    def write(self, chunk):
+        if self.size + len(chunk) > self.max_bytes:
+            raise UploadRejected(f"Upload exceeds its size limit of {self.max_bytes} bytes", 413)
+        self.quota.reserve(self.user_id, len(chunk))
+        self.reserved += len(chunk)
+
+        # Check the real file type as soon as enough of it has arrived
+        if self.header is not None:
+            self.header += chunk[:SNIFF_BYTES - len(self.header)]
+            if len(self.header) >= SNIFF_BYTES:
+                self._check_header()
+
+        self.digest.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def _check_header(self):
+        header, self.header = self.header, None
+        check_file_kind(self.ext, header)
+
+    def close(self):
+        """Finish the file; returns (sha256, size)"""
+        self.file.close()
+        if self.header is not None:
+            self._check_header()
+        return self.digest.hexdigest(), self.size
+
+    def discard(self):
+        """Undo everything this sink wrote; calling it again does nothing more"""
+        self.file.close()
+        self.quota.release(self.user_id, self.reserved)
+        self.reserved = 0
+        if self.start:
+            with open(self.filepath, 'r+b') as f:
+                f.truncate(self.start)
+        elif os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+def stream_multipart_upload(stream, content_type, open_sink, chunk_size):
+    """Parse a multipart/form-data body as it arrives, writing the 'file' part through a sink.
+
+    open_sink(filename, fields) is called when the file part starts, with the fields sent before it.
+    Returns (fields, sink); the sink is still open.
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary', '').encode('ascii')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadRejected("Expected a multipart/form-data upload")
+
+    # Field sizes are checked below; the decoder's own limit would also cap file chunks
+    decoder = MultipartDecoder(boundary)
+    fields = {}
+    sink = None
+    file_part = None
+    part = None
+    buffer = []
+    try:
+        while True:
+            data = read_chunk(stream, chunk_size)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, (Field, File)):
+                    part = event
+                    buffer = []
+                    if isinstance(event, File) and event.name == 'file':
+                        # A second file would be appended to the first one's bytes
+                        if sink is not None:
+                            raise UploadRejected("Only one file per upload; use /process_documents for several")
+                        sink = open_sink(event.filename, fields)
+                        file_part = event
+                elif isinstance(event, Data):
+                    if isinstance(part, Field):
+                        buffer.append(event.data)
+                        if sum(len(b) for b in buffer) > FORM_FIELD_MAX_BYTES:
+                            raise UploadRejected(f"Form field {part.name} is too large", 413)
+                        if not event.more_data:
+                            fields[part.name] = b"".join(buffer).decode('utf-8', 'replace')
+                    elif part is file_part:
+                        sink.write(event.data)
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not data:
+                break
+    except ValueError as e:
+        if sink is not None:
+            sink.discard()
+        raise UploadRejected(f"Malformed multipart body: {str(e)}")
+    except Exception:
+        if sink is not None:
+            sink.discard()
+        raise
+    return fields, sink
+
+def stream_multipart_files(stream, content_type, open_sink, chunk_size, max_files=BULK_MAX_FILES):
+    """Parse a multipart/form-data body with any number of file parts, writing each through its own sink.
+
+    open_sink(filename, fields) is called as each file part starts, with the fields sent before it. A
+    file it refuses (by raising UploadRejected), or whose bytes a sink refuses, is skipped and the rest
+    of the body is still read. Returns (fields, sinks, rejected): the sinks of the files written, still
+    open, and (filename, UploadRejected) for each skipped one.
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary', '').encode('ascii')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadRejected("Expected a multipart/form-data upload")
+
+    decoder = MultipartDecoder(boundary)
+    fields = {}
+    sinks = []
+    rejected = []
+    part = None
+    sink = None
+    buffer = []
+    try:
+        while True:
+            data = read_chunk(stream, chunk_size, BULK_UPLOAD_MAX_BYTES)
+            decoder.receive_data(data or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, (Field, File)):
+                    part = event
+                    buffer = []
+                    sink = None
+                    # An empty file input still sends a part, without a filename
+                    if isinstance(event, File) and event.filename:
+                        if len(sinks) + len(rejected) >= max_files:
+                            raise UploadRejected(f"At most {max_files} files per upload", 413)
+                        try:
+                            sink = open_sink(event.filename, fields)
+                            sinks.append(sink)
+                        except UploadRejected as e:
+                            rejected.append((event.filename, e))
+                elif isinstance(event, Data):
+                    if isinstance(part, Field):
+                        buffer.append(event.data)
+                        if sum(len(b) for b in buffer) > FORM_FIELD_MAX_BYTES:
+                            raise UploadRejected(f"Form field {part.name} is too large", 413)
+                        if not event.more_data:
+                            fields[part.name] = b"".join(buffer).decode('utf-8', 'replace')
+                    elif sink is not None:
+                        try:
+                            sink.write(event.data)
+                        except UploadRejected as e:
+                            sink.discard()
+                            sinks.remove(sink)
+                            rejected.append((part.filename, e))
+                            sink = None
+                event = decoder.next_event()
+            if isinstance(event, Epilogue) or not data:
+                break
+    except ValueError as e:
+        for sink in sinks:
+            sink.discard()
+        raise UploadRejected(f"Malformed multipart body: {str(e)}")
+    except Exception:
+        for sink in sinks:
+            sink.discard()
+        raise
+    return fields, sinks, rejected
+
+def copy_stream(stream, sink, chunk_size, limit=BULK_UPLOAD_MAX_BYTES):
+    """Write a raw request body through a sink"""
+    while True:
+        chunk = read_chunk(stream, chunk_size, limit)
+        if not chunk:
+            break
+        sink.write(chunk)
+
+def is_archive_member(info):
+    """Whether a ZIP entry is a file worth ingesting (not a folder, hidden file or resource fork)"""
+    if info.is_dir():
+        return False
+    name = info.filename.rsplit('/', 1)[-1]
+    return bool(name) and not info.filename.startswith(ARCHIVE_SKIPPED_PREFIXES) and not name.startswith('.')
+
+def get_member_limit(info):
+    """Most bytes an archive member may expand to, and the reason given past it"""
+    limit = max(info.compress_size, ARCHIVE_RATIO_MIN_BYTES) * ARCHIVE_MAX_RATIO
+    if limit < UPLOAD_MAX_BYTES:
+        return limit, f"File expands to more than {ARCHIVE_MAX_RATIO} times its compressed size"
+    return UPLOAD_MAX_BYTES, f"File is larger than the {UPLOAD_MAX_BYTES // MB} MB upload limit"
+
+def extract_archive(path, open_sink, chunk_size, max_files=BULK_MAX_FILES, max_expanded=ARCHIVE_EXPANDED_MAX_BYTES):
+    """Decompress each file of a ZIP archive on disk through its own sink, a chunk at a time.
+
+    Only the archive's central directory is held in memory. Works like stream_multipart_files:
+    open_sink(filename) may refuse a member, and a member that is too big or damaged is skipped.
+    Members may expand to max_expanded bytes in all, checked against the sizes the archive
+    declares and again against the bytes really decompressed. Returns (sinks, rejected).
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise UploadRejected(f"Not a valid ZIP archive: {str(e)}")
+
+    too_large = f"Archive expands to more than {max_expanded // MB} MB"
+    sinks = []
+    rejected = []
+    with archive:
+        members = [info for info in archive.infolist() if is_archive_member(info)]
+        if len(members) > max_files:
+            raise UploadRejected(f"At most {max_files} files per upload", 413)
+        if sum(info.file_size for info in members) > max_expanded:
+            raise UploadRejected(too_large, 413)
+
+        expanded = 0
+        for info in members:
+            filename = info.filename.rsplit('/', 1)[-1]
+            # The declared size can be checked before anything is decompressed
+            limit, reason = get_member_limit(info)
+            if info.file_size > limit:
+                rejected.append((filename, UploadRejected(reason, 413)))
+                continue
+            if expanded >= max_expanded:
+                rejected.append((filename, UploadRejected(too_large, 413)))
+                continue
+            try:
+                sink = open_sink(filename)
+            except UploadRejected as e:
+                rejected.append((filename, e))
+                continue
+
+            # The bytes really decompressed are metered too, not just the declared sizes
+            size = 0
+            try:
+                with archive.open(info) as member:
+                    for chunk in iter(lambda: member.read(chunk_size), b""):
+                        size += len(chunk)
+                        if size > limit:
+                            raise UploadRejected(reason, 413)
+                        if expanded + size > max_expanded:
+                            # Nothing more is decompressed from this request
+                            expanded = max_expanded
+                            raise UploadRejected(too_large, 413)
+                        sink.write(chunk)
+            except UploadRejected as e:
+                sink.discard()
+                rejected.append((filename, e))
+                continue
+            except (zipfile.BadZipFile, zlib.error, EOFError, RuntimeError, NotImplementedError) as e:
+                # Damaged, encrypted or using a compression method zipfile can't read
+                sink.discard()
+                rejected.append((filename, UploadRejected(f"Could not read {filename} from the archive: {str(e)}")))
+                continue
+            except Exception:
+                sink.discard()
+                for opened in sinks:
+                    opened.discard()
+                raise
+            expanded += size
+            sinks.append(sink)
+    return sinks, rejected
+
+class UploadBatches:
+    """Records of bulk uploads (the documents each one produced and the files it refused), kept as JSON files.
+
+    The folder also holds uploaded archives while their files are extracted.
+    """
+
+    def __init__(self, folder, ttl=UPLOAD_BATCH_TTL):
+        self.folder = folder
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.batches = None
+
+    def _path(self, batch_id):
+        return os.path.join(self.folder, f"{batch_id}.json")
+
+    def _load(self):
+        """Read the batches of earlier runs and drop archives they left behind (lock held)"""
+        if self.batches is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        self.batches = {}
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if name.endswith('.json'):
+                with open(path, 'r') as f:
+                    batch = json.load(f)
+                self.batches[batch["batch_id"]] = batch
+            elif name.endswith('.zip'):
+                os.remove(path)
+
+    def _expire(self):
+        """Forget batches older than the TTL (lock held)"""
+        cutoff = time.time() - self.ttl
+        for batch_id, batch in list(self.batches.items()):
+            if batch["created_at"] < cutoff:
+                del self.batches[batch_id]
+                os.remove(self._path(batch_id))
+
+    def archive_path(self):
+        """A fresh path to receive an uploaded archive at"""
+        with self.lock:
+            self._load()
+        return os.path.join(self.folder, f"{uuid.uuid4()}.zip")
+
+    def create(self, batch_id, user_id, doc_ids, rejected, fields):
+        """Record a bulk upload; rejected is a list of {"filename", "error", "status_code"}"""
+        batch = {
+            "batch_id": batch_id,
+            "user_id": user_id,
+            "doc_ids": list(doc_ids),
+            "rejected": list(rejected),
+            "fields": dict(fields),
+            "created_at": time.time(),
+        }
+        with self.lock:
+            self._load()
+            self._expire()
+            tmp_path = self._path(batch["batch_id"]) + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(batch, f)
+            os.replace(tmp_path, self._path(batch["batch_id"]))
+            self.batches[batch["batch_id"]] = batch
+        return batch
+
+    def get(self, batch_id):
+        with self.lock:
+            self._load()
+            return self.batches.get(batch_id)
+
+    def stats(self):
+        with self.lock:
+            return {"batches": len(self.batches) if self.batches is not None else None}
+
+class ResumableUploads:
+    """Chunked uploads that survive dropped connections: create, append at an offset, then finish"""
+
+    def __init__(self, folder, quota, ttl=RESUMABLE_UPLOAD_TTL):
+        self.folder = folder
+        self.quota = quota
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = None
+        # upload_id -> (sha256 of the bytes so far, their length); lost on restart
+        self.digests = {}
+        self.busy = set()
+
+    def _state_path(self, upload_id):
+        return os.path.join(self.folder, f"{upload_id}.json")
+
+    def _save(self, session):
+        tmp_path = self._state_path(session["upload_id"]) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(session, f)
+        os.replace(tmp_path, self._state_path(session["upload_id"]))
+
+    def _load(self):
+        """Pick up uploads left by a previous run (lock held)"""
+        if self.sessions is not None:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        self.sessions = {}
+        for name in os.listdir(self.folder):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.folder, name), 'r') as f:
+                session = json.load(f)
+            if os.path.exists(session["filepath"]):
+                self.sessions[session["upload_id"]] = session
+                # The bytes on disk already count against the user's quota
+                self.quota.reserve(session["user_id"], os.path.getsize(session["filepath"]), force=True)
+            else:
+                os.remove(os.path.join(self.folder, name))
+
+    def _expire(self):
+        """Discard uploads nobody has touched within the TTL (lock held)"""
+        now = time.time()
+        for upload_id, session in list(self.sessions.items()):
+            if session["updated_at"] + self.ttl < now and upload_id not in self.busy:
+                self._remove(session)
+
+    def _remove(self, session):
+        """Delete an upload's state and data, returning its bytes to the quota (lock held)"""
+        self.sessions.pop(session["upload_id"], None)
+        self.digests.pop(session["upload_id"], None)
+        size = os.path.getsize(session["filepath"]) if os.path.exists(session["filepath"]) else 0
+        self.quota.release(session["user_id"], size)
+        for path in (session["filepath"], self._state_path(session["upload_id"])):
+            if os.path.exists(path):
+                os.remove(path)
+        # The document folder was created for this upload alone
+        try:
+            os.rmdir(os.path.dirname(session["filepath"]))
+        except OSError:
+            pass
+
+    def create(self, doc_id, filepath, filename, total_size, fields):
+        """Start an upload whose bytes will be written to filepath"""
+        if total_size > UPLOAD_MAX_BYTES:
+            raise UploadRejected(f"File is larger than the {UPLOAD_MAX_BYTES // MB} MB upload limit", 413)
+        user_id = fields.get('user_id', '')
+        self.quota.check(user_id, total_size)
+
+        now = time.time()
+        session = {
+            "upload_id": str(uuid.uuid4()),
+            "doc_id": doc_id,
+            "filepath": filepath,
+            "filename": filename,
+            "total_size": total_size,
+            "user_id": user_id,
+            "fields": dict(fields),
+            "created_at": now,
+            "updated_at": now,
+        }
+        open(filepath, 'wb').close()
+        with self.lock:
+            self._load()
+            self._expire()
+            self.sessions[session["upload_id"]] = session
+            self._save(session)
+        return session
+
+    def get(self, upload_id):
+        """Get an upload and how many bytes of it have arrived"""
+        with self.lock:
+            self._load()
+            self._expire()
+            session = self.sessions.get(upload_id)
+            if session is None:
+                return None, 0
+            return session, os.path.getsize(session["filepath"])
+
+    def _claim(self, upload_id):
+        """Mark an upload as in use so two requests cannot write it at once"""
+        with self.lock:
+            self._load()
+            session = self.sessions.get(upload_id)
+            if session is None:
+                raise UploadRejected("Upload not found", 404)
+            if upload_id in self.busy:
+                raise UploadRejected("Upload is already being written", 409)
+            self.busy.add(upload_id)
+            return session
+
+    def append(self, upload_id, offset, stream, chunk_size):
+        """Write the bytes of one request at offset; returns the new offset"""
+        session = self._claim(upload_id)
+        try:
+            current = os.path.getsize(session["filepath"])
+            if offset != current:
+                raise UploadRejected("Offset does not match the bytes received", 409, offset=current)
+
+            # Keep hashing incrementally unless a restart lost the running digest
+            with self.lock:
+                digest, hashed = self.digests.pop(upload_id, (None, 0))
+            if hashed != current:
+                digest = hashlib.sha256() if current == 0 else None
+
+            sink = UploadSink(session["filepath"], self.quota, session["user_id"],
+                              max_bytes=session["total_size"], offset=current, digest=digest)
+            try:
+                while True:
+                    chunk = read_chunk(stream, chunk_size)
+                    if not chunk:
+                        break
+                    sink.write(chunk)
+                sink.close()
+            except UploadInterrupted:
+                # Keep what arrived; the client resumes from the new offset
+                sink.close()
+                self._touch(session, digest, sink.size)
+                raise
+            except Exception:
+                sink.discard()
+                raise
+            self._touch(session, digest, sink.size)
+            return sink.size
+        finally:
+            with self.lock:
+                self.busy.discard(upload_id)
+
+    def _touch(self, session, digest, size):
+        """Record progress on an upload"""
+        with self.lock:
+            if digest is not None:
+                self.digests[session["upload_id"]] = (digest, size)
+            session["updated_at"] = time.time()
+            self._save(session)
+
+    def finish(self, upload_id, expected_sha256=None):
+        """Close a fully received upload; returns (session, sha256, size)"""
+        session = self._claim(upload_id)
+        try:
+            size = os.path.getsize(session["filepath"])
+            if size != session["total_size"]:
+                raise UploadRejected("Upload is incomplete", 409, offset=size)
+
+            with open(session["filepath"], 'rb') as f:
+                header = f.read(SNIFF_BYTES)
+            ext = session["filepath"].rsplit('.', 1)[-1].lower()
+            check_file_kind(ext, header)
+
+            with self.lock:
+                digest = self.digests.get(upload_id)
+            if digest is not None and digest[1] == size:
+                content_hash = digest[0].hexdigest()
+            else:
+                content_hash = hash_file(session["filepath"])
+
+            if expected_sha256 and expected_sha256.lower() != content_hash:
+                raise UploadRejected("Checksum mismatch", 422, sha256=content_hash)
+
+            # The file stays where it is; only the upload's state goes
+            with self.lock:
+                self.sessions.pop(upload_id, None)
+                self.digests.pop(upload_id, None)
+                os.remove(self._state_path(upload_id))
+            return session, content_hash, size
+        finally:
+            with self.lock:
+                self.busy.discard(upload_id)
+
+    def abort(self, upload_id):
+        """Throw away an upload"""
+        session = self._claim(upload_id)
+        with self.lock:
+            self.busy.discard(upload_id)
+            self._remove(session)
+
+    def stats(self):
+        with self.lock:
+            return {"active": len(self.sessions) if self.sessions is not None else None}
+
+def hash_file(filepath, chunk_size=MB):
+    """SHA-256 of a file on disk"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -304,6 +304,110 @@ class BackendService {
     }
   }
 
+  // Upload several documents (or ZIP archives of them) in one request. The
+  // metadata (category, tags, ...) applies to every file; each file's name is
+  // its title. Files the server refuses are listed under 'rejected'.
+  Future<Map<String, dynamic>> uploadDocuments(
+    List<String> filePaths,
+    Map<String, dynamic> metadata,
+  ) async {
+    await initialize();
+
+    if (!isConfigured) {
+      return {'success': false, 'message': 'Backend not configured'};
+    }
+
+    try {
+      final uploadUrl = '$_backendUrl/process_documents';
+      final request = http.MultipartRequest('POST', Uri.parse(uploadUrl));
+
+      // Fields go first, so the server knows whose quota the files count against
+      metadata.forEach((key, value) {
+        if (value != null) {
+          request.fields[key] = value.toString();
+        }
+      });
+
+      for (final filePath in filePaths) {
+        final file = File(filePath);
+        if (!file.existsSync()) {
+          throw Exception('File does not exist: $filePath');
+        }
+        request.files.add(
+          http.MultipartFile(
+            'files',
+            http.ByteStream(file.openRead()),
+            await file.length(),
+            filename: path.basename(filePath),
+          ),
+        );
+      }
+
+      final streamedResponse = await request.send();
+      final response = await http.Response.fromStream(streamedResponse);
+      final responseData = json.decode(response.body);
+
+      if (response.statusCode == 200) {
+        print('Documents uploaded to backend: batch ${responseData['batch_id']}');
+        return {
+          'success': true,
+          'message': responseData['message'],
+          'batch_id': responseData['batch_id'],
+          'status_url': responseData['status_url'],
+          'documents': responseData['documents'],
+          'rejected': responseData['rejected'] ?? [],
+        };
+      } else {
+        print(
+          'Error uploading documents to backend: ${response.statusCode} ${response.body}',
+        );
+        return {
+          'success': false,
+          'message':
+              'Failed to upload documents: ${response.statusCode} ${response.reasonPhrase}',
+          'rejected': responseData is Map ? responseData['rejected'] ?? [] : [],
+        };
+      }
+    } catch (e) {
+      print('Exception uploading documents to backend: $e');
+      return {'success': false, 'message': 'Exception uploading documents: $e'};
+    }
+  }
+
+  // Check the combined progress of a bulk upload
+  Future<Map<String, dynamic>> checkBatchStatus(String batchId) async {
+    await initialize();
+
+    if (!isConfigured) {
+      return {'success': false, 'message': 'Backend not configured'};
+    }
+
+    try {
+      final response = await http.get(Uri.parse('$_backendUrl/batches/$batchId'));
+
+      if (response.statusCode == 200) {
+        final responseData = json.decode(response.body);
+        return {
+          'success': true,
+          'done': responseData['done'],
+          'progress': responseData['progress'],
+          'data': responseData,
+        };
+      } else {
+        return {
+          'success': false,
+          'message':
+              'Failed to check batch status: ${response.statusCode} ${response.reasonPhrase}',
+        };
+      }
+    } catch (e) {
+      return {
+        'success': false,
+        'message': 'Exception checking batch status: $e',
+      };
+    }
+  }
+
   // Check document processing status
   Future<Map<String, dynamic>> checkDocumentStatus(String documentId) async {
     await initialize();
@@ -343,4 +447,56 @@ class BackendService {
       };
     }
   }
+
+  // Wait for status changes of several documents (long-poll). Without a cursor
+  // the current statuses are returned at once, with the cursor to wait from next.
+  Future<Map<String, dynamic>> waitForDocumentStatusChanges(
+    List<String> documentIds, {
+    int? cursor,
+    int timeoutSeconds = 30,
+  }) async {
+    await initialize();
+
+    if (!isConfigured) {
+      return {'success': false, 'message': 'Backend not configured'};
+    }
+
+    try {
+      final query = {
+        'doc_ids': documentIds.join(','),
+        'timeout': timeoutSeconds.toString(),
+        if (cursor != null) 'cursor': cursor.toString(),
+      };
+      final pollUrl = Uri.parse(
+        '$_backendUrl/document_events/poll',
+      ).replace(queryParameters: query);
+      final response = await http
+          .get(pollUrl)
+          .timeout(Duration(seconds: timeoutSeconds + 10));
+
+      if (response.statusCode == 200) {
+        final responseData = json.decode(response.body);
+        return {
+          'success': true,
+          'cursor': responseData['cursor'],
+          // Current statuses (first call, or after missing changes) ...
+          'documents': responseData['documents'],
+          // ... or the changes since the cursor
+          'events': responseData['events'] ?? [],
+          'resync': responseData['resync'] ?? false,
+        };
+      } else {
+        return {
+          'success': false,
+          'message':
+              'Failed to wait for status changes: ${response.statusCode} ${response.reasonPhrase}',
+        };
+      }
+    } catch (e) {
+      return {
+        'success': false,
+        'message': 'Exception waiting for status changes: $e',
+      };
+    }
+  }
 }